@@ -0,0 +1,255 @@
+''' Throughput and latency benchmarks for the loghandlersplus handlers.
+
+Each handler is driven by a number of caller threads, with records of
+a given size, against a downstream with injected latency and failure
+rate. The SQS and SNS handlers run against the in-process stand-ins in
+standin.py, so no AWS account or network is needed (boto must still
+be installed for them to import). The event-loop handlers run against
+a stand-in HTTP server on localhost. For each case we report throughput
+and the latency percentiles seen by the caller.
+
+Usage:
+
+    python benchmarks/bench.py --threads 1,4,16 --sizes 100,2000 \\
+        --latency 0.016 --failure-rate 0.01 --save results.json
+
+    python benchmarks/bench.py --baseline results.json
+
+With --baseline, the run fails if any case loses more than --tolerance
+of its throughput, or its p99 latency grows by more than that much.
+'''
+import json
+import logging
+import optparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from lambdahandler import LambdaHandler
+from failsafehandler import FailsafeHandler
+from eventhandlers import EventSQSHandler, EventSNSHandler
+from standin import Downstream, StandInSQSConnection, StandInSNSConnection, StandInHTTPServer
+
+try:
+    from sqshandler import SQSHandler
+    from snshandler import SNSHandler
+except ImportError:
+    SQSHandler = SNSHandler = None
+
+
+def noop(msg):
+    pass
+
+
+def lambda_case(downstream):
+    return LambdaHandler(lambda msg: downstream.call(1, len(msg)))
+
+
+def failsafe_case(downstream):
+    main = lambda_case(downstream)
+    timeout = max(0.1, downstream.latency * 10)
+    return FailsafeHandler(main, [LambdaHandler(noop)], LambdaHandler(noop),
+                           timeout=timeout, attempts=3, retry_timeout=1)
+
+
+def failsafe_hedge_case(downstream):
+    main = lambda_case(downstream)
+    timeout = max(0.1, downstream.latency * 10)
+    return FailsafeHandler(main, [LambdaHandler(noop)], LambdaHandler(noop),
+                           timeout=timeout, attempts=3, retry_timeout=1, hedge=0.9)
+
+
+# Number of pooled connections given to the SQS and SNS handlers
+POOL_SIZE = 1
+
+
+def sqs_case(downstream):
+    return SQSHandler(connection_factory=lambda: StandInSQSConnection(downstream),
+                      pool_size=POOL_SIZE)
+
+
+def sqs_batch_case(downstream):
+    return SQSHandler(connection_factory=lambda: StandInSQSConnection(downstream),
+                      pool_size=POOL_SIZE, batch=True, linger=0.05)
+
+
+def sqs_envelope_case(downstream):
+    return SQSHandler(connection_factory=lambda: StandInSQSConnection(downstream),
+                      pool_size=POOL_SIZE, envelope="zlib", batch_count=1000,
+                      batch_bytes=1024*1024, linger=0.05)
+
+
+def sns_case(downstream):
+    return SNSHandler(connection_factory=lambda: StandInSNSConnection(downstream),
+                      pool_size=POOL_SIZE)
+
+
+def sns_batch_case(downstream):
+    return SNSHandler(connection_factory=lambda: StandInSNSConnection(downstream),
+                      pool_size=POOL_SIZE, batch=True, linger=0.05)
+
+def sns_envelope_case(downstream):
+    return SNSHandler(connection_factory=lambda: StandInSNSConnection(downstream),
+                      pool_size=POOL_SIZE, envelope="zlib", batch_count=1000,
+                      batch_bytes=1024*1024, linger=0.05)
+
+# Requests the event-loop handlers keep in flight
+CONCURRENCY = 64
+
+_server = None
+
+
+def standin_server(downstream):
+    ''' One stand-in HTTP server serves every event-loop case. '''
+    global _server
+    if _server is None:
+        _server = StandInHTTPServer(downstream)
+    _server.downstream = downstream
+    return _server
+
+
+def sqs_event_case(downstream):
+    return EventSQSHandler("https://sqs.us-east-1.amazonaws.com/000000000000/sqs_handler_debug",
+                           endpoint=standin_server(downstream).url, concurrency=CONCURRENCY)
+
+
+def sns_event_case(downstream):
+    return EventSNSHandler("arn:aws:sns:us-east-1:000000000000:sns_handler_debug",
+                           endpoint=standin_server(downstream).url, concurrency=CONCURRENCY)
+
+CASES = [("lambda", lambda_case),
+         ("failsafe", failsafe_case),
+         ("failsafe-hedge", failsafe_hedge_case),
+         ("sqs", sqs_case),
+         ("sqs-batch", sqs_batch_case),
+         ("sqs-envelope", sqs_envelope_case),
+         ("sns", sns_case),
+         ("sns-batch", sns_batch_case),
+         ("sns-envelope", sns_envelope_case),
+         ("sqs-event", sqs_event_case),
+         ("sns-event", sns_event_case)]
+
+AWS_CASES = ("sqs", "sqs-batch", "sqs-envelope", "sns", "sns-batch", "sns-envelope")
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def run_case(make_handler, threads, size, records, latency, failure_rate, seed=0):
+    ''' Runs one case. Returns a dictionary of results. '''
+    downstream = Downstream(latency=latency, jitter=0.2, failure_rate=failure_rate, seed=seed)
+    handler = make_handler(downstream)
+    # Errors are expected with injected failures; don't print them.
+    handler.handleError = lambda record: None
+    msg = "x" * size
+    per_thread = records // threads
+    latencies = [[] for i in range(threads)]
+
+    def caller(out):
+        record = logging.LogRecord("bench", logging.ERROR, __file__, 0, msg, None, None)
+        for i in range(per_thread):
+            t = time.time()
+            try:
+                handler.handle(record)
+            except Exception:
+                pass
+            out.append(time.time() - t)
+
+    workers = [threading.Thread(target=caller, args=(latencies[i],)) for i in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    handler.flush()
+    elapsed = time.time() - start
+    handler.close()
+
+    ordered = sorted(sum(latencies, []))
+    return {"records": per_thread * threads,
+            "seconds": elapsed,
+            "throughput": per_thread * threads / elapsed,
+            "p50": percentile(ordered, 0.50),
+            "p90": percentile(ordered, 0.90),
+            "p99": percentile(ordered, 0.99),
+            "max": ordered[-1] if ordered else 0.0,
+            "calls": downstream.calls,
+            "delivered": downstream.messages}
+
+
+def compare(results, baseline, tolerance):
+    ''' Returns a list of regressions against a baseline. '''
+    regressions = []
+    for key, old in sorted(baseline.items()):
+        new = results.get(key)
+        if new is None:
+            continue
+        if new["throughput"] < old["throughput"] * (1 - tolerance):
+            regressions.append("%s: throughput %.0f/s, was %.0f/s" % (key, new["throughput"], old["throughput"]))
+        if new["p99"] > old["p99"] * (1 + tolerance) and new["p99"] - old["p99"] > 0.001:
+            regressions.append("%s: p99 %.2fms, was %.2fms" % (key, new["p99"] * 1000, old["p99"] * 1000))
+    return regressions
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--handlers", default=",".join(name for name, f in CASES),
+                      help="comma-separated cases to run")
+    parser.add_option("--threads", default="1,4,16", help="comma-separated caller thread counts")
+    parser.add_option("--sizes", default="100,2000", help="comma-separated message sizes in bytes")
+    parser.add_option("--records", type="int", default=2000, help="records per case")
+    parser.add_option("--latency", type="float", default=0.016, help="injected downstream latency in seconds")
+    parser.add_option("--failure-rate", type="float", default=0.0, help="injected downstream failure rate")
+    parser.add_option("--pool-size", type="int", default=1, help="connections pooled by the SQS and SNS handlers")
+    parser.add_option("--concurrency", type="int", default=64, help="requests in flight for the event-loop handlers")
+    parser.add_option("--save", help="write results as JSON to this file")
+    parser.add_option("--baseline", help="compare against results saved with --save")
+    parser.add_option("--tolerance", type="float", default=0.2, help="allowed fractional regression")
+    options, args = parser.parse_args(argv)
+
+    global POOL_SIZE, CONCURRENCY
+    POOL_SIZE = options.pool_size
+    CONCURRENCY = options.concurrency
+    names = options.handlers.split(",")
+    threads = [int(t) for t in options.threads.split(",")]
+    sizes = [int(s) for s in options.sizes.split(",")]
+
+    results = {}
+    print "%-14s %7s %6s %10s %9s %9s %9s %9s %7s" % (
+        "handler", "threads", "size", "records/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "calls")
+    for name, make_handler in CASES:
+        if name not in names:
+            continue
+        if name in AWS_CASES and SQSHandler is None:
+            print "%-14s skipped (boto not installed)" % name
+            continue
+        for t in threads:
+            for size in sizes:
+                r = run_case(make_handler, t, size, options.records, options.latency, options.failure_rate)
+                key = "%s/%d/%d" % (name, t, size)
+                results[key] = r
+                print "%-14s %7d %6d %10.0f %9.2f %9.2f %9.2f %9.2f %7d" % (
+                    name, t, size, r["throughput"], r["p50"] * 1000, r["p90"] * 1000,
+                    r["p99"] * 1000, r["max"] * 1000, r["calls"])
+                sys.stdout.flush()
+
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for regression in regressions:
+            print "REGRESSION", regression
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
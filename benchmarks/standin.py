@@ -0,0 +1,156 @@
+''' In-process stand-ins for the boto SQS and SNS connections used by
+SQSHandler and SNSHandler, and a local HTTP server standing in for
+the SQS and SNS endpoints for the event-loop handlers. They accept the
+same calls, sleep for an injected latency and fail at an injected
+rate, so benchmarks run offline and give repeatable numbers. '''
+import BaseHTTPServer
+import random
+import SocketServer
+import threading
+import time
+import urlparse
+
+
+class StandInError(Exception):
+    ''' Raised by a stand-in to simulate a failed AWS call. '''
+    pass
+
+
+class Downstream(object):
+    ''' Latency and failure injection shared by the stand-ins.
+
+    Parameters:
+    * latency is the mean time, in seconds, of each call
+    * jitter is the fraction by which latency varies uniformly
+    * failure_rate is the probability that a call raises StandInError
+    * seed makes the random choices repeatable
+    '''
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.messages = 0
+        self.bytes = 0
+
+    def call(self, messages, size):
+        with self.lock:
+            self.calls += 1
+            r = self.random.random()
+            delay = self.latency * (1 + self.jitter * (2 * self.random.random() - 1))
+        if delay > 0:
+            time.sleep(delay)
+        if r < self.failure_rate:
+            raise StandInError("Injected failure")
+        with self.lock:
+            self.messages += messages
+            self.bytes += size
+
+
+class _BatchResults(object):
+    def __init__(self, errors):
+        self.errors = errors
+
+
+class _SentMessage(object):
+    def __init__(self, body):
+        self.id = "00000000-0000-0000-0000-000000000000"
+        self.md5 = ""
+
+
+class StandInQueue(object):
+    ''' Stands in for boto.sqs.queue.Queue '''
+    def __init__(self, downstream, name):
+        self.downstream = downstream
+        self.name = name
+        self.url = "http://localhost/000000000000/" + name
+
+    def write(self, message):
+        body = message.get_body_encoded()
+        self.downstream.call(1, len(body))
+        return message
+
+    def write_batch(self, messages, delay_seconds=None):
+        self.downstream.call(len(messages), sum(len(m[1]) for m in messages))
+        return _BatchResults([])
+
+
+class StandInSQSConnection(object):
+    ''' Stands in for boto.sqs.connection.SQSConnection '''
+    def __init__(self, downstream):
+        self.downstream = downstream
+
+    def create_queue(self, name):
+        return StandInQueue(self.downstream, name)
+
+    # Called by boto.sqs.queue.Queue objects built around this connection
+    def send_message(self, queue, message_content, delay_seconds=None, message_attributes=None):
+        self.downstream.call(1, len(message_content))
+        return _SentMessage(message_content)
+
+    def send_message_batch(self, queue, messages):
+        self.downstream.call(len(messages), sum(len(m[1]) for m in messages))
+        return _BatchResults([])
+
+
+class StandInSNSConnection(object):
+    ''' Stands in for boto.sns.SNSConnection '''
+    def __init__(self, downstream, topics=("sns_handler_debug",)):
+        self.downstream = downstream
+        self.topics = ["arn:aws:sns:us-east-1:000000000000:" + t for t in topics]
+
+    def get_all_topics(self, next_token=None):
+        topics = [{'TopicArn': t} for t in self.topics]
+        return {"ListTopicsResponse": {"ListTopicsResult": {"Topics": topics}}}
+
+    def publish(self, topic, message, subject=None, message_attributes=None):
+        self.downstream.call(1, len(message))
+
+    def _make_request(self, action, params, path='/', verb='GET'):
+        messages = [v for k, v in params.items() if k.endswith('.Message')]
+        self.downstream.call(len(messages), sum(len(m) for m in messages))
+        return {action + "Response": {action + "Result": {"Failed": []}}}
+
+
+class _StandInRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # One write per response, or Nagle's algorithm stalls keep-alive
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        params = urlparse.parse_qs(body)
+        message = (params.get("MessageBody") or params.get("Message") or [""])[0]
+        action = params.get("Action", ["Unknown"])[0]
+        try:
+            self.server.downstream.call(1, len(message))
+            status = 200
+            reply = "<%sResponse/>" % action
+        except StandInError:
+            status = 500
+            reply = "<ErrorResponse/>"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' Stands in for the SQS and SNS query API endpoints. Runs on a
+    background thread; point handlers at url. The downstream may be
+    swapped between runs. '''
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, downstream):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), _StandInRequestHandler)
+        self.downstream = downstream
+        self.url = "http://127.0.0.1:%d" % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever, name="StandInHTTPServer")
+        thread.daemon = True
+        thread.start()
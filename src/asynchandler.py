@@ -0,0 +1,274 @@
+import logging
+import logging.handlers
+import threading
+import time
+import Queue
+
+from compact import CompactRecord
+from metrics import HandlerMetrics
+
+
+class AsyncHandler(logging.Handler):
+    ''' AsyncHandler wraps another handler so that emit only puts the
+    record on a bounded in-memory queue. One or more background
+    drainer threads take records off the queue and pass them to the
+    wrapped handler. The caller never waits on the network.
+
+    This is meant for the SNS and SQS handlers:
+
+        handler = AsyncHandler(SQSHandler("myqueue"), queue_size=10000)
+
+    When the queue is full, overflow decides what happens:
+    * "block" waits for room, for up to block_timeout seconds (forever
+      if None), then drops the new record
+    * "drop_oldest" discards the oldest queued record to make room
+    * "drop_newest" discards the new record
+    * "fallback" hands the new record to fallback_handler on the
+      caller's thread
+
+    flush() waits until everything queued so far has been handed to
+    the wrapped handler, and flushes it. close() flushes, stops the
+    drainers and closes the wrapped handler. Records emitted after
+    close() go to fallback_handler if there is one, and are otherwise
+    dropped.
+
+    With more than one worker, the wrapped handler's emit is called
+    from several threads at once, as with FailsafeHandler.
+
+    With compact=True, records are queued as CompactRecords, which
+    hold a fraction of the memory, and expanded again for the wrapped
+    handler; see the compact module for what is kept.
+    '''
+    OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_newest", "fallback")
+
+    def __init__(self, handler, queue_size=10000, workers=1, overflow="block",
+                 fallback_handler=None, block_timeout=None, compact=False):
+        ''' Parameters:
+        * handler is the wrapped handler
+        * queue_size is the number of records which may be queued
+        * workers is the number of drainer threads
+        * overflow is one of "block", "drop_oldest", "drop_newest" or
+          "fallback"
+        * fallback_handler receives overflow records with "fallback",
+          and records emitted after close
+        * block_timeout bounds the wait with "block"
+        * compact queues CompactRecords instead of the records
+        '''
+        logging.Handler.__init__(self)
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy " + str(overflow))
+        if overflow == "fallback" and fallback_handler is None:
+            raise ValueError("overflow='fallback' requires a fallback_handler")
+        self.handler = handler
+        self.overflow = overflow
+        self.fallback_handler = fallback_handler
+        self.block_timeout = block_timeout
+        self.compact = compact
+        self.metrics = HandlerMetrics("AsyncHandler")
+        self.closed = False
+        # Guards closed, and counts the emits putting a record on the
+        # queue, which close waits for
+        self.state = threading.Condition(threading.Lock())
+        self.putting = 0
+        self.queue = Queue.Queue(queue_size)
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.__drain, name="AsyncHandler-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def __drain(self):
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    return
+                if self.compact:
+                    record = record.expand()
+                t = time.time()
+                try:
+                    self.handler.emit(record)
+                except Exception:
+                    self.metrics.observe(time.time() - t, "raised")
+                    self.handleError(record)
+                else:
+                    self.metrics.observe(time.time() - t, "succeeded")
+            finally:
+                self.queue.task_done()
+
+    def emit(self, record):
+        self.metrics.incr("emitted")
+        with self.state:
+            closed = self.closed
+            if not closed:
+                self.putting += 1
+        if closed:
+            # The wrapped handler is closed, or about to be
+            if self.fallback_handler is not None:
+                self.metrics.incr("fell_back")
+                self.fallback_handler.handle(record)
+            else:
+                self.metrics.incr("dropped")
+            return
+        try:
+            self.__put(record)
+        finally:
+            with self.state:
+                self.putting -= 1
+                if not self.putting:
+                    self.state.notify_all()
+
+    def __put(self, record):
+        queued = CompactRecord(record) if self.compact else record
+        try:
+            self.queue.put_nowait(queued)
+            self.metrics.incr("queued")
+            return
+        except Queue.Full:
+            pass
+        if self.overflow == "block":
+            try:
+                self.queue.put(queued, True, self.block_timeout)
+                self.metrics.incr("queued")
+            except Queue.Full:
+                self.metrics.incr("dropped")
+        elif self.overflow == "drop_oldest":
+            while True:
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.metrics.incr("dropped")
+                except Queue.Empty:
+                    pass
+                try:
+                    self.queue.put_nowait(queued)
+                    self.metrics.incr("queued")
+                    return
+                except Queue.Full:
+                    pass
+        elif self.overflow == "drop_newest":
+            self.metrics.incr("dropped")
+        else:
+            self.metrics.incr("fell_back")
+            self.fallback_handler.handle(record)
+
+    def pending(self):
+        ''' The number of records queued or being sent. '''
+        return self.queue.unfinished_tasks
+
+    def flush(self, timeout=None):
+        ''' Waits until every record queued so far has been emitted,
+        then flushes the wrapped handler. Returns False if timeout
+        seconds passed first. '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        q = self.queue
+        with q.all_tasks_done:
+            while q.unfinished_tasks:
+                if deadline is None:
+                    q.all_tasks_done.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    q.all_tasks_done.wait(remaining)
+        self.handler.flush()
+        return True
+
+    def close(self):
+        with self.state:
+            closing = not self.closed
+            self.closed = True
+            # Let emits already past the check queue their records,
+            # so the flush below sends them
+            while self.putting:
+                self.state.wait()
+        if closing:
+            self.flush()
+            for t in self.threads:
+                self.queue.put(None)
+            for t in self.threads:
+                t.join()
+            self.handler.close()
+        logging.Handler.close(self)
+
+if __name__ == '__main__':
+    from lambdahandler import LambdaHandler
+    logger = logging.getLogger('myapp')
+    received = []
+    def slow(x):
+        time.sleep(0.01)
+        received.append(x)
+
+    handler = AsyncHandler(LambdaHandler(slow), queue_size=5, overflow="drop_newest")
+    logger.addHandler(handler)
+    t = time.time()
+    for i in range(20):
+        logger.error("TEST %d" % i)
+    if time.time() - t > 0.05:
+        raise Exception("emit blocked")
+    handler.close()
+    logger.removeHandler(handler)
+    dropped = handler.metrics.snapshot()["counters"]["dropped"]
+    if dropped + len(received) != 20 or not dropped:
+        raise Exception("drop_newest failed " + str(received))
+    print "Async drop_newest OKAY"
+
+    del received[:]
+    spilled = []
+    handler = AsyncHandler(LambdaHandler(slow), queue_size=5, workers=2, overflow="fallback",
+                           fallback_handler=LambdaHandler(spilled.append))
+    logger.addHandler(handler)
+    for i in range(20):
+        logger.error("TEST %d" % i)
+    handler.close()
+    logger.error("TEST closed")
+    logger.removeHandler(handler)
+    if sorted(received + spilled) != sorted(["TEST %d" % i for i in range(20)] + ["TEST closed"]) or \
+            spilled[-1] != "TEST closed":
+        raise Exception("fallback failed")
+    print "Async fallback OKAY"
+
+    del received[:]
+    formatted = LambdaHandler(received.append)
+    formatted.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    handler = AsyncHandler(formatted, compact=True)
+    logger.addHandler(handler)
+    logger.error("TEST %s", "compact")
+    handler.close()
+    logger.removeHandler(handler)
+    if received != ["ERROR TEST compact"]:
+        raise Exception("compact failed " + str(received))
+    print "Async compact OKAY"
+
+    # Emits racing close are sent; those after it don't reach the
+    # closed handler
+    del received[:]
+    class Closable(LambdaHandler):
+        closed = False
+
+        def emit(self, record):
+            if self.closed:
+                raise Exception("emit after close")
+            LambdaHandler.emit(self, record)
+
+        def close(self):
+            self.closed = True
+    wrapped = Closable(slow)
+    handler = AsyncHandler(wrapped, workers=2)
+    def emits():
+        for i in range(100):
+            handler.emit(logging.makeLogRecord({"msg": "TEST %d" % i}))
+    threads = [threading.Thread(target=emits) for i in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.05)
+    handler.close()
+    for t in threads:
+        t.join()
+    counters = handler.metrics.snapshot()["counters"]
+    if len(received) != counters["queued"] or len(received) + counters["dropped"] != 400:
+        raise Exception("close race failed: %d sent, %s" % (len(received), counters))
+    print "Async close OKAY"
@@ -0,0 +1,139 @@
+import threading
+import time
+
+
+class BatchBuffer(object):
+    ''' Collects items and hands them to a flush function in batches.
+
+    A batch is flushed once it holds max_count items, once adding an
+    item would take it past max_bytes, or once its oldest item is
+    max_linger seconds old. Count and size flushes happen on the
+    thread which called add(); linger flushes happen on a background
+    timer thread. flush_function is always called without the buffer
+    lock held, with a list of items.
+    '''
+    def __init__(self, flush_function, max_count=10, max_bytes=256*1024, max_linger=1.0, name="BatchBuffer"):
+        ''' Parameters:
+        * flush_function is called with a list of items
+        * max_count is the largest number of items in a batch
+        * max_bytes is the largest total size of a batch
+        * max_linger is the longest, in seconds, an item waits to be
+          sent. None disables the timer thread.
+        '''
+        self.flush_function = flush_function
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_linger = max_linger
+        self.items = []
+        self.sizes = []
+        self.size = 0
+        self.deadline = None
+        self.closed = False
+        self.condition = threading.Condition(threading.Lock())
+        self.timer = None
+        if max_linger is not None:
+            self.timer = threading.Thread(target=self.__linger, name=name)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def __take(self):
+        # Must be called with the lock held. Returns the current batch.
+        batch = self.items
+        self.items = []
+        self.sizes = []
+        self.size = 0
+        self.deadline = None
+        return batch
+
+    def __append(self, item, size):
+        # Must be called with the lock held.
+        if not self.items and self.max_linger is not None:
+            self.deadline = time.time() + self.max_linger
+            self.condition.notify()
+        self.items.append(item)
+        self.sizes.append(size)
+        self.size += size
+
+    def add(self, item, size=0):
+        ''' Adds an item of the given size. May flush on the calling thread. '''
+        batches = []
+        with self.condition:
+            if self.items and self.size + size > self.max_bytes:
+                batches.append(self.__take())
+            self.__append(item, size)
+            if len(self.items) >= self.max_count or self.size >= self.max_bytes:
+                batches.append(self.__take())
+        for batch in batches:
+            self.flush_function(batch)
+
+    def requeue(self, items, sizes):
+        ''' Puts items which failed to send back at the front of the
+        buffer, to go out with the next batch. '''
+        batches = []
+        with self.condition:
+            pending = zip(self.items, self.sizes)
+            self.__take()
+            for item, size in zip(items, sizes) + pending:
+                if self.items and (len(self.items) >= self.max_count or self.size + size > self.max_bytes):
+                    batches.append(self.__take())
+                self.__append(item, size)
+        for batch in batches:
+            self.flush_function(batch)
+
+    def __len__(self):
+        return len(self.items)
+
+    def flush(self):
+        ''' Sends whatever is buffered now. '''
+        with self.condition:
+            batch = self.__take()
+        if batch:
+            self.flush_function(batch)
+
+    def close(self):
+        ''' Stops the timer thread, waiting for any flush it is in the
+        middle of, then flushes until the buffer is empty. Items which
+        flush_function requeues are flushed again, so it must give up
+        on an item eventually. '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.timer is not None and self.timer is not threading.current_thread():
+            self.timer.join()
+        while self.items:
+            self.flush()
+
+    def __linger(self):
+        while True:
+            batch = None
+            with self.condition:
+                if self.closed:
+                    return
+                if self.deadline is None:
+                    self.condition.wait()
+                    continue
+                delay = self.deadline - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                batch = self.__take()
+            try:
+                self.flush_function(batch)
+            except Exception:
+                # There is no caller to report to. The flush function
+                # is expected to handle its own errors.
+                pass
+
+if __name__ == '__main__':
+    batches = []
+    buf = BatchBuffer(batches.append, max_count=3, max_bytes=10, max_linger=0.1)
+    for i in range(4):
+        buf.add(i, 1)
+    buf.add(4, 8)
+    buf.add(5, 5)
+    time.sleep(0.3)
+    buf.requeue([6, 7], [1, 1])
+    buf.close()
+    if batches != [[0, 1, 2], [3, 4], [5], [6, 7]]:
+        raise Exception("BatchBuffer failed: " + str(batches))
+    print "BatchBuffer OKAY"
@@ -0,0 +1,102 @@
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    ''' Tracks whether a handler should be used. A breaker is closed
+    while the handler is healthy, open once it has timed out /attempts/
+    times within /retry_timeout/ seconds, and half-open while a single
+    probe record is testing whether it has recovered.
+
+    Usage:
+
+        state = breaker.allow()
+        if state is None: skip the handler
+        ... try the handler, then one of:
+        breaker.success(state), breaker.failure(state), breaker.abort(state)
+
+    allow() is a couple of attribute reads for a healthy handler. All
+    transitions happen under a lock, and only one thread at a time is
+    given the probe of an open breaker.
+    '''
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    __slots__ = ('attempts', 'retry_timeout', 'state', 'failures', 'reset_time', 'lock')
+
+    def __init__(self, attempts, retry_timeout):
+        ''' Parameters:
+        * attempts is the number of timeouts before the breaker opens
+        * retry_timeout is how long the breaker stays open, and how
+          long timeouts are remembered while it is closed
+        '''
+        self.attempts = attempts
+        self.retry_timeout = retry_timeout
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        ''' Closes the breaker and forgets past timeouts. '''
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.reset_time = 0
+
+    def allow(self):
+        ''' Returns CLOSED if the handler may be used, HALF_OPEN if the
+        caller holds the probe, or None if the handler should be
+        skipped. '''
+        if self.state is self.CLOSED and not self.failures:
+            return self.CLOSED
+        with self.lock:
+            if self.state is self.CLOSED:
+                if self.reset_time < time.time():
+                    self.failures = 0
+                return self.CLOSED
+            if self.state is self.OPEN and self.reset_time < time.time():
+                self.state = self.HALF_OPEN
+                return self.HALF_OPEN
+            return None
+
+    def success(self, state):
+        ''' The handler succeeded. A successful probe closes the breaker. '''
+        if state is self.HALF_OPEN:
+            with self.lock:
+                self.state = self.CLOSED
+                self.failures = 0
+
+    def failure(self, state):
+        ''' The handler timed out. '''
+        with self.lock:
+            self.reset_time = time.time() + self.retry_timeout
+            if state is self.HALF_OPEN:
+                self.state = self.OPEN
+                return
+            self.failures += 1
+            if self.failures >= self.attempts and self.state is self.CLOSED:
+                self.state = self.OPEN
+
+    def abort(self, state):
+        ''' The attempt gave no verdict on the handler's health (for
+        example, it raised, or was never run). A probe is released so
+        the next record may probe again. '''
+        if state is self.HALF_OPEN:
+            with self.lock:
+                self.state = self.OPEN
+
+if __name__ == '__main__':
+    breaker = CircuitBreaker(attempts=2, retry_timeout=0.1)
+    state = breaker.allow()
+    breaker.failure(state)
+    breaker.failure(breaker.allow())
+    if breaker.allow() is not None:
+        raise Exception("Breaker did not open")
+    time.sleep(0.15)
+    probe = breaker.allow()
+    if probe != CircuitBreaker.HALF_OPEN or breaker.allow() is not None:
+        raise Exception("More than one probe allowed")
+    breaker.success(probe)
+    if breaker.allow() != CircuitBreaker.CLOSED:
+        raise Exception("Probe did not close breaker")
+    print "CircuitBreaker OKAY"
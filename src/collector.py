@@ -0,0 +1,271 @@
+''' Ships records from many processes through one local collector.
+
+Under a pre-forking server every worker would otherwise build its own
+AWS handler, with its own connections, lookups and small sends. With
+a collector, each worker gets a CollectorHandler, which writes every
+record as one datagram to a Unix domain socket, and a single collector
+process per host owns the real (typically batching) handler:
+
+    # In the collector process
+    Collector("/run/loghandlers.sock", SQSHandler("myqueue", batch=True)).serve_forever()
+
+    # In each worker
+    logger.addHandler(CollectorHandler("/run/loghandlers.sock"))
+
+Datagrams keep records whole without any framing, and a send is one
+system call. If the collector is down or falls behind, records go to
+the client's fallback_handler, if any, and are otherwise dropped; a
+worker never blocks for more than block_timeout on the collector.
+'''
+import errno
+import json
+import logging
+import logging.handlers
+import os
+import select
+import socket
+import stat
+import threading
+import time
+
+from compact import CompactRecord
+from metrics import HandlerMetrics
+
+# Largest record sent to the collector. Larger ones go to the fallback.
+MAX_DATAGRAM = 256*1024
+
+
+def encode_record(record):
+    ''' The datagram for a record: its CompactRecord fields, so the
+    message has its args interpolated and any exception is rendered. '''
+    return json.dumps(CompactRecord(record).fields(), separators=(',', ':'))
+
+
+def decode_record(data):
+    ''' The LogRecord for a datagram. Raises ValueError for one which
+    is not a record's fields. '''
+    fields = json.loads(data)
+    if not isinstance(fields, dict):
+        raise ValueError("Not a record: " + data[:100])
+    try:
+        return CompactRecord.from_fields(fields).expand()
+    except (TypeError, AttributeError, KeyError), e:
+        raise ValueError("Not a record: %s: %s" % (e, data[:100]))
+
+
+class CollectorHandler(logging.Handler):
+    ''' A Python logging handler which sends records to a Collector
+    listening on a local Unix domain socket. Safe to create before a
+    fork: each process opens its own socket on first use. '''
+    def __init__(self, path, fallback_handler=None, block_timeout=0.1, retry_interval=1.0):
+        ''' Parameters:
+        * path is the collector's socket
+        * fallback_handler receives records which could not be sent
+        * block_timeout is how long, in seconds, emit waits for room
+          when the collector has fallen behind
+        * retry_interval is how long, in seconds, to wait before trying
+          to reach a collector which was not listening
+        '''
+        logging.Handler.__init__(self)
+        self.path = path
+        self.fallback_handler = fallback_handler
+        self.block_timeout = block_timeout
+        self.retry_interval = retry_interval
+        self.sock = None
+        self.pid = None
+        self.next_connect = 0
+        self.connect_lock = threading.Lock()
+        self.metrics = HandlerMetrics("CollectorHandler:" + path)
+
+    def createLock(self):
+        # Datagram sends are atomic, so emit needs no lock
+        self.lock = None
+
+    def __socket(self):
+        ''' This process's socket, connecting if need be, or None. '''
+        if self.pid == os.getpid() and self.sock is not None:
+            return self.sock
+        with self.connect_lock:
+            if self.pid != os.getpid():
+                # Forked. The parent's socket is the parent's.
+                self.sock = None
+                self.pid = os.getpid()
+                self.next_connect = 0
+            if self.sock is None and time.time() >= self.next_connect:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sock.setblocking(0)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2 * MAX_DATAGRAM)
+                try:
+                    sock.connect(self.path)
+                except socket.error:
+                    sock.close()
+                    self.next_connect = time.time() + self.retry_interval
+                    return None
+                self.sock = sock
+            return self.sock
+
+    def __disconnect(self, sock):
+        with self.connect_lock:
+            if self.sock is sock:
+                self.sock = None
+                self.next_connect = time.time() + self.retry_interval
+        sock.close()
+
+    def __send(self, data):
+        sock = self.__socket()
+        if sock is None:
+            return False
+        try:
+            sock.send(data)
+            return True
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                if e.args[0] != errno.EMSGSIZE:
+                    # The collector went away
+                    self.__disconnect(sock)
+                return False
+        # The collector's queue is full. Wait a little for room.
+        if not self.block_timeout or not select.select([], [sock], [], self.block_timeout)[1]:
+            return False
+        try:
+            sock.send(data)
+            return True
+        except socket.error:
+            return False
+
+    def emit(self, record):
+        self.metrics.incr("emitted")
+        t = time.time()
+        data = encode_record(record)
+        if len(data) <= MAX_DATAGRAM and self.__send(data):
+            self.metrics.observe(time.time() - t, "succeeded")
+        elif self.fallback_handler is not None:
+            self.metrics.incr("fell_back")
+            self.fallback_handler.handle(record)
+        else:
+            self.metrics.incr("dropped")
+
+    def close(self):
+        with self.connect_lock:
+            if self.sock is not None and self.pid == os.getpid():
+                self.sock.close()
+            self.sock = None
+        logging.Handler.close(self)
+
+
+class Collector(object):
+    ''' Receives records from CollectorHandlers on a Unix domain socket
+    and passes them to handler. serve_forever() runs on the calling
+    thread; start() runs it on a background thread. '''
+    def __init__(self, path, handler, recv_buffer=4*1024*1024):
+        ''' Parameters:
+        * path is the socket to listen on. A stale socket left by a
+          previous collector is replaced.
+        * handler receives every record
+        * recv_buffer is the socket receive buffer, in bytes, which
+          absorbs bursts while handler is busy
+        '''
+        self.path = path
+        self.handler = handler
+        self.metrics = HandlerMetrics("Collector:" + path)
+        self.closing = False
+        self.thread = None
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer)
+        self.sock.bind(path)
+        self.sock.setblocking(0)
+
+    def serve_forever(self):
+        while not self.closing:
+            if not select.select([self.sock], [], [], 0.5)[0]:
+                continue
+            while True:
+                try:
+                    data = self.sock.recv(MAX_DATAGRAM + 1)
+                except socket.error, e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                self.metrics.incr("emitted")
+                try:
+                    record = decode_record(data)
+                except ValueError:
+                    self.metrics.incr("dropped")
+                    continue
+                t = time.time()
+                try:
+                    self.handler.handle(record)
+                except Exception:
+                    self.metrics.observe(time.time() - t, "raised")
+                else:
+                    self.metrics.observe(time.time() - t, "succeeded")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="Collector")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def close(self):
+        ''' Stops receiving, and closes the handler. '''
+        self.closing = True
+        if self.thread is not None:
+            self.thread.join()
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.handler.close()
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    from lambdahandler import LambdaHandler
+    path = os.path.join(tempfile.mkdtemp(), "collector.sock")
+    received = []
+    collector = Collector(path, LambdaHandler(received.append)).start()
+    handler = CollectorHandler(path)
+    logger = logging.getLogger('myapp')
+    logger.addHandler(handler)
+    logger.error("parent")
+    children = []
+    for i in range(4):
+        pid = os.fork()
+        if pid == 0:
+            for j in range(1000):
+                logger.error("child %d record %d" % (i, j))
+            os._exit(handler.metrics.snapshot()["counters"]["dropped"])
+        children.append(pid)
+    dropped = sum(os.waitpid(pid, 0)[1] >> 8 for pid in children)
+    time.sleep(0.2)
+    collector.close()
+    logger.removeHandler(handler)
+    if len(received) + dropped != 4001 or "parent" not in received or dropped > 100:
+        raise Exception("Collector failed: %d received, %d dropped" % (len(received), dropped))
+    print "Collector received %d records from 4 processes, %d dropped" % (len(received), dropped)
+
+    try:
+        0/0
+    except ZeroDivisionError:
+        record = logger.makeRecord("myapp", logging.ERROR, __file__, 1, "Request %d failed", (42,),
+                                   sys.exc_info())
+    fmt = logging.Formatter("%(name)s %(levelname)s %(message)s")
+    if fmt.format(decode_record(encode_record(record))) != fmt.format(record):
+        raise Exception("Args or exception lost: " + encode_record(record))
+
+    handler.emit(logging.makeLogRecord({"msg": "no collector"}))
+    if handler.metrics.snapshot()["counters"]["dropped"] != 1:
+        raise Exception("Missing collector should drop")
+
+    # Malformed datagrams are dropped, and the collector keeps going
+    received = []
+    collector = Collector(path, LambdaHandler(received.append)).start()
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    for data in ['[1,2]', '"x"', '{"msg":1}', 'not json', encode_record(logging.makeLogRecord({"msg": "after"}))]:
+        sender.sendto(data, path)
+    time.sleep(0.2)
+    collector.close()
+    if received != ["after"] or collector.metrics.snapshot()["counters"]["dropped"] != 4:
+        raise Exception("Malformed datagrams failed: %r %r" % (received, collector.metrics.snapshot()))
+    print "Collector OKAY"
@@ -0,0 +1,124 @@
+''' Compact snapshots of LogRecords, for holding in queues.
+
+A LogRecord keeps some twenty attributes in its own __dict__, and
+holds on to its args and exc_info, whose traceback keeps every frame
+on the stack alive. A backlog of millions of them, built up while a
+destination is down, runs to gigabytes. A CompactRecord keeps only
+what the handlers use, in __slots__:
+
+* name, levelno, levelname, created, process and threadName
+* msg, with any args interpolated into it, so the args are let go;
+  args which do not match it are appended as their repr
+* exc_text, the exception rendered when the snapshot is taken, so the
+  traceback is let go
+
+    snapshot = CompactRecord(record)      # when queueing
+    record = snapshot.expand()            # when sending
+
+expand() makes a LogRecord again, so any handler or formatter can take
+it, but the attributes not kept (pathname, lineno, funcName and so on)
+have their defaults. fields() and from_fields() turn a snapshot into a
+dictionary and back, for records sent or stored as JSON.
+'''
+import logging
+
+# Renders exception text the same way logging does by default
+_formatter = logging.Formatter()
+
+
+def _message(record):
+    # A record whose args don't match its msg would raise from inside
+    # emit; keep what there is instead.
+    try:
+        return record.getMessage()
+    except Exception:
+        return "%s %r" % (record.msg, record.args)
+
+
+class CompactRecord(object):
+    ''' A snapshot of a LogRecord. See the module docstring. '''
+    __slots__ = ('name', 'levelno', 'levelname', 'msg', 'created', 'process', 'threadName',
+                 'exc_text')
+
+    def __init__(self, record):
+        self.name = record.name
+        self.levelno = record.levelno
+        self.levelname = record.levelname
+        self.msg = _message(record) if record.args else record.msg
+        self.created = record.created
+        self.process = record.process
+        self.threadName = record.threadName
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = _formatter.formatException(record.exc_info)
+        self.exc_text = exc_text
+
+    def fields(self):
+        ''' The snapshot as a dictionary, with msg as a string. '''
+        fields = dict((name, getattr(self, name)) for name in self.__slots__)
+        if not isinstance(self.msg, basestring):
+            fields["msg"] = str(self.msg)
+        return fields
+
+    @classmethod
+    def from_fields(cls, fields):
+        ''' The snapshot for a dictionary made by fields(). Missing
+        fields are None. '''
+        snapshot = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(snapshot, name, fields.get(name))
+        return snapshot
+
+    def expand(self):
+        ''' A LogRecord with the snapshot's attributes. '''
+        record = logging.LogRecord(self.name, self.levelno, "", 0, self.msg, (), None)
+        record.levelname = self.levelname
+        record.created = self.created
+        record.msecs = (self.created - long(self.created)) * 1000
+        record.relativeCreated = (self.created - logging._startTime) * 1000
+        record.process = self.process
+        record.threadName = self.threadName
+        record.exc_text = self.exc_text
+        return record
+
+if __name__ == '__main__':
+    import gc
+    import resource
+    logger = logging.getLogger('myapp')
+    try:
+        0/0
+    except ZeroDivisionError:
+        record = logger.makeRecord("myapp", logging.ERROR, __file__, 1, "Request %d failed",
+                                   (42,), __import__('sys').exc_info())
+    expanded = CompactRecord(record).expand()
+    fmt = logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s")
+    if fmt.format(expanded) != fmt.format(record) or expanded.exc_info is not None:
+        raise Exception("Round trip failed: " + fmt.format(expanded))
+    import json
+    loaded = CompactRecord.from_fields(json.loads(json.dumps(CompactRecord(record).fields())))
+    if fmt.format(loaded.expand()) != fmt.format(record):
+        raise Exception("JSON round trip failed: " + fmt.format(loaded.expand()))
+
+    # Args which don't match the message are kept, not raised
+    bad = CompactRecord(logging.makeLogRecord({'msg': 'a %s %s', 'args': (1,)}))
+    if bad.msg != "a %s %s (1,)":
+        raise Exception("Mismatched args failed: " + bad.msg)
+
+    def rss():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    n = 200000
+    gc.collect()
+    before = rss()
+    compact = [CompactRecord(logger.makeRecord("myapp", logging.INFO, __file__, 1,
+                                               "Request %d done", (i,), None))
+               for i in range(n)]
+    compact_kb = rss() - before
+    before = rss()
+    full = [logger.makeRecord("myapp", logging.INFO, __file__, 1, "Request %d done", (i,), None)
+            for i in range(n)]
+    full_kb = rss() - before
+    print "%d records: LogRecords %d bytes each, CompactRecords %d bytes each" % (
+        n, full_kb * 1024 / n, compact_kb * 1024 / n)
+    if compact_kb * 3 > full_kb:
+        raise Exception("CompactRecord not compact")
+    print "Compact OKAY"
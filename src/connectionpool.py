@@ -0,0 +1,121 @@
+import contextlib
+import threading
+import time
+
+
+class ConnectionPool(object):
+    ''' A thread-safe pool of connections which are checked out for
+    one call at a time, for the AWS handlers. boto connections are not
+    safe to share between threads, but each keeps its HTTP connection
+    alive between calls, so reusing a warm connection avoids reconnect
+    overhead.
+
+    At most /size/ connections exist at once; a thread which finds
+    them all checked out waits for one. Idle connections are reused
+    most-recently-used first, and closed once they have been idle for
+    /idle_timeout/ seconds.
+
+        with pool.connection() as conn:
+            conn.publish(...)
+    '''
+    def __init__(self, factory, size=4, idle_timeout=60, first=None):
+        ''' Parameters:
+        * factory is called with no arguments to make a connection
+        * size is the most connections which may exist at once
+        * idle_timeout is how long, in seconds, an idle connection is
+          kept. None keeps them forever.
+        * first is an existing connection to start the pool with
+        '''
+        self.factory = factory
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.created = 0
+        self.condition = threading.Condition(threading.Lock())
+        if first is not None:
+            self.idle.append((first, time.time()))
+            self.created = 1
+
+    def __evict(self):
+        # Must be called with the lock held. Returns evicted connections.
+        if self.idle_timeout is None or not self.idle:
+            return []
+        cutoff = time.time() - self.idle_timeout
+        evicted = []
+        while self.idle and self.idle[0][1] < cutoff:
+            evicted.append(self.idle.pop(0)[0])
+            self.created -= 1
+        return evicted
+
+    def get(self):
+        ''' Checks out a connection, creating one if the pool is not
+        full, or waiting for one to be returned if it is. '''
+        with self.condition:
+            evicted = self.__evict()
+            while not self.idle and self.created >= self.size:
+                self.condition.wait()
+            if self.idle:
+                conn = self.idle.pop()[0]
+            else:
+                conn = None
+                self.created += 1
+        for old in evicted:
+            close = getattr(old, 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except Exception:
+                    pass
+        if conn is None:
+            try:
+                conn = self.factory()
+            except:
+                with self.condition:
+                    self.created -= 1
+                    self.condition.notify()
+                raise
+        return conn
+
+    def put(self, conn):
+        ''' Returns a checked out connection to the pool. '''
+        with self.condition:
+            self.idle.append((conn, time.time()))
+            self.condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.get()
+        try:
+            yield conn
+        finally:
+            self.put(conn)
+
+if __name__ == '__main__':
+    made = []
+    closed = []
+    class Connection(object):
+        def close(self):
+            closed.append(self)
+    def factory():
+        made.append(Connection())
+        return made[-1]
+
+    pool = ConnectionPool(factory, size=2, idle_timeout=0.1)
+    a = pool.get()
+    b = pool.get()
+    waiter = threading.Thread(target=lambda: pool.put(pool.get()))
+    waiter.start()
+    time.sleep(0.05)
+    if not waiter.is_alive():
+        raise Exception("Pool handed out more than size connections")
+    pool.put(a)
+    waiter.join()
+    pool.put(b)
+    if pool.get() is not b or len(made) != 2:
+        raise Exception("Pool did not reuse connections")
+    pool.put(b)
+    time.sleep(0.15)
+    with pool.connection() as conn:
+        if conn in (a, b) or len(made) != 3 or closed != [a, b]:
+            raise Exception("Idle connections were not evicted and closed")
+    print "ConnectionPool OKAY"
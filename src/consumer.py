@@ -0,0 +1,407 @@
+''' Drains log messages from an SQS queue into a sink.
+
+The other end of SQSHandler and EventSQSHandler. An SQSConsumer runs
+several receiver threads, each with its own connection, which long
+poll for up to ten messages at a time, decode them (unpacking
+envelopes into their records), and write the records to a sink:
+
+    consumer = SQSConsumer("myqueue", FileSink("/var/log/myapp.log"), receivers=8)
+    consumer.serve_forever()
+
+A sink is any object with write(messages), taking a list of strings,
+and flush(); close() is called if it has one. Writes may come from
+several receivers at once. FileSink appends records to a file, one
+per line, through a large buffer.
+
+Messages are deleted, ten to a call, only once the sink has been
+flushed after writing them, so a consumer which dies loses nothing;
+at worst some records are written twice. The queue's visibility
+timeout must be comfortably longer than flush_interval.
+
+Messages carrying a deduplication id (see the retry module) whose id
+has been seen among the last dedup_window are not written again, so
+a retried send which had in fact succeeded is written once.
+
+requires boto
+'''
+import base64
+import binascii
+import collections
+import io
+import threading
+import time
+
+from boto.sqs.connection import SQSConnection
+from boto.sqs.message import RawMessage
+from boto.sqs.queue import Queue
+
+import destinations
+import envelope
+from metrics import HandlerMetrics
+import retry
+
+
+class FileSink(object):
+    ''' Appends messages to a file, one per line. '''
+    def __init__(self, path, buffer_size=1024*1024):
+        ''' Parameters:
+        * path is the file, which is created if need be
+        * buffer_size is how much is buffered, in bytes, between writes
+          to the file
+        '''
+        self.file = io.open(path, "ab", buffering=buffer_size)
+        self.lock = threading.Lock()
+
+    def write(self, messages):
+        data = "".join((m.encode('utf-8') if isinstance(m, unicode) else m) + "\n"
+                       for m in messages)
+        with self.lock:
+            self.file.write(data)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class SQSConsumer(object):
+    ''' Receives messages from an SQS queue and writes their records to
+    a sink. See the module docstring. serve_forever() runs until
+    close(); drain() returns once the queue is empty. '''
+    # SQS limits on a single ReceiveMessage or DeleteMessageBatch call,
+    # and on a long poll
+    MAX_BATCH_COUNT = 10
+    MAX_WAIT_TIME = 20
+
+    def __init__(self, queue, sink, receivers=4, wait_time=MAX_WAIT_TIME, visibility_timeout=None,
+                 flush_interval=1.0, encoded=True, aws_key=None, secret_key=None,
+                 connection_factory=None, dedup_window=100000):
+        ''' Parameters:
+        * queue is the name or URL of an existing SQS queue
+        * sink receives the records; see the module docstring
+        * receivers is the number of receiver threads
+        * wait_time is how long, in seconds, a receive waits for
+          messages to arrive (at most 20)
+        * visibility_timeout overrides the queue's, for received messages
+        * flush_interval is how often, in seconds, each receiver flushes
+          the sink and deletes what it has written. It also flushes
+          after every hundred messages.
+        * encoded says that bodies which are not envelopes are base64
+          encoded, as SQSHandler and EventSQSHandler send them
+        * Optional: aws_key and secret_key. If these don't exist, it will
+          look at the appropriate environment variables.
+        * Optional: connection_factory makes each receiver's connection,
+          instead of an SQSConnection with the given keys
+        * Optional: dedup_window is the number of deduplication ids
+          remembered
+        '''
+        if connection_factory is None:
+            if aws_key and secret_key:
+                connection_factory = lambda: SQSConnection(aws_key, secret_key)
+            else:
+                connection_factory = SQSConnection
+        self.connection_factory = connection_factory
+        self.queue_name = queue
+        self.url = None
+        if queue.startswith("http://") or queue.startswith("https://"):
+            self.url = queue
+        self.sink = sink
+        self.receivers = receivers
+        self.wait_time = min(wait_time, self.MAX_WAIT_TIME)
+        self.visibility_timeout = visibility_timeout
+        self.flush_interval = flush_interval
+        self.encoded = encoded
+        self.dedup_window = dedup_window
+        self.seen = set()
+        self.seen_order = collections.deque()
+        self.seen_lock = threading.Lock()
+        self.duplicates = 0
+        self.metrics = HandlerMetrics("SQSConsumer:" + queue)
+        self.closing = False
+        self.until_empty = False
+        self.threads = []
+
+    def __queue(self):
+        conn = self.connection_factory()
+        if self.url is None:
+            def lookup():
+                q = conn.get_queue(self.queue_name)
+                if q is None:
+                    raise RuntimeError("Queue not found: " + self.queue_name)
+                return q.url
+            self.url = destinations.resolve("sqs", conn, self.queue_name, lookup)
+        return Queue(conn, self.url, message_class=RawMessage)
+
+    def decode(self, body):
+        ''' The records in a message body. '''
+        if envelope.is_envelope(body):
+            return envelope.decode(body)
+        if self.encoded:
+            return [base64.b64decode(body)]
+        return [body]
+
+    def __dedup_id(self, m):
+        # The message's deduplication id, or None
+        if not self.dedup_window:
+            return None
+        attribute = (getattr(m, 'message_attributes', None) or {}).get(retry.DEDUP_ATTRIBUTE)
+        return attribute.get('string_value') if attribute else None
+
+    def __seen(self, dedup):
+        with self.seen_lock:
+            return dedup in self.seen
+
+    def __remember(self, ids):
+        # Called once the messages with these ids are flushed
+        with self.seen_lock:
+            for dedup in ids:
+                if dedup not in self.seen:
+                    self.seen.add(dedup)
+                    self.seen_order.append(dedup)
+            while len(self.seen_order) > self.dedup_window:
+                self.seen.discard(self.seen_order.popleft())
+
+    def __receive(self):
+        q = self.__queue()
+        written = []
+        # The dedup ids of the messages written, until they are flushed
+        ids = set()
+        last_flush = time.time()
+        while not self.closing:
+            try:
+                messages = q.get_messages(num_messages=self.MAX_BATCH_COUNT,
+                                          visibility_timeout=self.visibility_timeout,
+                                          wait_time_seconds=self.wait_time,
+                                          message_attributes=[retry.DEDUP_ATTRIBUTE])
+            except Exception:
+                self.metrics.incr("raised")
+                time.sleep(1)
+                continue
+            records = []
+            received_ids = set()
+            for m in messages:
+                dedup = self.__dedup_id(m)
+                if dedup is not None:
+                    if dedup in received_ids or dedup in ids or self.__seen(dedup):
+                        # Deleted with the rest, unwritten
+                        with self.seen_lock:
+                            self.duplicates += 1
+                        continue
+                    received_ids.add(dedup)
+                try:
+                    records.extend(self.decode(m.get_body()))
+                except (ValueError, TypeError, binascii.Error):
+                    # Never decodable; written off below with the rest
+                    self.metrics.incr("dropped")
+            self.metrics.incr("emitted", len(records))
+            if records:
+                t = time.time()
+                try:
+                    self.sink.write(records)
+                except Exception:
+                    # Left on the queue, to come back once the
+                    # visibility timeout expires
+                    self.metrics.observe(time.time() - t, "raised", len(records))
+                    continue
+                self.metrics.observe(time.time() - t, "succeeded", len(records))
+            ids.update(received_ids)
+            written.extend(messages)
+            if len(written) >= 10 * self.MAX_BATCH_COUNT or time.time() - last_flush >= self.flush_interval:
+                if self.__delete(q, written, ids):
+                    written = []
+                    ids = set()
+                last_flush = time.time()
+            if not messages and self.until_empty:
+                break
+        self.__delete(q, written, ids)
+
+    def __delete(self, q, messages, ids):
+        ''' Flushes the sink, then deletes messages written to it and
+        remembers their dedup ids. Returns False, leaving both alone, if
+        the flush fails. '''
+        if not messages:
+            return True
+        try:
+            self.sink.flush()
+        except Exception:
+            self.metrics.incr("raised", len(messages))
+            return False
+        for i in range(0, len(messages), self.MAX_BATCH_COUNT):
+            try:
+                q.delete_message_batch(messages[i:i+self.MAX_BATCH_COUNT])
+            except Exception:
+                # They will be received again, and skipped as
+                # duplicates if they carry a dedup id
+                self.metrics.incr("raised")
+        # Only now, or a message whose flush failed would be taken
+        # for a duplicate when it came back, and never written
+        self.__remember(ids)
+        return True
+
+    def start(self):
+        ''' Starts the receivers on background threads. '''
+        for i in range(self.receivers):
+            t = threading.Thread(target=self.__receive, name="SQSConsumer-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def serve_forever(self):
+        self.start()
+        while any(t.is_alive() for t in self.threads):
+            # A timed join, so that KeyboardInterrupt gets through
+            for t in self.threads:
+                t.join(1)
+
+    def drain(self):
+        ''' Receives until a receive comes back empty on every receiver,
+        then flushes the sink. Returns the number of records written. '''
+        self.until_empty = True
+        before = self.metrics.snapshot()["counters"]["succeeded"]
+        self.serve_forever()
+        self.threads = []
+        self.until_empty = False
+        self.sink.flush()
+        return self.metrics.snapshot()["counters"]["succeeded"] - before
+
+    def close(self):
+        ''' Stops the receivers, waiting for a long poll in progress to
+        return, and closes the sink. '''
+        self.closing = True
+        for t in self.threads:
+            t.join()
+        self.sink.flush()
+        close = getattr(self.sink, 'close', None)
+        if close is not None:
+            close()
+
+if __name__ == '__main__':
+    import logging
+    import socket
+    import sys
+    from sqshandler import SQSHandler
+    from snshandler import SNSHandler
+
+    class Loopback(object):
+        ''' An in-memory SQS connection: what is sent is received. The
+        next /lose_replies/ sends are stored, then raise, as when a
+        reply is lost. '''
+        def __init__(self):
+            self.stored = []
+            self.requests = []
+            self.lose_replies = 0
+
+        def __store(self, body, attributes):
+            self.stored.append((body, attributes))
+            if self.lose_replies:
+                self.lose_replies -= 1
+                raise socket.error("Connection reset")
+
+        def send_message(self, queue, message_content, delay_seconds=None, message_attributes=None):
+            self.__store(message_content, message_attributes or {})
+            return RawMessage(queue, message_content)
+
+        def get_object(self, action, params, cls, path='/', parent=None, verb='GET'):
+            self.requests.append((action, params))
+            return cls()
+
+        def receive_message(self, queue, number_messages=1, visibility_timeout=None,
+                            attributes=None, wait_time_seconds=None, message_attributes=None):
+            received = []
+            for body, attributes in self.stored[:number_messages]:
+                m = queue.message_class(queue, body)
+                m.message_attributes = dict((k, v) for k, v in attributes.items()
+                                            if k in (message_attributes or ()))
+                received.append(m)
+            del self.stored[:number_messages]
+            return received
+
+        def delete_message_batch(self, queue, messages):
+            pass
+
+    class ListSink(list):
+        def write(self, messages):
+            self.extend(messages)
+
+        def flush(self):
+            pass
+
+    # A send whose reply is lost is retried, and the copy is not written
+    conn = Loopback()
+    handler = SQSHandler("http://localhost/000000000000/test", connection=conn,
+                         retrier=retry.Retrier(base=0.001))
+    conn.lose_replies = 1
+    handler.handle(logging.makeLogRecord({"msg": "TEST 1", "name": "myapp"}))
+    handler.handle(logging.makeLogRecord({"msg": "TEST 2", "name": "myapp"}))
+    handler.close()
+    sink = ListSink()
+    consumer = SQSConsumer("http://localhost/000000000000/test", sink, receivers=1, wait_time=0,
+                           connection_factory=lambda: conn)
+    consumer.drain()
+    if sorted(sink) != ["TEST 1", "TEST 2"] or consumer.duplicates != 1:
+        raise Exception("Duplicate not skipped: %s, %d duplicates" % (sink, consumer.duplicates))
+    print "Retried send written once; %d duplicate skipped" % consumer.duplicates
+
+    # A message whose flush failed is written when it comes back
+    class FailingSink(ListSink):
+        def flush(self):
+            raise IOError("Disk full")
+    handler = SQSHandler("http://localhost/000000000000/test", connection=conn, retrier=retry.Retrier())
+    handler.handle(logging.makeLogRecord({"msg": "TEST 5", "name": "myapp"}))
+    handler.close()
+    stored = list(conn.stored)
+    consumer = SQSConsumer("http://localhost/000000000000/test", FailingSink(), receivers=1,
+                           wait_time=0, connection_factory=lambda: conn)
+    try:
+        consumer.drain()
+    except IOError:
+        pass
+    # The visibility timeout expires
+    conn.stored = stored
+    sink = ListSink()
+    consumer.sink = sink
+    consumer.drain()
+    if sink != ["TEST 5"]:
+        raise Exception("Unflushed message lost: %s, %d duplicates" % (sink, consumer.duplicates))
+
+    # FIFO queues and topics get the dedup id as MessageDeduplicationId
+    handler = SQSHandler("http://localhost/000000000000/test.fifo", connection=conn, batch=True)
+    handler.handle(logging.makeLogRecord({"msg": "TEST 3", "name": "myapp"}))
+    handler.close()
+    action, params = conn.requests[-1]
+    entry = "SendMessageBatchRequestEntry.1."
+    if action != "SendMessageBatch" or params[entry + "MessageGroupId"] != "myapp" or \
+            params[entry + "MessageDeduplicationId"] != params[entry + "MessageAttribute.1.Value.StringValue"]:
+        raise Exception("FIFO ids not sent to SQS: %s" % params)
+
+    class SNSLoopback(object):
+        def __init__(self):
+            self.requests = []
+
+        def _make_request(self, action, params, path='/', verb='GET'):
+            self.requests.append((action, params))
+            return {action + "Response": {action + "Result": {"Failed": []}}}
+    sns = SNSLoopback()
+    for topic, retrier in (("test", retry.Retrier()), ("test.fifo", None)):
+        handler = SNSHandler("arn:aws:sns:us-east-1:000000000000:" + topic, connection=sns,
+                             batch=True, publish_batch=True, retrier=retrier)
+        handler.handle(logging.makeLogRecord({"msg": "TEST 4", "name": "myapp"}))
+        handler.close()
+        action, params = sns.requests[-1]
+        entry = "PublishBatchRequestEntries.member.1."
+        dedup = params.get(entry + "MessageAttributes.entry.1.Value.StringValue")
+        if action != "PublishBatch" or not dedup or \
+                params.get(entry + "MessageDeduplicationId") != (dedup if retrier is None else None):
+            raise Exception("Dedup ids not sent to SNS %s: %s" % (topic, params))
+    print "FIFO deduplication ids sent to SQS and SNS"
+    print "Consumer OKAY"
+
+    if len(sys.argv) > 1:
+        # Drains the debug queue the handlers' own self-tests fill
+        consumer = SQSConsumer("sqs_handler_debug", FileSink(sys.argv[1]), wait_time=1)
+        print "Drained %d records to %s" % (consumer.drain(), sys.argv[1])
+        consumer.close()
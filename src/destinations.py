@@ -0,0 +1,69 @@
+''' A small process-wide cache of resolved AWS destinations (topic ARNs
+and queue URLs), so that each name is looked up once per process,
+rather than once per handler. Entries made before a fork are inherited
+by the children, so a pre-forking server which resolves in the master
+saves its workers the round trip.
+
+Entries are kept per endpoint and access key, so handlers for
+different accounts in one process never share a destination. '''
+import threading
+
+_cache = {}
+_locks = {}
+_lock = threading.Lock()
+
+
+def resolve(kind, conn, name, lookup):
+    ''' Returns the cached destination for name on conn's endpoint and
+    account, calling lookup() to find it the first time. Lookups of
+    different destinations run in parallel; failed lookups are not
+    cached. '''
+    key = (kind, getattr(conn, 'host', None), getattr(conn, 'aws_access_key_id', None), name)
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+    with _lock:
+        lock = _locks.setdefault(key, threading.Lock())
+    # Held only by lookups of this destination, so a hung one
+    # blocks nobody else.
+    with lock:
+        if key not in _cache:
+            _cache[key] = lookup()
+        return _cache[key]
+
+
+def clear():
+    ''' Forgets every resolved destination. '''
+    with _lock:
+        _cache.clear()
+        _locks.clear()
+
+if __name__ == '__main__':
+    import time
+
+    class Connection(object):
+        def __init__(self, key):
+            self.host = "sqs.us-east-1.amazonaws.com"
+            self.aws_access_key_id = key
+
+    one, other = Connection("AKIAONE"), Connection("AKIAOTHER")
+    if resolve("sqs", one, "logs", lambda: "one/logs") != "one/logs" or \
+            resolve("sqs", other, "logs", lambda: "other/logs") != "other/logs" or \
+            resolve("sqs", one, "logs", lambda: "wrong") != "one/logs":
+        raise Exception("Accounts share destinations")
+
+    # A hung lookup holds up only its own destination
+    started = threading.Event()
+    hung = threading.Thread(target=resolve, args=("sqs", one, "hung",
+                                                  lambda: started.set() or time.sleep(1) or "hung"))
+    hung.start()
+    started.wait()
+    t = time.time()
+    resolve("sqs", one, "other", lambda: "other")
+    if time.time() - t > 0.5:
+        raise Exception("Hung lookup blocked another destination")
+    hung.join()
+    if resolve("sqs", one, "hung", lambda: "wrong") != "hung":
+        raise Exception("Hung lookup not cached")
+    print "Destinations OKAY"
@@ -0,0 +1,95 @@
+''' Compressed multi-record envelopes for SQS and SNS message bodies.
+
+Log lines are small and repetitive, so packing many into one message
+and compressing it cuts both API calls and bytes on the wire. An
+envelope is plain ASCII, safe to use as an SQS or SNS message body:
+
+    LHE1:<codec>:<base64 of the compressed JSON list of messages>
+
+zlib is always available. lz4 and snappy are used if the lz4 or
+python-snappy packages are installed; they are faster, but whoever
+decodes the envelopes needs the same package.
+
+    bodies = pack(messages, max_bytes=256*1024)   # [(body, count), ...]
+    messages = decode(body)
+'''
+import base64
+import json
+import zlib
+
+PREFIX = "LHE1:"
+
+CODECS = {"zlib": (lambda data: zlib.compress(data, 6), zlib.decompress)}
+
+try:
+    import lz4.frame
+    CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+try:
+    import snappy
+    CODECS["snappy"] = (snappy.compress, snappy.decompress)
+except ImportError:
+    pass
+
+
+def fastest_codec():
+    ''' The fastest codec installed. '''
+    for codec in ("lz4", "snappy", "zlib"):
+        if codec in CODECS:
+            return codec
+
+
+def encode(messages, codec="zlib"):
+    ''' Packs a list of messages into one envelope. '''
+    if codec not in CODECS:
+        raise ValueError("Codec not available: " + str(codec))
+    compress = CODECS[codec][0]
+    data = json.dumps(messages, separators=(',', ':'))
+    return PREFIX + codec + ":" + base64.b64encode(compress(data))
+
+
+def is_envelope(body):
+    return body.startswith(PREFIX)
+
+
+def decode(body):
+    ''' Returns the list of messages in an envelope. A body which is
+    not an envelope is returned as a single message. '''
+    if not is_envelope(body):
+        return [body]
+    codec, data = body[len(PREFIX):].split(":", 1)
+    if codec not in CODECS:
+        raise ValueError("Codec not available: " + str(codec))
+    return json.loads(CODECS[codec][1](base64.b64decode(data)))
+
+
+def pack(messages, max_bytes=256*1024, codec="zlib"):
+    ''' Packs a list of messages into as few envelopes as fit within
+    max_bytes each. Returns a list of (body, count) tuples, where count
+    is the number of consecutive messages in that body. A single
+    message which does not fit on its own gets an envelope anyway. '''
+    if not messages:
+        return []
+    body = encode(messages, codec)
+    if len(body) <= max_bytes or len(messages) == 1:
+        return [(body, len(messages))]
+    # Compression ratios are fairly even within a batch, so guess a
+    # split from the overshoot rather than halving repeatedly.
+    split = max(1, min(len(messages) // 2, len(messages) * max_bytes // len(body)))
+    return pack(messages[:split], max_bytes, codec) + pack(messages[split:], max_bytes, codec)
+
+if __name__ == '__main__':
+    import random
+    messages = [u"ERROR handling request %d: timeout talking to backend" % random.randint(0, 10**6)
+                for i in range(5000)]
+    bodies = pack(messages, max_bytes=16*1024)
+    raw = sum(len(m) for m in messages)
+    packed = sum(len(body) for body, count in bodies)
+    if sum([decode(body) for body, count in bodies], []) != messages:
+        raise Exception("Envelope round trip failed")
+    if [decode("plain")] != [["plain"]]:
+        raise Exception("Plain bodies should decode as one message")
+    print "%d messages, %d bytes in %d envelopes of %d bytes" % (len(messages), raw, len(bodies), packed)
+    print "Envelope OKAY"
@@ -0,0 +1,177 @@
+import base64
+import logging
+import logging.handlers
+import urlparse
+import uuid
+
+from eventsender import EventSender
+from metrics import HandlerMetrics
+from structured import message
+
+
+class _EventHandler(logging.Handler):
+    ''' Common code for the event-loop AWS handlers. emit only encodes
+    the record and queues it on an EventSender, which keeps many
+    requests in flight from one thread. '''
+    SERVICE = None
+
+    def __init__(self, name, endpoint, sender, aws_key, secret_key, region, concurrency,
+                 queue_size, block_timeout, timeout, max_retries, group_by):
+        logging.Handler.__init__(self)
+        if isinstance(group_by, basestring):
+            attribute = group_by
+            group_by = lambda record: getattr(record, attribute, None)
+        self.group_by = group_by
+        self.owns_sender = sender is None
+        if sender is None:
+            sender = EventSender(endpoint, concurrency, queue_size, timeout, max_retries,
+                                 aws_key, secret_key, region, name=type(self).__name__)
+        self.sender = sender
+        self.block_timeout = block_timeout
+        self.metrics = HandlerMetrics(type(self).__name__ + ":" + name)
+
+    def createLock(self):
+        # emit only queues, and the queue is thread-safe
+        self.lock = None
+
+    def __done(self, outcome, seconds, retrying):
+        # Called from the event loop after each attempt
+        self.metrics.observe(seconds, outcome)
+        if outcome != "succeeded" and not retrying:
+            self.metrics.incr("dropped")
+
+    def fifo(self, record, params):
+        ''' Adds a message group id and a deduplication id to params, if
+        the handler has group_by. The deduplication id is made once per
+        record, so the sender's retries of it are deduplicated. '''
+        if self.group_by is not None:
+            group = self.group_by(record)
+            if isinstance(group, unicode):
+                group = group.encode('utf-8')
+            params["MessageGroupId"] = str(group)
+            params["MessageDeduplicationId"] = uuid.uuid4().hex
+        return params
+
+    def submit(self, path, params):
+        self.metrics.incr("emitted")
+        if self.sender.submit(path, params, self.SERVICE, self.__done, self.block_timeout,
+                              params.get("MessageGroupId")):
+            self.metrics.incr("queued")
+        else:
+            self.metrics.incr("dropped")
+
+    def pending(self):
+        ''' The number of requests queued or in flight on the sender,
+        which may be shared. '''
+        return self.sender.pending()
+
+    def flush(self, timeout=None):
+        ''' Waits until everything queued so far has been sent. '''
+        return self.sender.flush(timeout)
+
+    def close(self):
+        if self.owns_sender:
+            self.sender.close()
+        else:
+            self.sender.flush()
+        logging.Handler.close(self)
+
+
+class EventSQSHandler(_EventHandler):
+    ''' A Python logging handler which sends messages to Amazon SQS from
+    an event loop, rather than with a blocking boto call per record.
+    Bodies are base64 encoded, as SQSHandler's are, so consumers see
+    the same messages from either.
+
+    Unlike SQSHandler, it needs the queue URL; it makes no calls to
+    look one up. Does not require boto. '''
+    SERVICE = "sqs"
+
+    def __init__(self, queue_url, endpoint=None, sender=None, aws_key=None, secret_key=None,
+                 region=None, concurrency=64, queue_size=10000, block_timeout=None,
+                 timeout=10, max_retries=3, group_by=None):
+        ''' Parameters:
+        * queue_url is the URL of an existing SQS queue
+        * Optional: endpoint sends to another URL, e.g. a local stand-in
+          server, instead of the queue URL's host.
+        * Optional: sender is an EventSender to share with other
+          handlers sending to the same endpoint. The remaining
+          parameters are then ignored.
+        * Optional: aws_key and secret_key. If these don't exist, it will look
+          at the appropriate environment variables.
+        * Optional: region is used to sign requests. By default it is
+          taken from the host name.
+        * Optional: concurrency is the most requests in flight at once
+        * Optional: queue_size is the number of records which may wait
+          to be sent. When it is full, emit waits for up to
+          block_timeout seconds (forever if None), then drops the record.
+        * Optional: timeout and max_retries bound each request
+        * Optional: group_by is a record attribute name, or a function
+          of the record, giving the message group id, for FIFO queues.
+          Each message then also gets a unique deduplication id. A
+          group has one record in flight at a time, so its records
+          arrive in order, retries and all; other groups are sent
+          alongside it.
+        '''
+        url = urlparse.urlparse(queue_url)
+        if endpoint is None:
+            endpoint = "%s://%s" % (url.scheme, url.netloc)
+        self.path = url.path
+        _EventHandler.__init__(self, url.path.split("/")[-1], endpoint, sender, aws_key,
+                               secret_key, region, concurrency, queue_size, block_timeout,
+                               timeout, max_retries, group_by)
+
+    def emit(self, record):
+        msg = message(self, record)
+        if isinstance(msg, unicode):
+            msg = msg.encode('utf-8')
+        elif not isinstance(msg, str):
+            msg = str(msg)
+        self.submit(self.path, self.fifo(record, {"Action": "SendMessage",
+                                                  "MessageBody": base64.b64encode(msg),
+                                                  "Version": "2012-11-05"}))
+
+
+class EventSNSHandler(_EventHandler):
+    ''' A Python logging handler which publishes to Amazon SNS from an
+    event loop, rather than with a blocking boto call per record.
+
+    Unlike SNSHandler, it needs the topic ARN; it makes no calls to
+    look one up. Does not require boto. '''
+    SERVICE = "sns"
+
+    def __init__(self, topic_arn, endpoint=None, sender=None, aws_key=None, secret_key=None,
+                 region=None, concurrency=64, queue_size=10000, block_timeout=None,
+                 timeout=10, max_retries=3, group_by=None):
+        ''' Parameters:
+        * topic_arn is the ARN of an existing SNS topic
+        * Optional: endpoint sends to another URL, e.g. a local stand-in
+          server, instead of the topic's regional endpoint.
+        * The other parameters are as for EventSQSHandler.
+        '''
+        parts = topic_arn.split(":")
+        if region is None:
+            region = parts[3]
+        if endpoint is None:
+            endpoint = "https://sns.%s.amazonaws.com" % region
+        self.topic_arn = topic_arn
+        _EventHandler.__init__(self, parts[5], endpoint, sender, aws_key, secret_key, region,
+                               concurrency, queue_size, block_timeout, timeout, max_retries,
+                               group_by)
+
+    def emit(self, record):
+        msg = message(self, record)
+        if isinstance(msg, unicode):
+            msg = msg.encode('utf-8')
+        elif not isinstance(msg, str):
+            msg = str(msg)
+        self.submit("/", self.fifo(record, {"Action": "Publish",
+                                            "TopicArn": self.topic_arn,
+                                            "Message": msg,
+                                            "Version": "2010-03-31"}))
+
+if __name__ == '__main__':
+    logger = logging.getLogger('myapp')
+    logger.addHandler(EventSQSHandler("https://sqs.us-east-1.amazonaws.com/000000000000/sqs_handler_debug"))
+    logger.error("AAAA")
+    logger.info("BBBB")
@@ -0,0 +1,692 @@
+''' An event-loop HTTP sender for the AWS query APIs (SQS, SNS).
+
+A single background thread drives up to /concurrency/ keep-alive
+connections to one endpoint with select(), so many requests are in
+flight at once without a thread apiece. Callers only encode a request
+and put it on a bounded queue; when the queue is full, submit() blocks
+for up to block_timeout seconds, then gives up. This is the
+backpressure: a caller can never get more than queue_size requests
+ahead of the network.
+
+    sender = EventSender("https://sqs.us-east-1.amazonaws.com", concurrency=64)
+    sender.submit("/123456789012/myqueue", {"Action": "SendMessage", ...}, "sqs")
+
+Requests are signed with AWS Signature Version 4 if credentials are
+given, or found in the AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY
+environment variables. Otherwise they are sent unsigned, which is what
+a local stand-in server wants. Failed requests (connection errors,
+timeouts, throttling and 5xx responses) are retried up to max_retries
+times, after a jittered backoff and within a retry budget (see the
+retry module); other 4xx responses will never succeed, and are not.
+
+The endpoint's host name is resolved on a thread of its own, never on
+the event loop, and the address is kept for ADDRESS_TTL seconds. Once
+known, an address is used until a fresh one arrives.
+
+Requests may be given a group (an SQS or SNS FIFO message group id).
+Only one request of a group and path is in flight, or waiting to be
+retried, at a time; later ones are held back, then sent one at a time,
+in order, as each is done. A group's requests are therefore sent in
+the order they were submitted, retries and all, at any concurrency,
+while other groups' requests go out alongside them.
+'''
+import collections
+import errno
+import hashlib
+import heapq
+import hmac
+import os
+import Queue
+import select
+import socket
+import ssl
+import threading
+import time
+import urllib
+import urlparse
+
+import retry
+
+
+def sign_v4(headers, method, host, path, body, region, service, key, secret,
+            token=None, now=None, cache=None):
+    ''' Adds the AWS Signature Version 4 headers to headers. cache, if
+    given, is a dictionary used to keep derived signing keys. '''
+    amzdate = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(now))
+    datestamp = amzdate[:8]
+    headers['Host'] = host
+    headers['X-Amz-Date'] = amzdate
+    if token:
+        headers['X-Amz-Security-Token'] = token
+    names = sorted(headers, key=str.lower)
+    canonical_headers = ''.join('%s:%s\n' % (k.lower(), str(headers[k]).strip()) for k in names)
+    signed_headers = ';'.join(k.lower() for k in names)
+    canonical_request = '\n'.join([method, urllib.quote(path), '', canonical_headers,
+                                   signed_headers, hashlib.sha256(body).hexdigest()])
+    scope = '%s/%s/%s/aws4_request' % (datestamp, region, service)
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amzdate, scope,
+                                hashlib.sha256(canonical_request).hexdigest()])
+    signing_key = cache.get(scope) if cache is not None else None
+    if signing_key is None:
+        signing_key = 'AWS4' + secret
+        for part in (datestamp, region, service, 'aws4_request'):
+            signing_key = hmac.new(signing_key, part, hashlib.sha256).digest()
+        if cache is not None:
+            cache.clear()
+            cache[scope] = signing_key
+    signature = hmac.new(signing_key, string_to_sign, hashlib.sha256).hexdigest()
+    headers['Authorization'] = 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (
+        key, scope, signed_headers, signature)
+
+
+class _Request(object):
+    __slots__ = ('path', 'body', 'service', 'done', 'retries', 'started', 'group')
+
+    def __init__(self, path, body, service, done, group):
+        self.path = path
+        self.body = body
+        self.service = service
+        self.done = done
+        self.retries = 0
+        self.started = 0
+        # (path, group id) for requests which must stay in order, or None
+        self.group = group
+
+
+class _Connection(object):
+    ''' One keep-alive connection, and the request on it, if any. '''
+    __slots__ = ('sock', 'state', 'request', 'out', 'inbuf', 'deadline', 'reused')
+
+    def __init__(self, sock, state):
+        self.sock = sock
+        # "connecting", "handshake_read", "handshake_write", "sending",
+        # "reading" or "idle"
+        self.state = state
+        self.request = None
+        self.out = ""
+        self.inbuf = ""
+        self.deadline = None
+        self.reused = False
+
+
+class _Incomplete(Exception):
+    pass
+
+
+def _parse_response(data):
+    ''' Returns (status, body, keep_alive) for a complete response in
+    data, or raises _Incomplete. '''
+    end = data.find("\r\n\r\n")
+    if end < 0:
+        raise _Incomplete()
+    lines = data[:end].split("\r\n")
+    version, status = lines[0].split(" ", 2)[:2]
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    rest = data[end+4:]
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = []
+        while True:
+            line_end = rest.find("\r\n")
+            if line_end < 0:
+                raise _Incomplete()
+            size = int(rest[:line_end].split(";")[0], 16)
+            if len(rest) < line_end + 2 + size + 2:
+                raise _Incomplete()
+            body.append(rest[line_end+2:line_end+2+size])
+            rest = rest[line_end+2+size+2:]
+            if size == 0:
+                return int(status), "".join(body), keep_alive
+    if "content-length" in headers:
+        length = int(headers["content-length"])
+        if len(rest) < length:
+            raise _Incomplete()
+        return int(status), rest[:length], keep_alive
+    # Body runs to the end of the connection; the caller sees the close
+    raise _Incomplete()
+
+
+class EventSender(object):
+    ''' Sends AWS query API requests to one endpoint from a single
+    event-loop thread. See the module docstring. '''
+    # How long, in seconds, a resolved address is used before it is
+    # looked up again, and a failed lookup is before it is retried
+    ADDRESS_TTL = 60
+    FAILED_ADDRESS_TTL = 5
+
+    def __init__(self, endpoint, concurrency=64, queue_size=10000, timeout=10,
+                 max_retries=3, aws_key=None, secret_key=None, region=None, name="EventSender",
+                 budget=None):
+        ''' Parameters:
+        * endpoint is the base URL, e.g. "https://sns.us-east-1.amazonaws.com"
+          or "http://localhost:9324"
+        * concurrency is the most connections, and so requests, in flight
+        * queue_size is the number of requests which may wait to be sent
+        * timeout is the time, in seconds, a request may take
+        * max_retries is the number of times a failed request is retried
+        * aws_key and secret_key sign requests. If these don't exist, it
+          will look at the appropriate environment variables, and send
+          unsigned if they don't exist either.
+        * region is used in signing. By default it is taken from the
+          endpoint host name, or us-east-1.
+        * budget is the retry.RetryBudget retries are drawn from.
+          Defaults to retry.GLOBAL_BUDGET.
+        '''
+        url = urlparse.urlparse(endpoint)
+        if url.scheme not in ("http", "https"):
+            raise ValueError("Endpoint must be an http or https URL: " + str(endpoint))
+        self.endpoint = endpoint
+        self.tls = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port or (443 if self.tls else 80)
+        self.host_header = url.netloc
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.budget = budget if budget is not None else retry.GLOBAL_BUDGET
+        self.aws_key = aws_key or os.environ.get("AWS_ACCESS_KEY_ID")
+        self.secret_key = secret_key or os.environ.get("AWS_SECRET_ACCESS_KEY")
+        self.token = None
+        if not aws_key:
+            self.token = os.environ.get("AWS_SESSION_TOKEN")
+        if region is None:
+            parts = self.host.split(".")
+            region = parts[1] if len(parts) > 3 and parts[-2] == "amazonaws" else "us-east-1"
+        self.region = region
+        self.signing_keys = {}
+        # (address or None, expiry time), replaced whole by the resolver
+        self.address = (None, 0)
+        self.resolving = False
+        self.ssl_context = ssl.create_default_context() if self.tls else None
+        self.queue = Queue.Queue(queue_size)
+        self.retries = []       # heap of (due time, sequence, request)
+        self.sequence = 0
+        # For each group with a request in flight or waiting to be
+        # retried, a deque of its later requests, held back until that
+        # one is done
+        self.held = {}
+        self.connections = []
+        self.sleeping = False
+        self.stopping = False
+        self.wake_r, self.wake_w = os.pipe()
+        self.pipe_lock = threading.Lock()
+        self.pipe_open = True
+        self.thread = threading.Thread(target=self.__run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, path, params, service, done=None, block_timeout=None, group=None):
+        ''' Queues a POST of the form-encoded params to path. Returns
+        False if the queue stayed full for block_timeout seconds (None
+        waits forever). group, if given, is the request's message group
+        id; see the module docstring.
+
+        done, if given, is called from the event loop after each
+        attempt as done(outcome, seconds, retrying), where outcome is
+        "succeeded", "timed_out" or "raised", and retrying says whether
+        the request will be tried again. It must not block. '''
+        request = _Request(path, urllib.urlencode(params), service, done,
+                           (path, group) if group is not None else None)
+        try:
+            self.queue.put(request, True, block_timeout)
+        except Queue.Full:
+            return False
+        self.budget.deposit()
+        if self.sleeping:
+            self.__wake()
+        return True
+
+    def __wake(self):
+        try:
+            os.write(self.wake_w, "x")
+        except OSError:
+            pass
+
+    def __encode(self, request):
+        headers = {'Content-Type': 'application/x-www-form-urlencoded; charset=utf-8',
+                   'Content-Length': str(len(request.body))}
+        if self.aws_key and self.secret_key:
+            sign_v4(headers, 'POST', self.host_header, request.path, request.body,
+                    self.region, request.service, self.aws_key, self.secret_key,
+                    self.token, cache=self.signing_keys)
+        else:
+            headers['Host'] = self.host_header
+        head = "POST %s HTTP/1.1\r\n%s\r\n" % (
+            request.path, "".join("%s: %s\r\n" % item for item in headers.items()))
+        return head + request.body
+
+    def __resolve(self):
+        # On a thread of its own: a slow resolver must not stall the loop
+        try:
+            self.address = (socket.gethostbyname(self.host), time.time() + self.ADDRESS_TTL)
+        except (socket.error, EnvironmentError):
+            # Keep the last good address, if any, for a while longer
+            self.address = (self.address[0], time.time() + self.FAILED_ADDRESS_TTL)
+        self.resolving = False
+        with self.pipe_lock:
+            # The loop may have stopped, and closed the pipe, meanwhile
+            if self.pipe_open:
+                self.__wake()
+
+    def __awaiting_address(self):
+        ''' True while the first lookup of the address is running. '''
+        return self.address[0] is None and self.resolving
+
+    def __connect(self, address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = sock.connect_ex((address, self.port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise socket.error(err, os.strerror(err))
+        conn = _Connection(sock, "connecting")
+        self.connections.append(conn)
+        return conn
+
+    def __start(self, request, now):
+        ''' Puts request on an idle connection, or a new one. Returns
+        False if every connection is busy. '''
+        for conn in self.connections:
+            if conn.state == "idle":
+                conn.reused = True
+                break
+        else:
+            if len(self.connections) >= self.concurrency:
+                return False
+            # In this order: a lookup seen to have finished has
+            # stored its address
+            resolving = self.resolving
+            address, expires = self.address
+            if now >= expires and not resolving:
+                self.resolving = resolving = True
+                t = threading.Thread(target=self.__resolve, name="EventSender-resolver")
+                t.daemon = True
+                t.start()
+            if address is None and resolving:
+                # Held until the resolver wakes us
+                return False
+            try:
+                if address is None:
+                    raise socket.error("Cannot resolve " + self.host)
+                conn = self.__connect(address)
+            except (socket.error, EnvironmentError):
+                request.started = now
+                self.__finish(request, "raised", now)
+                return True
+            conn.reused = False
+        request.started = now
+        conn.request = request
+        conn.out = self.__encode(request)
+        conn.inbuf = ""
+        conn.deadline = now + self.timeout
+        if conn.state == "idle":
+            conn.state = "sending"
+        return True
+
+    def __finish(self, request, outcome, now):
+        ''' Reports one attempt, and either retries the request or
+        marks it done. '''
+        retrying = outcome != "succeeded" and outcome != "rejected" and \
+            request.retries < self.max_retries and not self.stopping and \
+            self.budget.withdraw() > 0
+        if outcome == "rejected":
+            outcome = "raised"
+        if request.done is not None:
+            try:
+                request.done(outcome, now - request.started, retrying)
+            except Exception:
+                pass
+        if retrying:
+            request.retries += 1
+            self.__retry(request, now + retry.backoff(request.retries))
+        else:
+            self.queue.task_done()
+            held = self.held.get(request.group)
+            if held:
+                # The next of the group's requests takes its place
+                self.__retry(held.popleft(), now)
+            elif held is not None:
+                del self.held[request.group]
+
+    def __retry(self, request, due):
+        ''' Puts a failed request on the backoff heap. Until it is done,
+        its group's later requests stay held back. '''
+        self.sequence += 1
+        # Back off, so throttling has a chance to clear
+        heapq.heappush(self.retries, (due, self.sequence, request))
+
+    def __drop(self, conn, outcome, now):
+        ''' Closes a connection, failing its request, if any. '''
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+        self.connections.remove(conn)
+        request = conn.request
+        if request is None:
+            return
+        conn.request = None
+        if conn.reused and not conn.inbuf and outcome != "timed_out":
+            # The server closed a kept-alive connection before we
+            # used it. That is not the request's fault; try again.
+            self.__retry(request, now)
+            return
+        self.__finish(request, outcome, now)
+
+    def __on_writable(self, conn, now):
+        if conn.state == "connecting":
+            err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                return self.__drop(conn, "raised", now)
+            if not self.tls:
+                conn.state = "sending"
+            else:
+                conn.sock = self.ssl_context.wrap_socket(conn.sock, server_hostname=self.host,
+                                                         do_handshake_on_connect=False)
+                conn.state = "handshake_write"
+        if conn.state == "handshake_write":
+            return self.__handshake(conn, now)
+        if conn.state == "sending":
+            try:
+                sent = conn.sock.send(conn.out)
+            except ssl.SSLWantWriteError:
+                return
+            except ssl.SSLWantReadError:
+                return
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                return self.__drop(conn, "raised", now)
+            conn.out = conn.out[sent:]
+            if not conn.out:
+                conn.state = "reading"
+
+    def __handshake(self, conn, now):
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            conn.state = "handshake_read"
+            return
+        except ssl.SSLWantWriteError:
+            conn.state = "handshake_write"
+            return
+        except (ssl.SSLError, socket.error):
+            return self.__drop(conn, "raised", now)
+        conn.state = "sending"
+
+    def __on_readable(self, conn, now):
+        if conn.state == "handshake_read":
+            return self.__handshake(conn, now)
+        try:
+            data = conn.sock.recv(65536)
+            # TLS may hold decrypted data select() does not know about
+            while data and self.tls and conn.sock.pending():
+                data += conn.sock.recv(65536)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            return self.__drop(conn, "raised", now)
+        if not data:
+            return self.__drop(conn, "raised", now)
+        if conn.state != "reading":
+            # Nothing should arrive on an idle connection
+            return self.__drop(conn, "raised", now)
+        conn.inbuf += data
+        try:
+            status, body, keep_alive = _parse_response(conn.inbuf)
+        except _Incomplete:
+            return
+        except ValueError:
+            return self.__drop(conn, "raised", now)
+        request = conn.request
+        conn.request = None
+        conn.inbuf = ""
+        conn.deadline = None
+        if keep_alive:
+            conn.state = "idle"
+        else:
+            self.__drop(conn, None, now)
+        if status < 300:
+            self.__finish(request, "succeeded", now)
+        elif status >= 500 or status == 429 or "Throttl" in body:
+            self.__finish(request, "raised", now)
+        else:
+            # A malformed request will never succeed
+            self.__finish(request, "rejected", now)
+
+    def __dispatch(self, now):
+        while self.retries and self.retries[0][0] <= now:
+            request = self.retries[0][2]
+            if not self.__start(request, now):
+                return
+            heapq.heappop(self.retries)
+        while True:
+            try:
+                request = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            held = self.held.get(request.group)
+            if held is not None:
+                # An earlier request of its group is in flight, or
+                # waiting to be retried
+                held.append(request)
+                continue
+            if request.group is not None:
+                self.held[request.group] = collections.deque()
+            if not self.__start(request, now):
+                # Every connection is busy. Hold it until one frees up.
+                self.sequence += 1
+                heapq.heappush(self.retries, (now, self.sequence, request))
+                return
+
+    def __run(self):
+        while True:
+            now = time.time()
+            self.__dispatch(now)
+            for conn in list(self.connections):
+                if conn.deadline is not None and conn.deadline <= now:
+                    self.__drop(conn, "timed_out", now)
+            busy = [c for c in self.connections if c.request is not None]
+            if self.stopping and not busy and not self.retries and not self.held and \
+                    self.queue.empty():
+                break
+            readers = [self.wake_r] + [c.sock for c in self.connections
+                                       if c.state in ("reading", "idle", "handshake_read")]
+            writers = [c.sock for c in self.connections
+                       if c.state in ("connecting", "sending", "handshake_write")]
+            wait = 1.0
+            if busy:
+                wait = min(wait, max(0, min(c.deadline for c in busy) - now))
+            # Set before checking the queue, so submit() wakes us if
+            # a request arrives between the check and select().
+            self.sleeping = True
+            if len(busy) < self.concurrency and not self.__awaiting_address():
+                if self.retries:
+                    wait = min(wait, max(0, self.retries[0][0] - now))
+                if not self.queue.empty():
+                    wait = 0
+            try:
+                readable, writable, _ = select.select(readers, writers, [], wait)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            finally:
+                self.sleeping = False
+            now = time.time()
+            by_sock = dict((c.sock, c) for c in self.connections)
+            for sock in writable:
+                conn = by_sock.get(sock)
+                if conn is not None and conn in self.connections:
+                    self.__on_writable(conn, now)
+            for sock in readable:
+                if sock == self.wake_r:
+                    os.read(self.wake_r, 4096)
+                    continue
+                conn = by_sock.get(sock)
+                if conn is not None and conn in self.connections:
+                    self.__on_readable(conn, now)
+        for conn in list(self.connections):
+            self.__drop(conn, None, time.time())
+
+    def pending(self):
+        ''' The number of requests queued, in flight or waiting to be
+        retried. '''
+        return self.queue.unfinished_tasks
+
+    def flush(self, timeout=None):
+        ''' Waits until every request submitted so far is done. Returns
+        False if timeout seconds passed first. '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        q = self.queue
+        with q.all_tasks_done:
+            while q.unfinished_tasks:
+                if deadline is None:
+                    q.all_tasks_done.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    q.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        ''' Flushes, for up to timeout seconds, then stops the event
+        loop. Requests still waiting are not retried. '''
+        if self.stopping:
+            return
+        self.flush(timeout)
+        self.stopping = True
+        self.__wake()
+        self.thread.join(timeout)
+        if not self.thread.is_alive():
+            with self.pipe_lock:
+                self.pipe_open = False
+                os.close(self.wake_r)
+                os.close(self.wake_w)
+
+if __name__ == '__main__':
+    import BaseHTTPServer
+    import SocketServer
+
+    received = []
+
+    class StandIn(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # One write per response, or Nagle's algorithm stalls keep-alive
+        wbufsize = -1
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            time.sleep(0.01)
+            received.append(urlparse.parse_qs(body)["MessageBody"][0])
+            reply = "<SendMessageResponse/>"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+    server = Server(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever).start()
+    sender = EventSender("http://127.0.0.1:%d" % server.server_address[1], concurrency=32)
+    outcomes = []
+    t = time.time()
+    for i in range(2000):
+        sender.submit("/000000000000/test", {"Action": "SendMessage", "MessageBody": "TEST %d" % i},
+                      "sqs", lambda outcome, seconds, retrying: outcomes.append(outcome))
+    sender.close()
+    delta = time.time() - t
+    server.shutdown()
+    if sorted(received) != sorted("TEST %d" % i for i in range(2000)) or outcomes != ["succeeded"] * 2000:
+        raise Exception("Event sender failed")
+    print "Sent 2000 requests in %.2fs, %.0f per second" % (delta, 2000 / delta)
+    print "Event sender OKAY"
+
+    # A group's requests stay in order when one of them is retried
+    del received[:]
+    failed = []
+    class Flaky(StandIn):
+        def do_POST(self):
+            if not failed:
+                failed.append(True)
+                self.rfile.read(int(self.headers["Content-Length"]))
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            StandIn.do_POST(self)
+    server = Server(("127.0.0.1", 0), Flaky)
+    threading.Thread(target=server.serve_forever).start()
+    for concurrency in (1, 8):
+        del received[:]
+        del failed[:]
+        sender = EventSender("http://127.0.0.1:%d" % server.server_address[1],
+                             concurrency=concurrency)
+        for i in range(20):
+            sender.submit("/000000000000/test.fifo", {"Action": "SendMessage",
+                                                      "MessageBody": "TEST %d" % i}, "sqs",
+                          group="g" if i % 2 else "h")
+        sender.close()
+        for group in (0, 1):
+            ordered = [m for m in received if int(m.split()[1]) % 2 == group]
+            if ordered != ["TEST %d" % i for i in range(group, 20, 2)] or sender.held:
+                raise Exception("Group order not kept across a retry: %s" % received)
+        if len(received) != 20:
+            raise Exception("Group requests lost: %s" % received)
+        print "Groups sent in order after a retry with concurrency %d: %s" % (
+            concurrency, " ".join(m.split()[1] for m in received))
+    server.shutdown()
+
+    # A slow resolver does not hold up the event loop: an expired
+    # address is used while it is looked up again
+    import calendar
+    del received[:]
+    server = Server(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever).start()
+    sender = EventSender("http://localhost:%d" % server.server_address[1], concurrency=10)
+    sender.submit("/000000000000/test", {"Action": "SendMessage", "MessageBody": "TEST first"}, "sqs")
+    sender.flush()
+    gethostbyname = socket.gethostbyname
+    def slow_gethostbyname(host):
+        time.sleep(1)
+        return gethostbyname(host)
+    socket.gethostbyname = slow_gethostbyname
+    sender.address = (sender.address[0], 0)
+    t = time.time()
+    for i in range(10):
+        sender.submit("/000000000000/test", {"Action": "SendMessage", "MessageBody": "TEST %d" % i},
+                      "sqs")
+    sender.flush()
+    delta = time.time() - t
+    sender.close()
+    socket.gethostbyname = gethostbyname
+    server.shutdown()
+    if len(received) != 11 or delta > 0.5:
+        raise Exception("Slow resolver held up the loop: %.2fs, %d sent" % (delta, len(received)))
+
+    # The post-vanilla case of the AWS Signature Version 4 test suite
+    headers = {}
+    sign_v4(headers, "POST", "example.amazonaws.com", "/", "", "us-east-1", "service",
+            "AKIDEXAMPLE", "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY",
+            now=calendar.timegm((2015, 8, 30, 12, 36, 0)))
+    if headers["Authorization"] != "AWS4-HMAC-SHA256 " \
+            "Credential=AKIDEXAMPLE/20150830/us-east-1/service/aws4_request, " \
+            "SignedHeaders=host;x-amz-date, " \
+            "Signature=5da7c1a2acd57cee7505fc6676e4e544621c30862966e37dddb68e92efbe5d6b":
+        raise Exception("Signing failed: " + headers["Authorization"])
+    print "Signing OKAY"
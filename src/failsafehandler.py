@@ -1,7 +1,11 @@
 import logging
 import logging.handlers
+import threading
 import time
 from lambdahandler import LambdaHandler
+from workerpool import WorkerPool
+from circuitbreaker import CircuitBreaker
+from metrics import HandlerMetrics, LatencyEstimator
 
 
 class FailsafeHandler(logging.Handler):
@@ -15,53 +19,87 @@ class FailsafeHandler(logging.Handler):
     2. If main_handler takes more than /timeout/ seconds, it will be terminated. 
     3. If it times out more than /attempts/ times, then it is taken
        out of main queue, and we start using failsafe_handlers instead. We retry main_handler
-       after /retry_timeout/ seconds
+       after /retry_timeout/ seconds. Only one record at a time is
+       used to probe whether it has come back.
     4. If at any point an exception is thrown, catch it using exception_handlers
-
-    Please note that Python does not give a way to kill threads. If
-    this code is completely ignored, threads may built up (e.g. at
-    attempts=3 and retry_timeout at 1 hour, you may accumulate up to
-    three threads per hour). 
+    5. Optionally, a SpoolHandler is used as the first fallback. Once
+       main_handler is back in rotation, what was spooled is replayed
+       to it in the background at /replay_rate/ records per second.
+       A replay which stops on a timeout, and anything spooled since
+       the last one started, is picked up again by a later success
+       of main_handler, backing off while replays keep stopping.
+    6. Optionally, records are hedged. If the first handler has not
+       finished within the /hedge/ percentile of its last hundred
+       latencies, the record is also sent to the next fallback, and
+       whichever succeeds first wins; the other call is abandoned.
+       With /fanout/ the record goes to both at once. This bounds the caller's wait
+       when a handler is slow rather than down, at the cost of some
+       records being delivered twice.
+    7. Optionally, timeouts are adaptive. Each handler's timeout is
+       then its recent mean latency plus four deviations, kept between
+       /min_timeout/ and /timeout/, so a record stops waiting on a
+       normally fast handler long before the full timeout.
+
+    Each handler is run on its own WorkerPool of /workers/ long-lived
+    threads. Please note that Python does not give a way to kill
+    threads. A worker which times out stays busy until the handler
+    returns. Up to /max_stuck/ such workers are replaced per handler;
+    past that, and once all of a handler's workers are stuck, records
+    skip that handler and go straight to the next one.
+
+    self.metrics counts what became of each record, and times emit as
+    the caller sees it. handler_metrics(handler) counts and times the
+    calls made to each wrapped handler.
     '''
+    # Counter for each result of a call to a wrapped handler
+    OUTCOMES = {"Success": "succeeded", "Timeout": "timed_out", "Exception": "raised"}
+    # Latencies a handler must have recorded before it is hedged, or
+    # given an adaptive timeout
+    HEDGE_MIN_SAMPLES = 20
+    ADAPTIVE_MIN_SAMPLES = 20
+    # Deviations above the mean latency at which an adaptive timeout is set
+    TIMEOUT_DEVIATIONS = 4
+    # Seconds before a stopped replay of the spool is tried again,
+    # doubling each time it stops early
+    REPLAY_MIN_BACKOFF = 1.0
+    REPLAY_MAX_BACKOFF = 60.0
     
     def __timeout (self, handler, record, timeout_duration):
-        ''' Calls handler with argument record.
+        ''' Calls handler with argument record on that handler's
+        worker pool.
 
-        Returns a tuple with first element a boolean indicating
-        whether the function timed out and the second element an
-        exception string if it occurred.
+        Returns "Success", "Timeout", "Busy" if the handler's workers
+        are all wedged or its queue is full, or "Exception" followed
+        by the exception string.
 
         Parameters:
-            handler: Function whose running time is to be monitered
+            handler: The handler whose emit is to be monitored
             record: Argument to the function
             timeout_duration: Time interval after which request times out
-            it: An InterruptableThread instance
         '''
-        import threading        
-        class InterruptableThread(threading.Thread):
-            def __init__ (self):
-                threading.Thread.__init__(self)
-                self.result = None
-            def run (self):
-                try:
-                    handler(record)
-                except Exception, ex:
-                    self.result = ex
-        it = InterruptableThread()
-        it.start()        
-        is_timeout = False
-        it.join(timeout_duration) # blocking call
-        if it.isAlive():
-            is_timeout = True
-        
-        if is_timeout:
-            return "Timeout"
-        if it.result:
-            self.exception_handler.emit(record)
-            return "Exception "+str(it.result)
-        return "Success"
-
-    def __init__(self, main_handler, fallback_handlers, exception_handler, timeout, attempts, retry_timeout):
+        t = time.time()
+        res, ex = self.__pools[handler].run(handler.emit, record, timeout_duration)
+        return self.__result(handler, record, res, ex, time.time() - t)
+
+    def __result(self, handler, record, res, ex, seconds, report=True):
+        ''' Records the result of a call to handler, and passes the
+        record to the exception handler if it raised, unless report is
+        False. Returns the result as __timeout does. '''
+        metrics = self.__handler_metrics[handler]
+        if res == "Busy":
+            metrics.incr("dropped")
+        else:
+            metrics.observe(seconds, self.OUTCOMES[res])
+            # A timed out call took at least this long, so it pushes
+            # the adaptive timeout up.
+            self.__estimators[handler].add(seconds)
+        if res == "Exception":
+            if report:
+                self.exception_handler.emit(record)
+            return "Exception "+str(ex)
+        return res
+
+    def __init__(self, main_handler, fallback_handlers, exception_handler, timeout, attempts, retry_timeout, workers=4, queue_size=1000, max_stuck=None, spool=None, replay_rate=100, hedge=None, fanout=False, adaptive=False, min_timeout=0.05):
         '''Parameters
             main_handler: The main log handler
             fallback_handlers: List of failsafe handlers if main_handler times out
@@ -69,15 +107,52 @@ class FailsafeHandler(logging.Handler):
             timeout: Timeout
             attempts: Number of attempts before the handler is taken out into recharge queue
             retry_timeout: Time interval after which handlers in recharge queue are tried again
+            workers: Number of worker threads per handler
+            queue_size: Number of records which may wait for a handler's workers
+            max_stuck: Number of timed out workers replaced per handler. Defaults to attempts.
+            spool: A SpoolHandler to keep records in while main_handler is out of rotation
+            replay_rate: Records per second replayed from the spool to main_handler
+            hedge: Latency percentile (e.g. 0.95) after which a record is also sent to the next fallback
+            fanout: Send each record to the first two handlers in rotation at once
+            adaptive: Set each handler's timeout from its recent latency, with timeout as the ceiling
+            min_timeout: The floor for adaptive timeouts
         '''
         logging.Handler.__init__(self)
+        self.main_handler = main_handler
+        self.spool = spool
+        self.replay_rate = replay_rate
+        if spool is not None:
+            fallback_handlers = [spool] + fallback_handlers
         self.handlers = [main_handler] + fallback_handlers
         self.exception_handler = exception_handler
         self.timeout = timeout
         self.attempts = attempts
         self.retry_timeout = retry_timeout
-        
-        self.reset()
+        self.hedge = hedge
+        self.fanout = fanout
+        self.adaptive = adaptive
+        self.min_timeout = min_timeout
+        if max_stuck is None:
+            max_stuck = attempts
+        self.__pools = {}
+        for fh in self.handlers:
+            self.__pools[fh] = WorkerPool(workers, queue_size, max_stuck, name="FailsafeHandler")
+        self.__breakers = {}
+        for fh in self.handlers:
+            self.__breakers[fh] = CircuitBreaker(attempts, retry_timeout)
+        self.__chain = [(fh, self.__breakers[fh]) for fh in self.handlers]
+        self.metrics = HandlerMetrics("FailsafeHandler")
+        self.__handler_metrics = {}
+        self.__estimators = {}
+        for fh in self.handlers:
+            self.__handler_metrics[fh] = HandlerMetrics("FailsafeHandler:" + type(fh).__name__)
+            self.__estimators[fh] = LatencyEstimator()
+        self.__replay_lock = threading.Lock()
+        self.__replay_backoff = self.REPLAY_MIN_BACKOFF
+        self.__replay_at = 0
+        # Records left over from a previous run
+        if spool is not None and spool.pending():
+            self.__replay()
         
     def reset(self):
         ''' Reset the handler to revert to the main handler
@@ -85,59 +160,208 @@ class FailsafeHandler(logging.Handler):
 
         Parameters: None 
         '''
-        self.__timeouts = {}
-        for fh in self.handlers:
-            self.__timeouts[fh] = {}
-            self.__reset_handler(fh)
-
-    def __timeout_handler(self, handler):
-        self.__timeouts[handler]['active'] = False
-        self.__timeouts[handler]['reset_time'] = time.time() + self.retry_timeout
-
-    def __reset_handler(self, handler):
-        self.__timeouts[handler]['active'] = True
-        self.__timeouts[handler]['attempts'] = 0
-
-    def emit(self, record):
-        handled = False
-        for handler in self.handlers:
-            # If the current handler was inactive, but is past the retry timeout, try it. 
-            # If it works, reset it. 
-            if not self.__timeouts[handler]['active'] and \
-                    self.__timeouts[handler]['reset_time'] < time.time():
-                res = self.__timeout(handler.emit, record, self.timeout)
-                if res == "Success":
-                    self.__reset_handler(handler)
-                    handled = True
-                    break
-                if res == "Timeout":
-                    self.__timeout_handler(handler)
+        for breaker in self.__breakers.values():
+            breaker.reset()
+
+    def createLock(self):
+        # Each handler is called on its own pool, and the breakers have
+        # their own locks, so records need not go through one at a time
+        self.lock = None
+
+    def stuck_workers(self):
+        ''' Returns a dictionary from each handler to the number of
+        its workers stuck on timed out records. '''
+        return dict((h, p.stuck) for h, p in self.__pools.items())
+
+    def handler_metrics(self, handler):
+        ''' Returns the HandlerMetrics of the calls made to one of the
+        wrapped handlers. '''
+        return self.__handler_metrics[handler]
+
+    def handler_timeout(self, handler):
+        ''' The timeout currently applied to calls to handler. '''
+        if not self.adaptive:
+            return self.timeout
+        estimator = self.__estimators[handler]
+        if estimator.count < self.ADAPTIVE_MIN_SAMPLES:
+            return self.timeout
+        return min(self.timeout, max(self.min_timeout, estimator.bound(self.TIMEOUT_DEVIATIONS)))
+
+    def __replay(self):
+        breaker = self.__breakers[self.main_handler]
+        self.spool.replay(self.__replay_emit, self.replay_rate,
+                          keep_going=lambda: breaker.state is breaker.CLOSED)
+
+    def __replay_emit(self, record):
+        # Replayed records get the same timeout protection, and a
+        # timeout counts against main_handler as usual.
+        res = self.__timeout(self.main_handler, record, self.handler_timeout(self.main_handler))
+        if res == "Timeout":
+            self.__breakers[self.main_handler].failure(CircuitBreaker.CLOSED)
+        if res in ("Timeout", "Busy"):
+            with self.__replay_lock:
+                self.__replay_at = time.time() + self.__replay_backoff
+                self.__replay_backoff = min(2 * self.__replay_backoff, self.REPLAY_MAX_BACKOFF)
+            raise RuntimeError("Replay stopped: " + res)
+        self.__replay_backoff = self.REPLAY_MIN_BACKOFF
+
+    def __resume_replay(self, force):
+        ''' Starts a replay of the spool if none is running and there
+        is something to replay. Unless forced, this waits out the
+        backoff since the last start, so a replay which stopped on a
+        timeout, or records spooled while one was running, are picked
+        up again by a later success of main_handler. '''
+        now = time.time()
+        with self.__replay_lock:
+            if self.spool.replaying() or (not force and now < self.__replay_at):
+                return
+            self.__replay_at = max(self.__replay_at, now + self.REPLAY_MIN_BACKOFF)
+        if self.spool.pending():
+            self.__replay()
+
+    def __settle(self, handler, breaker, state, res):
+        ''' Updates the breaker with the result of a call. Returns what
+        became of the record, or None if the next handler should be
+        tried. '''
+        if res == "Success":
+            breaker.success(state)
+            if handler is self.main_handler and self.spool is not None:
+                self.__resume_replay(state is breaker.HALF_OPEN)
+            if handler is self.main_handler:
+                return "succeeded"
+            return "fell_back"
+        if res == "Timeout":
+            breaker.failure(state)
+            return None
+        breaker.abort(state)
+        if res == "Busy":
+            # All workers are wedged or backed up. Reroute.
+            return None
+        # exception
+        return "raised"
+
+    def __race(self, record):
+        ''' Sends record to the first handler in rotation and, once its
+        hedge delay has passed, to the next one too. Returns what became
+        of the record, or None and the rest of the chain to try in
+        turn. '''
+        chain = self.__chain
+        for i, (handler, breaker) in enumerate(chain):
+            state = breaker.allow()
+            if state is not None:
+                break
+        else:
+            return None, []
+        rest = chain[i+1:]
+        delay = 0
+        if not self.fanout:
+            timeout = self.handler_timeout(handler)
+            delay = self.__estimators[handler].percentile(self.hedge, self.HEDGE_MIN_SAMPLES)
+            if delay is None or delay >= timeout:
+                # Not enough history, or hedging would not save anything
+                return self.__settle(handler, breaker, state, self.__timeout(handler, record, timeout)), rest
+        done = threading.Event()
+        task = self.__pools[handler].submit(handler.emit, record, done)
+        if task is None:
+            return self.__settle(handler, breaker, state, self.__result(handler, record, "Busy", None, 0)), rest
+        now = time.time()
+        racers = [(handler, breaker, state, task, now, now + self.handler_timeout(handler))]
+        if delay:
+            done.wait(delay)
+        if not task.finished:
+            for j, (hedge_handler, hedge_breaker) in enumerate(rest):
+                hedge_state = hedge_breaker.allow()
+                if hedge_state is None:
                     continue
-                # exception
+                hedge_task = self.__pools[hedge_handler].submit(hedge_handler.emit, record, done)
+                if hedge_task is None:
+                    self.__settle(hedge_handler, hedge_breaker, hedge_state,
+                                  self.__result(hedge_handler, record, "Busy", None, 0))
+                    continue
+                now = time.time()
+                racers.append((hedge_handler, hedge_breaker, hedge_state, hedge_task,
+                               now, now + self.handler_timeout(hedge_handler)))
+                rest = rest[j+1:]
                 break
-            elif self.__timeouts[handler]['attempts'] > 0 and self.__timeouts[handler]['reset_time'] < time.time(): 
-                self.__timeouts[handler]['attempts'] = 0
+            else:
+                rest = []
+        outcome = None
+        while racers:
+            done.clear()
+            now = time.time()
+            for racer in list(racers):
+                handler, breaker, state, task, started, deadline = racer
+                pool = self.__pools[handler]
+                if not task.finished and now >= deadline and pool.abandon(task):
+                    res, ex = "Timeout", None
+                elif task.finished:
+                    res, ex = pool.result(task)
+                else:
+                    continue
+                racers.remove(racer)
+                # A racer which raised is reported only if none wins
+                result = self.__settle(handler, breaker, state,
+                                       self.__result(handler, record, res, ex, now - started,
+                                                     report=False))
+                if result == "succeeded" or result == "fell_back":
+                    now = time.time()
+                    for handler, breaker, state, task, started, deadline in racers:
+                        # Not stuck, just beaten. It has taken at least
+                        # this long, which must still count towards
+                        # its latency or the hedge delay keeps falling.
+                        if self.__pools[handler].abandon(task, stuck=False):
+                            self.__handler_metrics[handler].observe(now - started)
+                            self.__estimators[handler].add(now - started)
+                        breaker.abort(state)
+                    return result, []
+                if result is not None:
+                    outcome = result
+            if racers:
+                done.wait(min(racer[5] for racer in racers) - now)
+        if outcome is not None:
+            self.exception_handler.emit(record)
+            return outcome, []
+        return None, rest
 
-            # If the current handler is inactive, and it's not past
-            # the timeout, go on to the next one
-            if not self.__timeouts[handler]['active']:
+    def emit(self, record):
+        t = time.time()
+        outcome = None
+        chain = self.__chain
+        if self.hedge is not None or self.fanout:
+            outcome, chain = self.__race(record)
+        for handler, breaker in chain:
+            if outcome is not None:
+                break
+            # None if the handler is out of rotation, or another
+            # thread is already probing whether it has come back
+            state = breaker.allow()
+            if state is None:
                 continue
+            outcome = self.__settle(handler, breaker, state,
+                                    self.__timeout(handler, record, self.handler_timeout(handler)))
+        self.metrics.incr("emitted")
+        self.metrics.observe(time.time() - t, outcome or "dropped")
 
-            # If the current handler is active, try it. 
-            res = self.__timeout(handler.emit, record, self.timeout)
-            if res == "Timeout":
-                self.__timeouts[handler]['attempts'] = self.__timeouts[handler]['attempts'] + 1
-                self.__timeouts[handler]['reset_time'] = time.time() + self.retry_timeout
-                if self.__timeouts[handler]['attempts'] >= self.attempts: 
-                    self.__timeout_handler(handler)
-                continue
-            handled = True
-            break
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        ''' Closes the wrapped handlers, and stops the workers. The
+        exception handler is left open, as it may be shared. '''
+        if self.spool is not None:
+            # Stop the replay before closing the handler it feeds
+            self.spool.close()
+        for handler in self.handlers:
+            handler.close()
+        for pool in self.__pools.values():
+            pool.close()
+        logging.Handler.close(self)
             
     def __getattr__ (self, name):
         ## Allows access to auxiliary methods/data in the main_handler
-        if name=="__timeouts":
-            return self.__timeouts
+        if name=="__breakers":
+            return self.__breakers
         return getattr(self.main_handler, name)
 
 if __name__ == '__main__':
@@ -314,6 +538,136 @@ if __name__ == '__main__':
     
     verify("All handlers time out. This one is tricky, since this is never logged. Final fallback handler should log this.", ['[main]start rtimeout: TEST 7-0', '[failsafe]start rtimeout: TEST 7-0', '[default]start rtimeout: TEST 7-0', '[main]start rtimeout: TEST 7-1', '[failsafe]start rtimeout: TEST 7-1', '[default]start rtimeout: TEST 7-1', '[main]start rtimeout: TEST 7-2', '[failsafe]start rtimeout: TEST 7-2', '[default]start rtimeout: TEST 7-2', '[main]finish rtimeout: TEST 7-0', '[failsafe]finish rtimeout: TEST 7-0', '[default]finish rtimeout: TEST 7-0', '[main]finish rtimeout: TEST 7-1', '[failsafe]finish rtimeout: TEST 7-1', '[default]finish rtimeout: TEST 7-1', '[main]finish rtimeout: TEST 7-2', '[failsafe]finish rtimeout: TEST 7-2', '[default]finish rtimeout: TEST 7-2'])
 
+    # Test case: Main handler is down, records are spooled, then replayed once it is back
+    import shutil
+    import tempfile
+    from spoolhandler import SpoolHandler
+    spooldir = tempfile.mkdtemp()
+    down = [True]
+    mainhandlerflaky = LambdaHandler(lambda x: f_handlertimeout("main", x) if down[0] else f_handlerok("main", x))
+    test8handler = FailsafeHandler(mainhandlerflaky, fallback_handlers=[defaulthandlerok], exception_handler=defaultexceptionhandler, timeout=0.1, attempts=1, retry_timeout=0.5, spool=SpoolHandler(spooldir, linger=0.01), replay_rate=1000)
+    logger.addHandler(test8handler)
+    for i in range(0, 4):
+        logger.error("TEST 8-" + str(i))
+    time.sleep(1)
+    down[0] = False
+    del handlers_called[:]
+    logger.error("TEST 8-4")
+    time.sleep(0.5)
+    logger.removeHandler(test8handler)
+    test8handler.spool.close()
+    shutil.rmtree(spooldir)
+    verify("Spooled records are replayed", ['[main]start ok: TEST 8-4', '[main]finish ok: TEST 8-4'] + sum([['[main]start ok: TEST 8-' + str(i), '[main]finish ok: TEST 8-' + str(i)] for i in range(0, 4)], []))
+
+    # Test case: A replay stops on a timeout while main stays in
+    # rotation. The next success of main resumes it, along with what
+    # was spooled after it started.
+    spooldir = tempfile.mkdtemp()
+    spool = SpoolHandler(spooldir, linger=0.01)
+    logger.addHandler(spool)
+    for i in range(0, 4):
+        logger.error("TEST 8a-" + str(i))
+    logger.removeHandler(spool)
+    delivered = []
+    stalled = []
+    def f_stallonce(x):
+        if x == "TEST 8a-1" and not stalled:
+            stalled.append(x)
+            time.sleep(0.3)
+        else:
+            delivered.append(x)
+    test8ahandler = FailsafeHandler(LambdaHandler(f_stallonce), fallback_handlers=[], exception_handler=defaultexceptionhandler, timeout=0.1, attempts=3, retry_timeout=60*60, spool=spool, replay_rate=1000)
+    time.sleep(0.5)
+    spool.emit(logging.LogRecord("myapp", logging.ERROR, __file__, 0, "TEST 8a-late", None, None))
+    if delivered != ["TEST 8a-0"] or spool.replaying():
+        raise Exception("Replay did not stop: " + str(delivered))
+    test8ahandler.emit(logging.LogRecord("myapp", logging.ERROR, __file__, 0, "TEST 8a-4", None, None))
+    time.sleep(0.2)
+    if delivered != ["TEST 8a-0", "TEST 8a-4"]:
+        raise Exception("Replay resumed before its backoff: " + str(delivered))
+    time.sleep(test8ahandler.REPLAY_MIN_BACKOFF)
+    test8ahandler.emit(logging.LogRecord("myapp", logging.ERROR, __file__, 0, "TEST 8a-5", None, None))
+    time.sleep(0.2)
+    test8ahandler.close()
+    shutil.rmtree(spooldir)
+    if delivered != ["TEST 8a-0", "TEST 8a-4", "TEST 8a-5", "TEST 8a-1", "TEST 8a-2", "TEST 8a-3", "TEST 8a-late"]:
+        raise Exception("Replay was not resumed: " + str(delivered))
+    print "Stopped replays are resumed OKAY"
+
+    # Test case: Hedging. Once main has a latency history, a slow
+    # record is also sent to the fallback, and the caller waits only
+    # for whichever is first.
+    mainhandlersometimesslow = LambdaHandler(lambda x: time.sleep(0.3) if x.startswith("slow") else None)
+    test9handler = FailsafeHandler(mainhandlersometimesslow, fallback_handlers=[failsafehandlerok], exception_handler=defaultexceptionhandler, timeout=1, attempts=3, retry_timeout=60*60, hedge=0.9)
+    logger.addHandler(test9handler)
+    for i in range(FailsafeHandler.HEDGE_MIN_SAMPLES):
+        logger.error("fast %d" % i)
+    t = time.time()
+    logger.error("slow 9")
+    delta = time.time() - t
+    logger.removeHandler(test9handler)
+    if delta > 0.1:
+        raise Exception("Hedging failed " + str(delta))
+    if test9handler.metrics.snapshot()["counters"]["fell_back"] != 1:
+        raise Exception("Hedging failed " + str(test9handler.metrics.snapshot()["counters"]))
+    # The beaten call is timed, and is not taken for a stuck worker
+    if test9handler.handler_metrics(mainhandlersometimesslow).snapshot()["latency"]["count"] != FailsafeHandler.HEDGE_MIN_SAMPLES + 1 or \
+            test9handler.stuck_workers()[mainhandlersometimesslow]:
+        raise Exception("Hedging failed " + str(test9handler.handler_metrics(mainhandlersometimesslow).snapshot()))
+    verify("Slow main handler is hedged", ['[failsafe]start ok: slow 9', '[failsafe]finish ok: slow 9'])
+
+    # Test case: Fan-out. The fast handler wins from the first record.
+    test10handler = FailsafeHandler(mainhandlersometimesslow, fallback_handlers=[failsafehandlerok], exception_handler=defaultexceptionhandler, timeout=1, attempts=3, retry_timeout=60*60, fanout=True)
+    logger.addHandler(test10handler)
+    t = time.time()
+    logger.error("slow 10")
+    delta = time.time() - t
+    logger.removeHandler(test10handler)
+    if delta > 0.1:
+        raise Exception("Fan-out failed " + str(delta))
+    verify("Fan-out", ['[failsafe]start ok: slow 10', '[failsafe]finish ok: slow 10'])
+
+    # Test case: Fan-out where the fallback raises first and main then
+    # succeeds. The record was delivered, so it is not reported.
+    mainhandlerslowok = LambdaHandler(lambda x: time.sleep(0.05) or f_handlerok("main", x))
+    test10ahandler = FailsafeHandler(mainhandlerslowok, fallback_handlers=[failsafehandlerbad], exception_handler=defaultexceptionhandler, timeout=1, attempts=3, retry_timeout=60*60, fanout=True)
+    logger.addHandler(test10ahandler)
+    logger.error("TEST 10a")
+    logger.removeHandler(test10ahandler)
+    verify("Fan-out racer raising before a success", ['[failsafe]start rbad: TEST 10a', '[main]start ok: TEST 10a', '[main]finish ok: TEST 10a'])
+
+    # Test case: Adaptive timeouts. Once main has a latency history,
+    # a hung call is given up on well before the full timeout.
+    mainhandlersometimeshangs = LambdaHandler(lambda x: time.sleep(0.5 if x.startswith("hang") else 0.005))
+    test11handler = FailsafeHandler(mainhandlersometimeshangs, fallback_handlers=[failsafehandlerok], exception_handler=defaultexceptionhandler, timeout=1, attempts=3, retry_timeout=60*60, adaptive=True, min_timeout=0.05)
+    logger.addHandler(test11handler)
+    for i in range(FailsafeHandler.ADAPTIVE_MIN_SAMPLES):
+        logger.error("fast %d" % i)
+    t = time.time()
+    logger.error("hang 11")
+    delta = time.time() - t
+    logger.removeHandler(test11handler)
+    if delta > 0.15 or not 0.05 <= test11handler.handler_timeout(mainhandlersometimeshangs) < 1:
+        raise Exception("Adaptive timeout failed " + str(delta))
+    verify("Adaptive timeout", ['[failsafe]start ok: hang 11', '[failsafe]finish ok: hang 11'])
+
+    # Test case: Records logged from several threads at once are sent
+    # concurrently, on the main handler's workers
+    mainhandlerslow = LambdaHandler(lambda x: time.sleep(0.1) or f_handlerok("main", x))
+    test12handler = FailsafeHandler(mainhandlerslow, fallback_handlers=[failsafehandlerok], exception_handler=defaultexceptionhandler, timeout=1, attempts=3, retry_timeout=60*60, workers=4)
+    logger.addHandler(test12handler)
+    threads = [threading.Thread(target=logger.error, args=("TEST 12",)) for i in range(4)]
+    t = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    delta = time.time() - t
+    logger.removeHandler(test12handler)
+    if delta > 0.2:
+        raise Exception("Concurrent emits failed " + str(delta))
+    verify("Concurrent emits", ['[main]start ok: TEST 12', '[main]finish ok: TEST 12']*4)
+
     test7handler = FailsafeHandler(mainhandlerok, fallback_handlers=[failsafehandlerok, defaulthandlerok], exception_handler=defaultexceptionhandler, timeout=0.1, attempts=3, retry_timeout=60*60)
     logger.addHandler(test7handler)
 
@@ -335,3 +689,8 @@ if __name__ == '__main__':
         raise Exception("Performance not okay")
     print "Ran 10000 threads in ", delta," for ", tps, " threads per second" # Handles 680-4500 threads per second on a 7-year-old T2400
     verify("Load test okay", ['[main]start ok: TEST 8', '[main]finish ok: TEST 8']*10000)
+    counters = test7handler.metrics.snapshot()["counters"]
+    if counters["emitted"] != 10000 or counters["succeeded"] != 10000 or \
+            test7handler.handler_metrics(mainhandlerok).snapshot()["latency"]["count"] != 10000:
+        raise Exception("Metrics failed: " + str(counters))
+    print "Metrics OKAY"
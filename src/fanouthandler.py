@@ -0,0 +1,344 @@
+import logging
+import logging.handlers
+import threading
+import time
+
+from circuitbreaker import CircuitBreaker
+from metrics import HandlerMetrics
+from workerpool import WorkerPool
+
+
+class _Done(object):
+    ''' Set by a worker when one of a record's calls finishes. Wakes the
+    caller, or once the caller has moved on, the handler's watcher. '''
+    __slots__ = ('event', 'watcher')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.watcher = None
+
+    def set(self):
+        self.event.set()
+        watcher = self.watcher
+        if watcher is not None:
+            with watcher:
+                watcher.notify()
+
+
+class FanoutHandler(logging.Handler):
+    ''' FanoutHandler sends each record to several handlers at once.
+    Attached to a logger one by one, handlers are called in turn on the
+    caller's thread, and the caller waits for the sum of their
+    latencies. Wrapped in a FanoutHandler:
+
+        handler = FanoutHandler([SQSHandler("myqueue"), SNSHandler("mytopic"),
+                                 LambdaHandler(p)], timeout=1.0, deadline=0.2)
+
+    the caller waits for the slowest of them, or /deadline/ seconds,
+    whichever comes first.
+
+    Each handler is isolated as in FailsafeHandler: it has its own
+    WorkerPool of long-lived threads, so a hung handler only ties up
+    its own workers, and its own CircuitBreaker. A call running past
+    /timeout/ is abandoned and counts as a timeout; after /attempts/
+    timeouts the handler is skipped for /retry_timeout/ seconds. Calls
+    still running at the deadline are counted as queued, and handed to
+    a watcher thread, which settles them when they finish, or abandons
+    them as timed out once /timeout/ has passed, just as the caller
+    would have.
+
+    self.metrics counts a record as succeeded if at least one handler
+    took it, as queued if none had by the deadline but some were still
+    running, and times emit as the caller sees it. handler_metrics(h)
+    counts and times the calls made to each handler.
+    '''
+    OUTCOMES = {"Success": "succeeded", "Timeout": "timed_out", "Exception": "raised"}
+
+    def __init__(self, handlers, timeout, deadline=None, exception_handler=None, attempts=3,
+                 retry_timeout=60, workers=4, queue_size=1000, max_stuck=None):
+        ''' Parameters:
+        * handlers is the list of handlers each record is sent to
+        * timeout is how long, in seconds, a call may run before it is
+          abandoned as timed out
+        * deadline is the longest emit waits, in seconds. None waits
+          for every handler, up to timeout.
+        * exception_handler, if given, is passed records a handler
+          raised on
+        * attempts is the number of timeouts after which a handler is
+          skipped for retry_timeout seconds
+        * workers is the number of worker threads per handler
+        * queue_size is the number of records which may wait for a
+          handler's workers
+        * max_stuck is the number of timed out workers replaced per
+          handler. Defaults to attempts.
+        '''
+        logging.Handler.__init__(self)
+        if max_stuck is None:
+            max_stuck = attempts
+        self.handlers = list(handlers)
+        self.timeout = timeout
+        self.deadline = deadline
+        self.exception_handler = exception_handler
+        self.__pools = {}
+        self.__breakers = {}
+        self.__handler_metrics = {}
+        for h in self.handlers:
+            self.__pools[h] = WorkerPool(workers, queue_size, max_stuck, name="FanoutHandler")
+            self.__breakers[h] = CircuitBreaker(attempts, retry_timeout)
+            self.__handler_metrics[h] = HandlerMetrics("FanoutHandler:" + type(h).__name__)
+        self.metrics = HandlerMetrics("FanoutHandler")
+        # Calls left running at the deadline, as (handler, state, task,
+        # record, started, timeout) tuples, watched by __watch
+        self.__detached = []
+        self.__watcher = threading.Condition(threading.Lock())
+        self.__watch_thread = None
+        self.__closing = False
+
+    def createLock(self):
+        # Each handler is called on its own pool; emit shares no state
+        self.lock = None
+
+    def handler_metrics(self, handler):
+        ''' Returns the HandlerMetrics of the calls made to one of the
+        handlers. '''
+        return self.__handler_metrics[handler]
+
+    def stuck_workers(self):
+        ''' Returns a dictionary from each handler to the number of
+        its workers stuck on timed out records. '''
+        return dict((h, p.stuck) for h, p in self.__pools.items())
+
+    def reset(self):
+        ''' Puts every handler back in rotation. '''
+        for breaker in self.__breakers.values():
+            breaker.reset()
+
+    def __settle(self, handler, state, record, res, ex, seconds):
+        # Records the result of one call; True if it succeeded
+        breaker = self.__breakers[handler]
+        self.__handler_metrics[handler].observe(seconds, self.OUTCOMES[res])
+        if res == "Success":
+            breaker.success(state)
+            return True
+        if res == "Timeout":
+            breaker.failure(state)
+        else:
+            breaker.abort(state)
+            if self.exception_handler is not None:
+                self.exception_handler.emit(record)
+        return False
+
+    def __check(self, handler, state, task, record, started, timeout, now):
+        ''' Settles a call which has finished, or has run past timeout.
+        Returns None if it is still running, else whether it succeeded. '''
+        pool = self.__pools[handler]
+        if task.finished:
+            res, ex = pool.result(task)
+        elif now >= timeout and pool.abandon(task):
+            res, ex = "Timeout", None
+        elif now >= timeout:
+            # Finished as it was abandoned
+            res, ex = pool.result(task)
+        else:
+            return None
+        return self.__settle(handler, state, record, res, ex, now - started)
+
+    def __watch(self):
+        while True:
+            with self.__watcher:
+                now = time.time()
+                running = []
+                due = []
+                for call in self.__detached:
+                    if call[2].finished or now >= call[5]:
+                        due.append(call)
+                    else:
+                        running.append(call)
+                self.__detached = running
+                if not due:
+                    if not running and self.__closing:
+                        return
+                    if running:
+                        self.__watcher.wait(min(call[5] for call in running) - now)
+                    else:
+                        self.__watcher.wait()
+                    continue
+            # Settled without the watcher lock, which workers take to
+            # wake us, while abandon() takes the pool's
+            for call in due:
+                self.__check(*(call + (now,)))
+
+    def __detach(self, calls, done, record, started, timeout):
+        with self.__watcher:
+            done.watcher = self.__watcher
+            for handler, state, task in calls:
+                self.__handler_metrics[handler].incr("queued")
+                self.__detached.append((handler, state, task, record, started, timeout))
+            if self.__watch_thread is None:
+                self.__watch_thread = threading.Thread(target=self.__watch, name="FanoutHandler")
+                self.__watch_thread.daemon = True
+                self.__watch_thread.start()
+            self.__watcher.notify()
+
+    def emit(self, record):
+        t = time.time()
+        done = _Done()
+        calls = []
+        for handler in self.handlers:
+            state = self.__breakers[handler].allow()
+            if state is None:
+                continue
+            task = self.__pools[handler].submit(handler.emit, record, done)
+            if task is None:
+                # Wedged or backed up
+                self.__breakers[handler].abort(state)
+                self.__handler_metrics[handler].incr("dropped")
+                continue
+            calls.append((handler, state, task))
+        timeout = t + self.timeout
+        deadline = timeout
+        if self.deadline is not None:
+            deadline = min(timeout, t + self.deadline)
+        succeeded = False
+        while calls:
+            done.event.clear()
+            now = time.time()
+            for call in list(calls):
+                handler, state, task = call
+                result = self.__check(handler, state, task, record, t, timeout, now)
+                if result is not None:
+                    calls.remove(call)
+                    succeeded = result or succeeded
+            if calls:
+                if now >= deadline:
+                    break
+                done.event.wait(deadline - now)
+        if calls:
+            # Past the deadline; these finish without us
+            self.__detach(calls, done, record, t, timeout)
+        self.metrics.incr("emitted")
+        if succeeded:
+            outcome = "succeeded"
+        elif calls:
+            # May yet succeed
+            outcome = "queued"
+        else:
+            outcome = "dropped"
+        self.metrics.observe(time.time() - t, outcome)
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        ''' Waits for calls left running at the deadline to finish or
+        time out, stops the workers, and closes the handlers. '''
+        with self.__watcher:
+            self.__closing = True
+            self.__watcher.notify()
+            watch_thread = self.__watch_thread
+        if watch_thread is not None:
+            watch_thread.join()
+        for pool in self.__pools.values():
+            pool.close()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+if __name__ == '__main__':
+    from lambdahandler import LambdaHandler
+    received = []
+    def slow(delay):
+        def f(x):
+            time.sleep(delay)
+            received.append((delay, x))
+        return f
+
+    handler = FanoutHandler([LambdaHandler(slow(d)) for d in (0.05, 0.05, 0.05)], timeout=1.0)
+    t = time.time()
+    handler.handle(logging.makeLogRecord({"msg": "a"}))
+    elapsed = time.time() - t
+    if len(received) != 3 or elapsed > 0.12:
+        raise Exception("Fanout not concurrent: %.3fs, %s" % (elapsed, received))
+    print "Three 50ms handlers in %.0fms" % (elapsed * 1000)
+
+    del received[:]
+    hung = LambdaHandler(slow(0.5))
+    handler = FanoutHandler([LambdaHandler(slow(0.01)), hung], timeout=0.1, attempts=2)
+    for i in range(3):
+        t = time.time()
+        handler.handle(logging.makeLogRecord({"msg": str(i)}))
+        elapsed = time.time() - t
+        if elapsed > 0.15:
+            raise Exception("Timeout not applied: %.3fs" % elapsed)
+    counters = handler.handler_metrics(hung).snapshot()["counters"]
+    if counters["timed_out"] != 2 or [x for d, x in received if d == 0.01] != ["0", "1", "2"]:
+        raise Exception("Hung handler not taken out: %s" % counters)
+    print "Hung handler timed out twice, then skipped"
+
+    handler = FanoutHandler([LambdaHandler(slow(0.01)), LambdaHandler(slow(0.3))],
+                            timeout=1.0, deadline=0.05)
+    t = time.time()
+    handler.handle(logging.makeLogRecord({"msg": "d"}))
+    elapsed = time.time() - t
+    if elapsed > 0.1 or handler.metrics.snapshot()["counters"]["succeeded"] != 1:
+        raise Exception("Deadline not applied: %.3fs" % elapsed)
+    time.sleep(0.3)
+    if (0.3, "d") not in received:
+        raise Exception("Call past the deadline was lost")
+    handler.close()
+
+    # Close waits for calls past the deadline before closing the handlers
+    class ClosingHandler(LambdaHandler):
+        def close(self):
+            received.append("closed")
+    handler = FanoutHandler([ClosingHandler(slow(0.2))], timeout=1.0, deadline=0.05)
+    handler.handle(logging.makeLogRecord({"msg": "c"}))
+    counters = handler.metrics.snapshot()["counters"]
+    if counters["queued"] != 1 or counters["dropped"]:
+        raise Exception("Record past the deadline not counted as queued: %s" % counters)
+    handler.close()
+    if received[-2:] != [(0.2, "c"), "closed"] or handler.handler_metrics(
+            handler.handlers[0]).snapshot()["counters"]["succeeded"] != 1:
+        raise Exception("Closed under a running call: %s" % received[-2:])
+
+    # Calls left behind at the deadline still time out, and trip the breaker
+    release = threading.Event()
+    hung = LambdaHandler(lambda x: release.wait())
+    handler = FanoutHandler([LambdaHandler(slow(0.001)), hung], timeout=0.1, deadline=0.05,
+                            attempts=2)
+    for i in range(50):
+        handler.handle(logging.makeLogRecord({"msg": "h"}))
+        time.sleep(0.01)
+    time.sleep(0.15)
+    counters = handler.handler_metrics(hung).snapshot()["counters"]
+    # Calls made before the first timeout was seen are also let through
+    if not 2 <= counters["timed_out"] <= 4 or counters["queued"] != counters["timed_out"] or \
+            handler.stuck_workers()[hung] < 2:
+        raise Exception("Detached calls not timed out: %s, %s stuck" % (
+            counters, handler.stuck_workers()[hung]))
+    print "Hung handler past the deadline timed out %d times in 50 records, then skipped" % (
+        counters["timed_out"])
+    # Let the hung calls return, rather than at interpreter shutdown
+    release.set()
+    handler.close()
+
+    # Calls finishing right at their timeout, as the watcher abandons them
+    handler = FanoutHandler([LambdaHandler(lambda x: time.sleep(0.02))], timeout=0.02,
+                            deadline=0.0005, attempts=1000000, max_stuck=1000000)
+    def storm():
+        for i in range(400):
+            handler.handle(logging.makeLogRecord({"msg": "s"}))
+            time.sleep(0.0025)
+    t = threading.Thread(target=storm)
+    t.daemon = True
+    t.start()
+    t.join(30)
+    if t.is_alive():
+        raise Exception("Fanout deadlocked settling calls at their timeout")
+    print "400 calls finishing at their timeout settled without deadlock"
+    # Let the last calls return, and the workers stop, before the
+    # interpreter shuts down
+    handler.close()
+    time.sleep(0.1)
+    print "Fanout OKAY"
@@ -1,5 +1,11 @@
 import logging
 import logging.handlers
+import sys
+import time
+
+from batching import BatchBuffer
+from metrics import HandlerMetrics
+from structured import message
 
 class LambdaHandler(logging.Handler):
     ''' A simple, extendable handler for logging. Initialize with a function. 
@@ -15,9 +21,79 @@ class LambdaHandler(logging.Handler):
         '''
         logging.Handler.__init__(self)
         self.f = f
+        self.metrics = HandlerMetrics("LambdaHandler")
 
     def emit(self, record):
-        self.f(record.msg)
+        self.metrics.incr("emitted")
+        t = time.time()
+        try:
+            self.f(message(self, record))
+        except Exception:
+            self.metrics.observe(time.time() - t, "raised")
+            raise
+        self.metrics.observe(time.time() - t, "succeeded")
+
+class BatchLambdaHandler(logging.Handler):
+    ''' Like LambdaHandler, but the function is called with a list of
+    messages rather than one at a time, so it can use bulk APIs such
+    as a database executemany or a bulk HTTP endpoint. '''
+    def __init__(self, f, batch_count=100, batch_bytes=None, linger=1.0):
+        ''' Takes a function which should take a list of messages. It
+        is called once batch_count messages (or batch_bytes bytes of
+        string messages) have been collected, on the logging thread,
+        or from a background thread once the oldest message is linger
+        seconds old. With linger=None there is no background thread,
+        and messages wait for a full batch or flush(). close() sends
+        whatever is left. Example:
+
+        def insert(messages):
+           cursor.executemany("INSERT INTO log (msg) VALUES (%s)", [(m,) for m in messages])
+           db.commit()
+
+        db_handler = BatchLambdaHandler(insert, batch_count=500, linger=5)
+
+        A batch the function raises on is dropped, and reported through
+        handleError.
+        '''
+        logging.Handler.__init__(self)
+        self.f = f
+        if batch_bytes is None:
+            batch_bytes = sys.maxint
+        self.metrics = HandlerMetrics("BatchLambdaHandler")
+        self.buffer = BatchBuffer(self.__send, batch_count, batch_bytes, linger, name="BatchLambdaHandler")
+
+    def __send(self, messages):
+        t = time.time()
+        try:
+            self.f(messages)
+        except Exception:
+            # Called from the linger thread and close() as well as from
+            # emit, so there may be no caller to raise to
+            self.metrics.observe(time.time() - t, "raised", len(messages))
+            self.metrics.incr("dropped", len(messages))
+            self.handleError(logging.makeLogRecord({
+                "name": "BatchLambdaHandler", "msg": "Batch of %d messages dropped" % len(messages)}))
+            return
+        self.metrics.observe(time.time() - t, "succeeded", len(messages))
+
+    def emit(self, record):
+        msg = message(self, record)
+        self.metrics.incr("emitted")
+        self.metrics.incr("queued")
+        self.buffer.add(msg, len(msg) if isinstance(msg, basestring) else 0)
+
+    def pending(self):
+        ''' The number of messages buffered. '''
+        return len(self.buffer)
+
+    def flush(self):
+        self.buffer.flush()
+
+    def close(self):
+        try:
+            self.buffer.close()
+        finally:
+            logging.Handler.close(self)
 
 if __name__ == '__main__':
     ''' Debug/test code. ''' 
@@ -28,3 +104,34 @@ if __name__ == '__main__':
     logger.addHandler(LambdaHandler(p))
     logger.error("AAAA")
     logger.info("BBBB")
+
+    batch_handler = BatchLambdaHandler(p, batch_count=3, linger=None)
+    logger.addHandler(batch_handler)
+    for m in ["CCCC", "DDDD", "EEEE", "FFFF"]:
+        logger.error(m)
+    batch_handler.close()
+    logger.removeHandler(batch_handler)
+
+    from structured import StructuredFormatter
+    json_handler = LambdaHandler(p)
+    json_handler.setFormatter(StructuredFormatter(["levelname", "message"]))
+    logger.addHandler(json_handler)
+    logger.error("GGGG %d", 7)
+    logger.removeHandler(json_handler)
+
+    # Failed batches are dropped and reported, from the linger thread
+    # and from close()
+    class Reporting(BatchLambdaHandler):
+        reported = []
+        def handleError(self, record):
+            self.reported.append(record.getMessage())
+    def fail(messages):
+        raise IOError("Database down")
+    failing = Reporting(fail, batch_count=10, linger=0.05)
+    failing.handle(logging.makeLogRecord({"msg": "lingered"}))
+    time.sleep(0.2)
+    failing.handle(logging.makeLogRecord({"msg": "closed"}))
+    failing.close()
+    if failing.metrics.snapshot()["counters"]["dropped"] != 2 or len(Reporting.reported) != 2:
+        raise Exception("Failed batches not reported: %s" % Reporting.reported)
+    print "BatchLambdaHandler OKAY"
@@ -0,0 +1,214 @@
+''' Low-overhead counters and latency histograms for the handlers.
+
+Every handler in this package has a metrics attribute, a
+HandlerMetrics, with these counters (all counted in records):
+
+* emitted: records given to the handler
+* succeeded: records delivered downstream
+* timed_out: records whose delivery timed out
+* raised: records whose delivery raised an exception
+* fell_back: records delivered by a fallback rather than the main path
+* dropped: records given up on, or deliberately discarded
+* queued: records put in a buffer or queue to be sent later
+
+and a fixed-bucket histogram of the latency of its downstream calls.
+Updates take one uncontended lock, so they are cheap from many
+threads. snapshot() returns a plain dictionary; snapshot_all() returns
+one for every live handler, and Reporter hands that to a callback
+every so often:
+
+    reporter = Reporter(lambda snapshots: statsd_send(snapshots), interval=60)
+'''
+import bisect
+import collections
+import math
+import threading
+import weakref
+
+COUNTERS = ("emitted", "succeeded", "timed_out", "raised", "fell_back", "dropped", "queued")
+
+# Upper bounds of the latency buckets, in seconds: 0.5ms up to 32s,
+# doubling. Anything slower lands in a final overflow bucket.
+DEFAULT_BOUNDS = tuple(0.0005 * 2 ** i for i in range(17))
+
+_registry = weakref.WeakSet()
+_registry_lock = threading.Lock()
+
+
+class Histogram(object):
+    ''' A fixed-bucket histogram. Not locked on its own; HandlerMetrics
+    updates it under its lock. '''
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        ''' The upper bound of the bucket holding the pth fraction of
+        values (0 < p <= 1), or None if there are none. Values in the
+        overflow bucket report the maximum seen. '''
+        if not self.count:
+            return None
+        rank = p * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c:
+                if i < len(self.bounds):
+                    return self.bounds[i]
+                return self.max
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count,
+                "sum": self.total,
+                "max": self.max,
+                "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99),
+                "buckets": zip(list(self.bounds) + [None], list(self.counts))}
+
+
+class HandlerMetrics(object):
+    ''' Counters and a latency histogram for one handler. '''
+    def __init__(self, name, bounds=DEFAULT_BOUNDS):
+        self.name = name
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.latency = Histogram(bounds)
+        with _registry_lock:
+            _registry.add(self)
+
+    def incr(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def observe(self, seconds, counter=None, n=1):
+        ''' Records the latency of a downstream call, and optionally
+        counts its outcome at the same time. '''
+        with self.lock:
+            self.latency.add(seconds)
+            if counter is not None:
+                self.counters[counter] += n
+
+    def percentile(self, p, min_count=1):
+        ''' The pth latency percentile, or None if fewer than min_count
+        latencies have been recorded. '''
+        with self.lock:
+            if self.latency.count < min_count:
+                return None
+            return self.latency.percentile(p)
+
+    def snapshot(self):
+        with self.lock:
+            return {"name": self.name,
+                    "counters": dict(self.counters),
+                    "latency": self.latency.snapshot()}
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict.fromkeys(COUNTERS, 0)
+            self.latency = Histogram(self.latency.bounds)
+
+
+class LatencyEstimator(object):
+    ''' A streaming estimate of recent latency: exponentially weighted
+    moving averages of the latency and of its deviation, as TCP keeps
+    for its retransmission timeout. The last /window/ latencies are
+    also kept, for exact percentiles of recent latency. Updates are not
+    locked; under contention one may occasionally be lost, which only
+    slows the estimate down a little. '''
+    def __init__(self, alpha=0.125, beta=0.25, window=100):
+        self.alpha = alpha
+        self.beta = beta
+        self.mean = None
+        self.deviation = 0.0
+        self.count = 0
+        self.recent = collections.deque(maxlen=window)
+
+    def add(self, seconds):
+        if self.mean is None:
+            self.mean = seconds
+            self.deviation = seconds / 2
+        else:
+            self.deviation += self.beta * (abs(seconds - self.mean) - self.deviation)
+            self.mean += self.alpha * (seconds - self.mean)
+        self.count += 1
+        self.recent.append(seconds)
+
+    def percentile(self, p, min_count=1):
+        ''' The pth percentile (0 < p <= 1) of the last window
+        latencies, or None if fewer than min_count are kept. '''
+        recent = sorted(self.recent)
+        if not recent or len(recent) < min_count:
+            return None
+        return recent[max(0, min(len(recent), int(math.ceil(p * len(recent)))) - 1)]
+
+    def bound(self, deviations=4):
+        ''' The mean plus the given number of deviations, or None if
+        nothing has been added. '''
+        if self.mean is None:
+            return None
+        return self.mean + deviations * self.deviation
+
+
+def snapshot_all():
+    ''' Snapshots of every live HandlerMetrics. '''
+    with _registry_lock:
+        metrics = list(_registry)
+    return [m.snapshot() for m in metrics]
+
+
+class Reporter(object):
+    ''' Calls callback with snapshot_all() every interval seconds, from
+    a background thread, until stop() is called. '''
+    def __init__(self, callback, interval=60):
+        self.callback = callback
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run, name="MetricsReporter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.callback(snapshot_all())
+            except Exception:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+
+if __name__ == '__main__':
+    m = HandlerMetrics("test")
+    for i in range(1000):
+        m.observe(0.001 * (i % 100), "succeeded")
+    m.incr("dropped", 3)
+    s = m.snapshot()
+    if s["counters"]["succeeded"] != 1000 or s["counters"]["dropped"] != 3:
+        raise Exception("Counters failed: " + str(s["counters"]))
+    if not (0.032 <= s["latency"]["p50"] <= 0.064 and s["latency"]["p99"] == 0.128):
+        raise Exception("Percentiles failed: " + str(s["latency"]))
+    # Percentiles of recent latency forget a slow period, and are exact
+    e = LatencyEstimator(window=100)
+    for i in range(1000):
+        e.add(5.0)
+    for i in range(100):
+        e.add(0.001 * (i + 1))
+    if e.percentile(0.9) != 0.09 or e.percentile(1) != 0.1 or LatencyEstimator().percentile(0.5) is not None:
+        raise Exception("Recent percentiles failed: %s" % e.percentile(0.9))
+    if "test" not in [snap["name"] for snap in snapshot_all()]:
+        raise Exception("Registry failed")
+    print "Metrics OKAY"
@@ -0,0 +1,311 @@
+import collections
+import logging
+import logging.handlers
+import threading
+import time
+
+from compact import CompactRecord
+from metrics import HandlerMetrics
+
+
+class _Lane(object):
+    ''' Queued records for one group of levels. '''
+    __slots__ = ('level', 'weight', 'sheddable', 'records', 'stride', 'dropped', 'seen')
+
+    def __init__(self, level, weight, sheddable):
+        self.level = level
+        self.weight = weight
+        self.sheddable = sheddable
+        self.records = collections.deque()
+        # Stride scheduling: the lane with the lowest stride goes next,
+        # and each record sent adds 1/weight to it. A lane which was
+        # empty starts level with the others (see PriorityHandler.emit).
+        self.stride = 0.0
+        self.dropped = 0
+        self.seen = 0
+
+
+class PriorityHandler(logging.Handler):
+    ''' PriorityHandler wraps another handler, in the same way as
+    AsyncHandler, but queues records in lanes by level, so a backlog
+    of INFO records does not hold up ERRORs:
+
+        handler = PriorityHandler(FailsafeHandler(SQSHandler("myqueue"), ...))
+
+    Each lane is a (level, weight, sheddable) tuple; a record goes in
+    the first lane whose level it reaches. Drainer threads take records
+    from the lanes in proportion to their weights, so the top lane gets
+    most of the sending, and the others are never starved.
+
+    All lanes share queue_size. Under pressure, load is shed from the
+    bottom up:
+    * once the queue is shed_at full, sheddable lanes keep only a
+      /sample/ fraction of their records
+    * once it is full, a record pushes out the oldest record of the
+      lowest lane below its own, or is dropped if there is none
+
+    Each lane's dropped count is in lane_dropped(). flush(), close()
+    and compact behave as for AsyncHandler, except that records emitted
+    after close() are dropped, as there is no fallback handler.
+    '''
+    DEFAULT_LANES = ((logging.ERROR, 8, False),
+                     (logging.WARNING, 2, False),
+                     (logging.NOTSET, 1, True))
+
+    def __init__(self, handler, queue_size=10000, workers=1, lanes=DEFAULT_LANES,
+                 shed_at=0.5, sample=0.1, compact=False):
+        ''' Parameters:
+        * handler is the wrapped handler
+        * queue_size is the number of records which may be queued in all
+          lanes together
+        * workers is the number of drainer threads
+        * lanes is a list of (level, weight, sheddable) tuples
+        * shed_at is the fraction of queue_size at which sheddable lanes
+          start sampling
+        * sample is the fraction of records sheddable lanes keep then
+        * compact queues CompactRecords instead of the records
+        '''
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.queue_size = queue_size
+        self.shed_at = shed_at
+        self.compact = compact
+        self.sample_every = max(1, int(round(1 / sample))) if sample else None
+        self.lanes = [_Lane(level, weight, sheddable)
+                      for level, weight, sheddable in sorted(lanes, reverse=True)]
+        self.queued = 0
+        self.unfinished = 0
+        # The stride of the lane last sent from
+        self.clock = 0.0
+        self.condition = threading.Condition(threading.Lock())
+        self.metrics = HandlerMetrics("PriorityHandler")
+        self.closed = False
+        self.stopping = False
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.__drain, name="PriorityHandler-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def createLock(self):
+        # The lanes have their own lock, and the wrapped handler is not
+        # called under it.
+        self.lock = None
+
+    def __lane(self, record):
+        for lane in self.lanes:
+            if record.levelno >= lane.level:
+                return lane
+        return self.lanes[-1]
+
+    def __next(self):
+        # Must be called with the condition held. The record from the
+        # non-empty lane with the lowest stride, or None.
+        best = None
+        for lane in self.lanes:
+            if lane.records and (best is None or lane.stride < best.stride):
+                best = lane
+        if best is None:
+            return None
+        self.clock = best.stride
+        best.stride += 1.0 / best.weight
+        self.queued -= 1
+        return best.records.popleft()
+
+    def __drain(self):
+        while True:
+            with self.condition:
+                record = self.__next()
+                while record is None:
+                    if self.stopping:
+                        return
+                    self.condition.wait()
+                    record = self.__next()
+            if self.compact:
+                record = record.expand()
+            t = time.time()
+            try:
+                self.handler.emit(record)
+            except Exception:
+                self.metrics.observe(time.time() - t, "raised")
+                self.handleError(record)
+            else:
+                self.metrics.observe(time.time() - t, "succeeded")
+            with self.condition:
+                self.unfinished -= 1
+                if not self.unfinished:
+                    self.condition.notify_all()
+
+    def emit(self, record):
+        self.metrics.incr("emitted")
+        lane = self.__lane(record)
+        if self.compact:
+            record = CompactRecord(record)
+        with self.condition:
+            if self.closed:
+                # The drainers are stopping, and the wrapped handler is
+                # closed or about to be
+                self.metrics.incr("dropped")
+                return
+            lane.seen += 1
+            if lane.sheddable and self.sample_every and \
+                    self.queued >= self.shed_at * self.queue_size and lane.seen % self.sample_every:
+                lane.dropped += 1
+                self.metrics.incr("dropped")
+                return
+            if self.queued >= self.queue_size:
+                for victim in reversed(self.lanes):
+                    if victim is lane:
+                        victim = None
+                        break
+                    if victim.records:
+                        break
+                if victim is None:
+                    lane.dropped += 1
+                    self.metrics.incr("dropped")
+                    return
+                victim.records.popleft()
+                victim.dropped += 1
+                self.queued -= 1
+                self.unfinished -= 1
+                self.metrics.incr("dropped")
+            if not lane.records:
+                # An idle lane has no credit for the time it sat empty,
+                # or a lane which ran alone for long would be starved
+                # until the others caught up with it.
+                strides = [l.stride for l in self.lanes if l.records]
+                lane.stride = max(lane.stride, min(strides) if strides else self.clock)
+            lane.records.append(record)
+            self.queued += 1
+            self.unfinished += 1
+            self.metrics.incr("queued")
+            # Several drainers may all be waiting; wake one
+            self.condition.notify()
+
+    def lane_dropped(self):
+        ''' A dictionary from each lane's level to the number of records
+        dropped from it. '''
+        with self.condition:
+            return dict((lane.level, lane.dropped) for lane in self.lanes)
+
+    def pending(self):
+        ''' The number of records queued or being sent. '''
+        return self.unfinished
+
+    def flush(self, timeout=None):
+        ''' Waits until every record queued so far has been emitted,
+        then flushes the wrapped handler. Returns False if timeout
+        seconds passed first. '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.condition:
+            while self.unfinished:
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+        self.handler.flush()
+        return True
+
+    def close(self):
+        # Records are queued under the condition, so once closed is set
+        # every record queued before it is sent by the flush below.
+        with self.condition:
+            closing = not self.closed
+            self.closed = True
+        if closing:
+            self.flush()
+            with self.condition:
+                self.stopping = True
+                self.condition.notify_all()
+            for t in self.threads:
+                t.join()
+            self.handler.close()
+        logging.Handler.close(self)
+
+if __name__ == '__main__':
+    from lambdahandler import LambdaHandler
+    logger = logging.getLogger('myapp')
+    logger.setLevel(logging.DEBUG)
+    received = []
+    gate = threading.Event()
+    def slow(x):
+        gate.wait()
+        time.sleep(0.001)
+        received.append(x)
+
+    handler = PriorityHandler(LambdaHandler(slow), queue_size=100)
+    logger.addHandler(handler)
+    # A backlog of INFO, then a few ERRORs, while the handler is stuck
+    for i in range(1000):
+        logger.info("info %d" % i)
+    for i in range(10):
+        logger.error("error %d" % i)
+    gate.set()
+    handler.close()
+    logger.removeHandler(handler)
+    errors = [i for i, m in enumerate(received) if m.startswith("error")]
+    dropped = handler.lane_dropped()
+    if len(errors) != 10 or errors[-1] > 20 or not dropped[logging.NOTSET] or dropped[logging.ERROR]:
+        raise Exception("Priority failed: errors at %s, dropped %s" % (errors, dropped))
+    print "ERRORs delivered at positions %s of %d; %d INFO records shed" % (
+        errors, len(received), dropped[logging.NOTSET])
+
+    # After a long run of ERRORs alone, a backlog of INFO does not get
+    # ahead of a new ERROR
+    del received[:]
+    gate.set()
+    def fast(x):
+        gate.wait()
+        received.append(x)
+    handler = PriorityHandler(LambdaHandler(fast), queue_size=10000)
+    logger.addHandler(handler)
+    for i in range(8000):
+        logger.error("error %d" % i)
+    handler.flush()
+    del received[:]
+    gate.clear()
+    for i in range(1000):
+        logger.info("info %d" % i)
+    logger.error("error late")
+    gate.set()
+    handler.close()
+    logger.removeHandler(handler)
+    late = received.index("error late")
+    if late > 2:
+        raise Exception("ERROR after a long ERROR run delivered at %d of %d" % (late, len(received)))
+    print "After 8000 ERRORs, a new ERROR delivered at position %d of %d" % (late, len(received))
+
+    # Emits racing close are sent or counted as dropped, and none
+    # reaches the closed handler
+    del received[:]
+    class Closable(LambdaHandler):
+        closed = False
+
+        def emit(self, record):
+            if self.closed:
+                raise Exception("emit after close")
+            LambdaHandler.emit(self, record)
+
+        def close(self):
+            self.closed = True
+    handler = PriorityHandler(Closable(fast), workers=2)
+    def emits():
+        for i in range(1000):
+            handler.emit(logging.makeLogRecord({"msg": "close %d" % i}))
+    threads = [threading.Thread(target=emits) for i in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.001)
+    handler.close()
+    for t in threads:
+        t.join()
+    counters = handler.metrics.snapshot()["counters"]
+    if len(received) != counters["queued"] or len(received) + counters["dropped"] != 4000:
+        raise Exception("close race failed: %d sent, %s" % (len(received), counters))
+    print "Priority lanes OKAY"
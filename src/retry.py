@@ -0,0 +1,197 @@
+''' Retries for the AWS handlers.
+
+A send which fails because the service is throttling or briefly down
+is worth trying again, but not at once, and not without limit: a
+service which is struggling gets every client's retries on top of its
+normal load. So a Retrier:
+
+* waits a capped, exponentially growing and fully jittered delay
+  before each retry, so clients which failed together do not retry
+  together
+* runs retries on its own background thread, never on the caller's
+* retries a failed batch as one, with one delay
+* draws on a RetryBudget, shared by default by every handler in the
+  process, which allows retries of only a fraction of recent sends.
+  During an outage most failures are then dropped (or go to a
+  fallback) at once, rather than multiplying the load.
+
+Handlers given a Retrier attach a deduplication id to each record they
+send on its own, the same on every attempt, so consumers can discard
+the copies a retry of a send which did in fact succeed creates. It
+goes in the DEDUP_ATTRIBUTE message attribute, which SQSConsumer asks
+for, and skips ids it has already seen. On FIFO queues and topics
+(names ending in ".fifo") every record gets one, which is also sent as
+the MessageDeduplicationId, so the service itself drops the copies.
+'''
+import heapq
+import random
+import threading
+import time
+import uuid
+
+# Message attribute holding a record's deduplication id
+DEDUP_ATTRIBUTE = "dedup-id"
+
+
+def backoff(attempt, base=0.05, cap=10.0):
+    ''' The delay, in seconds, before retry number /attempt/ (from 1):
+    uniformly random up to base * 2**attempt, capped at cap. '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def dedup_id():
+    ''' A new deduplication id. '''
+    return uuid.uuid4().hex
+
+
+def is_fifo(destination):
+    ''' Whether a queue or topic name, URL or ARN is a FIFO one. '''
+    return destination.endswith(".fifo")
+
+
+def message_group(group_by):
+    ''' A function of a record giving its message group id, as a str.
+    group_by is a record attribute name, or a function of the record. '''
+    if isinstance(group_by, basestring):
+        attribute = group_by
+        group_by = lambda record: getattr(record, attribute, None)
+    def group(record):
+        value = group_by(record)
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+    return group
+
+
+class RetryBudget(object):
+    ''' A token bucket for retries. Each send adds /ratio/ of a token,
+    and /reserve/ tokens are added per second so that a quiet process
+    can still retry; a retry takes one token. The bucket holds at most
+    /limit/ tokens. '''
+    def __init__(self, ratio=0.1, reserve=10, limit=100):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.limit = limit
+        self.tokens = float(limit)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def deposit(self, n=1):
+        ''' Records n sends. '''
+        with self.lock:
+            self.tokens = min(self.limit, self.tokens + n * self.ratio)
+
+    def withdraw(self, n=1):
+        ''' Asks to retry n sends. Returns how many may be retried. '''
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.reserve)
+            self.updated = now
+            granted = min(n, int(self.tokens))
+            self.tokens -= granted
+            return granted
+
+# Shared by every Retrier and EventSender not given a budget of its own
+GLOBAL_BUDGET = RetryBudget()
+
+
+class Retrier(object):
+    ''' Schedules retries of failed sends. It may be shared by several
+    handlers. Its thread is started on the first retry. '''
+    def __init__(self, base=0.05, cap=10.0, budget=None, name="Retrier"):
+        ''' Parameters:
+        * base and cap set the backoff; see backoff()
+        * budget is the RetryBudget retries are drawn from. Defaults to
+          GLOBAL_BUDGET.
+        * name is used to name the thread
+        '''
+        self.base = base
+        self.cap = cap
+        self.budget = budget if budget is not None else GLOBAL_BUDGET
+        self.name = name
+        self.heap = []          # of (due time, sequence, function, entries)
+        self.sequence = 0
+        self.condition = threading.Condition(threading.Lock())
+        self.thread = None
+
+    def sent(self, n=1):
+        ''' Records n first attempts, which earn retry budget. '''
+        self.budget.deposit(n)
+
+    def retry(self, function, entries, attempt):
+        ''' Schedules function(entries) after the backoff for retry
+        number /attempt/. If the budget does not cover every entry,
+        only the first ones are retried. Returns how many were. '''
+        granted = self.budget.withdraw(len(entries))
+        if not granted:
+            return 0
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.heap, (time.time() + backoff(attempt, self.base, self.cap),
+                                       self.sequence, function, entries[:granted]))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+        return granted
+
+    def pending(self):
+        ''' The number of entries waiting to be retried. '''
+        with self.condition:
+            return sum(len(item[3]) for item in self.heap)
+
+    def __call(self, function, entries):
+        try:
+            function(entries)
+        except Exception:
+            # There is no caller to report to. The function is
+            # expected to handle its own errors.
+            pass
+
+    def __run(self):
+        while True:
+            with self.condition:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                due, sequence, function, entries = heapq.heappop(self.heap)
+            self.__call(function, entries)
+
+    def flush(self):
+        ''' Runs every pending retry now, on the calling thread, and any
+        retries they schedule in turn, without waiting out the backoff.
+        For use on close. '''
+        while True:
+            with self.condition:
+                if not self.heap:
+                    return
+                due, sequence, function, entries = heapq.heappop(self.heap)
+            self.__call(function, entries)
+
+if __name__ == '__main__':
+    budget = RetryBudget(ratio=0.5, reserve=0, limit=10)
+    budget.withdraw(10)
+    budget.deposit(4)
+    if budget.withdraw(5) != 2:
+        raise Exception("Budget failed")
+
+    attempts = []
+    retrier = Retrier(base=0.01, budget=RetryBudget(reserve=0, limit=8))
+    def send(entries):
+        attempts.append((time.time(), list(entries)))
+        if len(attempts) < 3:
+            retrier.retry(send, entries, len(attempts) + 1)
+    t = time.time()
+    if retrier.retry(send, ["a", "b", "c", "d", "e"], 1) != 5:
+        raise Exception("Retry refused")
+    time.sleep(0.5)
+    sizes = [len(entries) for when, entries in attempts]
+    if sizes != [5, 3]:
+        raise Exception("Budget not applied to retries: %s" % sizes)
+    print "Retried %s after %s ms" % (sizes, [int((when - t) * 1000) for when, entries in attempts])
+    print "Retry OKAY"
@@ -0,0 +1,113 @@
+import itertools
+import logging
+import logging.handlers
+import operator
+import zlib
+
+from metrics import HandlerMetrics
+
+
+class ShardedHandler(logging.Handler):
+    ''' ShardedHandler spreads records over several handlers, typically
+    one SQS or SNS handler per queue or topic, so throughput is not
+    capped by a single destination and its connection:
+
+        queues = ["https://sqs.us-east-1.amazonaws.com/123456789012/logs-%d" % i
+                  for i in range(4)]
+        handler = ShardedHandler([EventSQSHandler(q) for q in queues], key="name")
+
+    Give each shard its own handler (and so its own connections or
+    EventSender); do not share a sender between shards.
+
+    With key=None records go round robin. Otherwise key is a record
+    attribute name, or a function of the record, and records with the
+    same key always go to the same shard, so a shard which sends in
+    order keeps each key's records in order while the shards send in
+    parallel. The shard is chosen by CRC32 of the key, which is stable
+    across processes and restarts. Records lacking the attribute have
+    the key None.
+
+    For FIFO queues and topics, give the event handlers the same key as
+    group_by, so each key is also its own message group.
+
+    Each shard's emit runs under that shard's lock, if it has one, and
+    shards are called in parallel from different threads.
+    '''
+    def __init__(self, handlers, key=None):
+        ''' Parameters:
+        * handlers is a list of handlers, one per shard
+        * key is None for round robin, a record attribute name, or a
+          function taking a record
+        '''
+        logging.Handler.__init__(self)
+        if not handlers:
+            raise ValueError("ShardedHandler needs at least one handler")
+        self.handlers = list(handlers)
+        if isinstance(key, basestring):
+            attribute = key
+            key = lambda record: getattr(record, attribute, None)
+        self.key = key
+        # next() on a count is atomic, so round robin needs no lock
+        self.counter = itertools.count()
+        self.metrics = HandlerMetrics("ShardedHandler")
+
+    def createLock(self):
+        # Each shard has its own lock
+        self.lock = None
+
+    def shard(self, record):
+        ''' The handler record is sent to. '''
+        if self.key is None:
+            i = next(self.counter)
+        else:
+            value = self.key(record)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            elif not isinstance(value, str):
+                value = str(value)
+            i = zlib.crc32(value) & 0xffffffff
+        return self.handlers[i % len(self.handlers)]
+
+    def emit(self, record):
+        self.metrics.incr("emitted")
+        try:
+            self.shard(record).handle(record)
+        except Exception:
+            self.metrics.incr("raised")
+            raise
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+if __name__ == '__main__':
+    from lambdahandler import LambdaHandler
+    shards = [[] for i in range(4)]
+    handler = ShardedHandler([LambdaHandler(s.append) for s in shards], key="name")
+    for i in range(400):
+        logger = logging.getLogger("myapp.%d" % (i % 20))
+        handler.handle(logger.makeRecord(logger.name, logging.ERROR, __file__, 1,
+                                         "%s %d" % (logger.name, i), (), None))
+    for s in shards:
+        names = set(m.split()[0] for m in s)
+        orders = [[int(m.split()[1]) for m in s if m.startswith(name + " ")] for name in names]
+        if any(o != sorted(o) for o in orders):
+            raise Exception("Shard out of order")
+        if any(m.split()[0] in names for other in shards if other is not s for m in other):
+            raise Exception("Key split across shards")
+    if sum(len(s) for s in shards) != 400 or not all(shards):
+        raise Exception("Records lost or shard unused: %s" % [len(s) for s in shards])
+    print "Keyed shards %s" % [len(s) for s in shards]
+
+    shards = [[] for i in range(3)]
+    handler = ShardedHandler([LambdaHandler(s.append) for s in shards])
+    for i in range(30):
+        handler.handle(logging.makeLogRecord({"msg": str(i)}))
+    if [len(s) for s in shards] != [10, 10, 10]:
+        raise Exception("Round robin failed: %s" % [len(s) for s in shards])
+    print "Sharded OKAY"
@@ -0,0 +1,260 @@
+''' Flushing and closing every handler at shutdown, within a deadline.
+
+At exit, logging closes its handlers one at a time, with no time
+limit. A handler whose endpoint is down holds up all the others, and
+the process hangs until whatever runs it gives up and kills it,
+losing everything still buffered. Instead:
+
+    shutdown.install(deadline=5.0)
+
+At exit, and on SIGTERM, every handler attached to a logger is then
+closed at once, each on its own thread, and the process waits at most
+/deadline/ seconds for them all. Handlers those wrap are closed by
+their wrappers. Handlers which do not finish in time are abandoned,
+and a line saying so, with the number of records they still held, is
+written to stderr, as is the count of records each handler dropped.
+logging's own shutdown is then told not to wait for them.
+
+If a signal already has a handler (a server's graceful shutdown, for
+instance), it is called after the handlers are flushed, and they are
+closed at exit as usual. Under a pre-forking server, call install() in
+each worker after the fork, once the server has set its own signal
+handlers (in gunicorn, the post_worker_init hook).
+'''
+import atexit
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from spoolhandler import SpoolHandler
+
+_lock = threading.Lock()
+_shut_down = False
+
+
+def attached_handlers():
+    ''' The handlers attached to loggers, each once. '''
+    loggers = [logging.getLogger()]
+    loggers.extend(l for l in logging.Logger.manager.loggerDict.values()
+                   if isinstance(l, logging.Logger))
+    seen = set()
+    handlers = []
+    for l in loggers:
+        for h in l.handlers:
+            if id(h) not in seen:
+                seen.add(id(h))
+                handlers.append(h)
+    return handlers
+
+
+def _registered_handlers():
+    # Every live handler, from logging's own list
+    handlers = []
+    for ref in list(logging._handlerList):
+        h = ref()
+        if h is not None:
+            handlers.append(h)
+    return handlers
+
+
+def _wrapped(handlers):
+    # The ids of the handlers which the given ones wrap, and close
+    # themselves, however deep
+    found = set()
+    stack = list(handlers)
+    while stack:
+        # vars, not getattr: FailsafeHandler passes names it does not
+        # have on to its main handler
+        attributes = vars(stack.pop())
+        children = list(attributes.get('handlers') or ())
+        children.append(attributes.get('handler'))
+        for child in children:
+            if isinstance(child, logging.Handler) and id(child) not in found:
+                found.add(id(child))
+                stack.append(child)
+    return found
+
+
+def _pending(handler):
+    # Records a handler still holds, if it says. A spool's are on disk.
+    if isinstance(handler, SpoolHandler):
+        return 0
+    try:
+        return handler.pending()
+    except Exception:
+        return None
+
+
+def _call(handler, method, errors):
+    try:
+        getattr(handler, method)()
+    except Exception, e:
+        errors[handler] = e
+
+
+def _run(method, handlers, deadline, stream):
+    end = time.time() + deadline
+    if handlers is None:
+        phases = [attached_handlers(), None]
+    else:
+        phases = [list(handlers)]
+    report = []
+    done = set()
+    for handlers in phases:
+        if handlers is None:
+            # Whatever the first phase's handlers did not take care of,
+            # themselves or through their wrappers
+            handlers = [h for h in _registered_handlers() if id(h) not in done]
+            if time.time() >= end:
+                break
+        errors = {}
+        threads = []
+        done.update(_wrapped(handlers))
+        for h in handlers:
+            done.add(id(h))
+            t = threading.Thread(target=_call, args=(h, method, errors), name="shutdown")
+            t.daemon = True
+            t.start()
+            threads.append((h, t))
+        for h, t in threads:
+            t.join(max(0, end - time.time()))
+        for h, t in threads:
+            metrics = getattr(h, 'metrics', None)
+            entry = {"handler": metrics.name if metrics is not None else type(h).__name__,
+                     "finished": not t.is_alive(),
+                     "error": errors.get(h),
+                     "pending": _pending(h),
+                     "dropped": metrics.snapshot()["counters"]["dropped"] if metrics is not None else 0}
+            report.append(entry)
+            if stream is not None:
+                if not entry["finished"]:
+                    stream.write("loghandlers: %s did not %s within %gs; %s records pending\n" % (
+                        entry["handler"], method, deadline, entry["pending"]))
+                elif entry["error"] is not None:
+                    stream.write("loghandlers: %s %s failed: %s\n" % (entry["handler"], method,
+                                                                       entry["error"]))
+                if entry["dropped"]:
+                    stream.write("loghandlers: %s dropped %d records\n" % (entry["handler"],
+                                                                          entry["dropped"]))
+    return report
+
+
+def flush_all(handlers=None, deadline=5.0, stream=None):
+    ''' Flushes handlers in parallel, waiting up to deadline seconds in
+    all. handlers defaults to those attached to loggers, then any others
+    logging knows of. Returns a list with a dictionary for each handler:
+    * handler, its metrics name
+    * finished, whether it finished in time
+    * error, any exception it raised
+    * pending, the records it still holds, if it says
+    * dropped, the records it has dropped
+    Problems are also written to stream, if given. '''
+    return _run("flush", handlers, deadline, stream)
+
+
+def close_all(handlers=None, deadline=5.0, stream=None):
+    ''' As flush_all, but closes the handlers. '''
+    return _run("close", handlers, deadline, stream)
+
+
+def shutdown(deadline=5.0, stream=sys.stderr):
+    ''' Closes every handler, once, as close_all does, then stops
+    logging's own shutdown from waiting on them. Returns close_all's
+    report, or None if already shut down. '''
+    global _shut_down
+    with _lock:
+        if _shut_down:
+            return None
+        _shut_down = True
+    report = close_all(None, deadline, stream)
+    # Everything is closed, or given up on; logging.shutdown would
+    # wait forever on what was given up on.
+    logging._acquireLock()
+    try:
+        del logging._handlerList[:]
+    finally:
+        logging._releaseLock()
+    return report
+
+
+def _on_signal(signum, frame, previous, deadline, stream):
+    if callable(previous):
+        # The process will shut down in its own way, and close the
+        # handlers at exit; make sure what is buffered is out first.
+        flush_all(None, deadline, stream)
+        previous(signum, frame)
+        return
+    shutdown(deadline, stream)
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def install(deadline=5.0, signals=(signal.SIGTERM,), stream=sys.stderr):
+    ''' Calls shutdown(deadline, stream) at exit, and on the given
+    signals. Signals which are ignored are left alone. Must be called
+    from the main thread. '''
+    atexit.register(shutdown, deadline, stream)
+    for signum in signals:
+        previous = signal.getsignal(signum)
+        if previous == signal.SIG_IGN:
+            continue
+        signal.signal(signum, lambda s, f, previous=previous: _on_signal(s, f, previous, deadline,
+                                                                         stream))
+
+if __name__ == '__main__':
+    import StringIO
+    from asynchandler import AsyncHandler
+    from lambdahandler import LambdaHandler
+    received = []
+    def slow(delay):
+        def f(x):
+            time.sleep(delay)
+            received.append(x)
+        return f
+
+    logger = logging.getLogger('myapp')
+    ok = AsyncHandler(LambdaHandler(slow(0.01)))
+    hung = AsyncHandler(LambdaHandler(slow(60)))
+    logger.addHandler(ok)
+    logger.addHandler(hung)
+    for i in range(20):
+        logger.error("TEST %d" % i)
+    out = StringIO.StringIO()
+    t = time.time()
+    report = shutdown(deadline=0.5, stream=out)
+    elapsed = time.time() - t
+    finished = dict((id(h), e["finished"]) for h, e in zip(attached_handlers(), report))
+    if elapsed > 1 or len(received) != 20 or not finished[id(ok)] or finished[id(hung)]:
+        raise Exception("Shutdown failed in %.2fs: %s" % (elapsed, report))
+    print out.getvalue(),
+    print "Shut down in %.2fs; %d records sent by the working handler" % (elapsed, len(received))
+    if shutdown() is not None or logging._handlerList:
+        raise Exception("Shutdown ran twice, or left handlers for logging.shutdown")
+    logger.removeHandler(ok)
+    logger.removeHandler(hung)
+
+    # Handlers inside a wrapper are closed by it, and only by it
+    import shutil
+    import tempfile
+    from failsafehandler import FailsafeHandler
+    directory = tempfile.mkdtemp()
+    try:
+        spool = SpoolHandler(directory, linger=0.01)
+        inner = LambdaHandler(received.append)
+        wrapped = FailsafeHandler(inner, [], LambdaHandler(received.append), timeout=1.0,
+                                  attempts=3, retry_timeout=60, spool=spool)
+        logger.addHandler(wrapped)
+        out = StringIO.StringIO()
+        report = close_all(deadline=1.0, stream=out)
+        logger.removeHandler(wrapped)
+        closed = [e["handler"] for e in report]
+        # The exception handler is left open by its wrapper, so closed here
+        if out.getvalue() or closed != ["FailsafeHandler", "LambdaHandler"]:
+            raise Exception("Wrapped handlers closed twice: %s, %r" % (closed, out.getvalue()))
+    finally:
+        shutil.rmtree(directory)
+    print "Wrapped handlers left to their wrapper"
+    print "Shutdown OKAY"
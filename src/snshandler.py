@@ -1,39 +1,351 @@
 import logging
 import logging.handlers
 import exceptions
+import time
 
 import boto.sns
 
+import destinations
+import envelope
+from envelope import CODECS as envelope_codecs
+from batching import BatchBuffer
+from connectionpool import ConnectionPool
+from metrics import HandlerMetrics
+import retry
+from structured import message
+
 class SNSHandler(logging.Handler):
     ''' Python logging handler which publishes to Amazon AWS Simple 
     Notification Service. 
+
+    In batch mode, records are buffered and published together. By
+    default several records are coalesced into one newline-delimited
+    message, kept under the SNS payload limit. With publish_batch,
+    records are sent as separate messages through PublishBatch, up to
+    ten to a request. With envelope set, batches are instead packed
+    into compressed envelopes (see the envelope module), each under the
+    payload limit, which keeps records intact even if they span lines.
+
+    Publishes are made on a pool of up to pool_size connections, so
+    several threads may publish at once.
+
+    With a Retrier (see the retry module), failed publishes are retried
+    with backoff from the retrier's thread, within its retry budget,
+    and records published one to a message carry a deduplication id in
+    the retry.DEDUP_ATTRIBUTE message attribute.
+
+    On a FIFO topic (one whose name ends in ".fifo"), every message
+    carries a deduplication id, published as its MessageDeduplicationId
+    too, and a message group id. Records must then be published one to
+    a message: unbatched, or with publish_batch.
     
     requires boto''' 
-    def __init__(self, topic="sns_handler_debug", aws_key=None, secret_key=None):
+    # SNS limits on a single message, and on a PublishBatch request
+    MAX_MESSAGE_BYTES = 256*1024
+    MAX_BATCH_COUNT = 10
+
+    def __init__(self, topic="sns_handler_debug", aws_key=None, secret_key=None,
+                 batch=False, batch_count=100, batch_bytes=MAX_MESSAGE_BYTES,
+                 linger=1.0, publish_batch=False, max_retries=3, connection=None,
+                 connection_factory=None, pool_size=1, idle_timeout=60, envelope=None,
+                 retrier=None, group_by="name"):
         ''' Sends log messages to SNS. Parameters: 
-        * topic is the SNS topic. This must exist prior to initalization. 
+        * topic is the SNS topic. This must exist prior to use. It may be
+          a topic ARN, in which case no lookup is needed. Otherwise, the
+          ARN is found on first use and cached for the process, so
+          creating the handler makes no AWS calls.
         * Optional: aws_key and secret_key. If these don't exist, it will look 
           at the appropriate environment variables. 
+        * Optional: batch turns on batch mode. A batch is published once
+          it holds batch_count records or batch_bytes bytes, or once its
+          oldest record has waited linger seconds. Coalesced records are
+          separated by newlines, so multi-line records cannot be told
+          apart on the receiving end.
+        * Optional: publish_batch sends batches with the PublishBatch
+          API instead of coalescing them. batch_count is then capped at
+          ten. Not all regions and SNS-compatible endpoints support it.
+        * Optional: max_retries is the number of times a record whose
+          publish failed is retried before it is dropped.
+        * Optional: connection is an SNSConnection, or an object with the
+          same interface, to use instead of creating one. It is the
+          only connection used, and is never closed by the handler.
+        * Optional: pool_size is the number of connections publishes may
+          be spread over, made with connection_factory (by default, an
+          SNSConnection with the given keys). Connections idle for
+          idle_timeout seconds are closed.
+        * Optional: envelope is a codec name ("zlib", or "lz4" or
+          "snappy" if installed), and turns on batch mode with
+          envelopes. batch_bytes then bounds the uncompressed records
+          packed per flush, and may be raised well past the limit.
+        * Optional: retrier is a retry.Retrier. Records which fail are
+          then retried up to max_retries times after a backoff, rather
+          than raising (or, in batch mode, going out again with the
+          next batch). A record the retry budget does not cover raises
+          (or is dropped) as before.
+        * Optional: group_by is a record attribute name, or a function
+          of the record, giving the message group id on a FIFO topic.
+          Defaults to the logger name.
         '''
         logging.Handler.__init__(self)
-        if aws_key and secret_key:
-            self.conn = boto.sns.SNSConnection(aws_key, secret_key)
-        else:
-            self.conn = boto.sns.SNSConnection()
+        if connection_factory is None:
+            if connection is not None:
+                if pool_size > 1:
+                    raise ValueError("A pool_size above 1 requires a connection_factory")
+                # The pool starts with it, and keeps it however long it
+                # is idle, so never needs to make another
+                idle_timeout = None
+            elif aws_key and secret_key:
+                connection_factory = lambda: boto.sns.SNSConnection(aws_key, secret_key)
+            else:
+                connection_factory = boto.sns.SNSConnection
+        self.pool = ConnectionPool(connection_factory, pool_size, idle_timeout, first=connection)
             
-        topics = self.conn.get_all_topics()
-        topics = topics["ListTopicsResponse"]["ListTopicsResult"]["Topics"]
-        topics = [t['TopicArn'] for t in topics]
-        try: 
-            self.topic = [t for t in topics if t.split(':')[5] == topic][0]
-        except: 
-            raise RuntimeError("Topic not found")
-        if not self.topic:
-            raise RuntimeError("Topic not found")
+        self.topic = None
+        if topic.startswith("arn:"):
+            self.topic = topic
+            topic = topic.split(':')[5]
         self.topic_name = topic
+        self.max_retries = max_retries
+        self.retrier = retrier
+        self.group = None
+        if retry.is_fifo(topic):
+            self.group = retry.message_group(group_by)
+            if envelope is not None or (batch and not publish_batch):
+                raise ValueError("A FIFO topic takes one record to a message; use publish_batch")
+        self.publish_batch_mode = publish_batch
+        self.metrics = HandlerMetrics("SNSHandler:" + topic)
+        self.buffer = None
+        self.envelope = envelope
+        if envelope is not None:
+            if envelope not in envelope_codecs:
+                raise ValueError("Codec not available: " + str(envelope))
+            self.buffer = BatchBuffer(self.publish_envelopes, batch_count, batch_bytes,
+                                      linger, name="SNSHandler")
+            return
+        if publish_batch:
+            batch_count = min(batch_count, self.MAX_BATCH_COUNT)
+            flush = self.publish_batch
+        else:
+            flush = self.publish_coalesced
+        if batch:
+            self.buffer = BatchBuffer(flush, batch_count,
+                                      min(batch_bytes, self.MAX_MESSAGE_BYTES),
+                                      linger, name="SNSHandler")
     
+    def resolve(self, conn):
+        ''' Returns the topic ARN, looking it up if need be. '''
+        if self.topic is None:
+            self.topic = destinations.resolve("sns", conn, self.topic_name,
+                                              lambda: self.__find_topic(conn))
+        return self.topic
+
+    def __find_topic(self, conn):
+        next_token = None
+        while True:
+            topics = conn.get_all_topics(next_token)
+            topics = topics["ListTopicsResponse"]["ListTopicsResult"]
+            for t in topics["Topics"]:
+                if t['TopicArn'].split(':')[5] == self.topic_name:
+                    return t['TopicArn']
+            next_token = topics.get("NextToken")
+            if not next_token:
+                raise RuntimeError("Topic not found")
+
     def emit(self, record): 
-        self.conn.publish(self.topic, record.msg)
+        self.metrics.incr("emitted")
+        if self.retrier is not None:
+            self.retrier.sent()
+        dedup = group = None
+        if self.retrier is not None or self.group is not None:
+            dedup = retry.dedup_id()
+        if self.group is not None:
+            group = self.group(record)
+        if self.buffer is not None:
+            # Buffered as UTF-8, so that coalescing joins bytes with
+            # bytes, and sizes are in bytes
+            msg = message(self, record)
+            if isinstance(msg, unicode):
+                msg = msg.encode('utf-8')
+            elif not isinstance(msg, str):
+                msg = str(msg)
+            self.metrics.incr("queued")
+            # Leave room for the separating newline
+            if self.publish_batch_mode and self.envelope is None:
+                self.buffer.add([msg, 0, dedup, group], len(msg) + 1)
+            else:
+                self.buffer.add([msg, 0], len(msg) + 1)
+            return
+        entry = [message(self, record), 0, dedup, group]
+        if self.retrier is None:
+            self.__publish(entry)
+            return
+        try:
+            self.__publish(entry)
+        except Exception:
+            if not self.__retry([entry]):
+                raise
+            self.metrics.incr("queued")
+
+    def __ids(self, prefix, params, dedup, group):
+        # The dedup id as a message attribute, and on a FIFO topic, the
+        # FIFO parameters, which SNSConnection.publish does not take
+        params[prefix + "MessageAttributes.entry.1.Name"] = retry.DEDUP_ATTRIBUTE
+        params[prefix + "MessageAttributes.entry.1.Value.DataType"] = "String"
+        params[prefix + "MessageAttributes.entry.1.Value.StringValue"] = dedup
+        if group is not None:
+            params[prefix + "MessageGroupId"] = group
+            params[prefix + "MessageDeduplicationId"] = dedup
+        return params
+
+    def __publish(self, entry):
+        ''' Publishes a [message, retries, dedup id, group] entry. '''
+        t = time.time()
+        try:
+            with self.pool.connection() as conn:
+                if entry[2] is None:
+                    conn.publish(self.resolve(conn), entry[0])
+                elif entry[3] is None:
+                    conn.publish(self.resolve(conn), entry[0], message_attributes={
+                        retry.DEDUP_ATTRIBUTE: {"data_type": "String", "string_value": entry[2]}})
+                else:
+                    params = self.__ids("", {"TopicArn": self.resolve(conn), "Message": entry[0]},
+                                        entry[2], entry[3])
+                    conn._make_request('Publish', params, verb='POST')
+        except Exception:
+            self.metrics.observe(time.time() - t, "raised")
+            raise
+        self.metrics.observe(time.time() - t, "succeeded")
+
+    def __retry(self, entries):
+        ''' Schedules another try of a single entry which failed.
+        Returns False if it is not to be retried. '''
+        entries[0][1] += 1
+        retrier = self.retrier
+        if retrier is None or entries[0][1] > self.max_retries:
+            return False
+        return retrier.retry(self.__republish, entries, entries[0][1]) > 0
+
+    def __republish(self, entries):
+        # Called by the retrier
+        try:
+            self.__publish(entries[0])
+        except Exception:
+            if not self.__retry(entries):
+                self.metrics.incr("dropped")
+
+    def createLock(self):
+        # Publishes are made on pooled connections, so emit is safe to
+        # call from several threads at once.
+        self.lock = None
+
+    def publish_coalesced(self, entries):
+        ''' Publishes a list of [message, retries] entries as a single
+        newline-delimited message. '''
+        t = time.time()
+        try:
+            with self.pool.connection() as conn:
+                conn.publish(self.resolve(conn), "\n".join(msg for msg, retries in entries))
+        except Exception:
+            self.metrics.observe(time.time() - t, "raised", len(entries))
+            self.__requeue(entries)
+        else:
+            self.metrics.observe(time.time() - t, "succeeded", len(entries))
+
+    def publish_envelopes(self, entries):
+        ''' Packs a list of [message, retries] entries into envelopes
+        and publishes each. Entries in envelopes which fail are
+        requeued. '''
+        failed = []
+        start = 0
+        for body, count in envelope.pack([msg for msg, retries in entries],
+                                         self.MAX_MESSAGE_BYTES, self.envelope):
+            held = entries[start:start+count]
+            start += count
+            t = time.time()
+            try:
+                with self.pool.connection() as conn:
+                    conn.publish(self.resolve(conn), body)
+            except Exception:
+                self.metrics.observe(time.time() - t, "raised", count)
+                failed.extend(held)
+            else:
+                self.metrics.observe(time.time() - t, "succeeded", count)
+        self.__requeue(failed)
+
+    def publish_batch(self, entries):
+        ''' Publishes a list of up to ten [message, retries, dedup id,
+        group] entries with one PublishBatch call. The dedup id is None
+        unless the handler has a retrier or the topic is FIFO, and the
+        group None unless it is FIFO. Entries which fail are requeued. '''
+        params = {}
+        for i, (msg, retries, dedup, group) in enumerate(entries):
+            params['PublishBatchRequestEntries.member.%d.Id' % (i+1)] = str(i)
+            params['PublishBatchRequestEntries.member.%d.Message' % (i+1)] = msg
+            if dedup is not None:
+                self.__ids('PublishBatchRequestEntries.member.%d.' % (i+1), params, dedup, group)
+        t = time.time()
+        try:
+            with self.pool.connection() as conn:
+                params['TopicArn'] = self.resolve(conn)
+                response = conn._make_request('PublishBatch', params, verb='POST')
+            errors = response["PublishBatchResponse"]["PublishBatchResult"].get("Failed") or []
+        except Exception:
+            self.metrics.observe(time.time() - t, "raised", len(entries))
+            self.__requeue(entries)
+            return
+        # Sender faults (e.g. a malformed message) will never succeed.
+        failed = [entries[int(f['Id'])] for f in errors if not f.get('SenderFault')]
+        lost = len(errors) - len(failed)
+        self.metrics.observe(time.time() - t, "succeeded", len(entries) - len(errors))
+        if failed:
+            self.metrics.incr("raised", len(failed))
+        if lost:
+            self.metrics.incr("dropped", lost)
+        self.__requeue(failed)
+
+    def __requeue(self, failed):
+        again = []
+        for entry in failed:
+            entry[1] += 1
+            if entry[1] <= self.max_retries:
+                again.append(entry)
+        retrier = self.retrier
+        if again and retrier is not None:
+            # The whole batch waits out one backoff, and goes back in
+            # the buffer after it
+            again = again[:retrier.retry(self.__buffer_again, again,
+                                         max(entry[1] for entry in again))]
+        if len(again) < len(failed):
+            self.metrics.incr("dropped", len(failed) - len(again))
+        if again and retrier is None:
+            self.__buffer_again(again)
+
+    def __buffer_again(self, entries):
+        # Messages are UTF-8 bytes; see emit
+        self.buffer.requeue(entries, [len(entry[0]) + 1 for entry in entries])
+
+    def pending(self):
+        ''' The number of records buffered or waiting to be retried. '''
+        count = len(self.buffer) if self.buffer is not None else 0
+        retrier = self.retrier
+        if retrier is not None:
+            # A shared retrier's count includes other handlers' retries
+            count += retrier.pending()
+        return count
+
+    def flush(self):
+        if self.buffer is not None:
+            self.buffer.flush()
+
+    def close(self):
+        if self.retrier is not None:
+            self.retrier.flush()
+            # What fails from here on goes straight back in the buffer,
+            # which close() keeps sending until it is empty
+            self.retrier = None
+        if self.buffer is not None:
+            self.buffer.close()
+        logging.Handler.close(self)
         
 if __name__ == '__main__':
     logger = logging.getLogger('myapp')
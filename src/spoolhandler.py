@@ -0,0 +1,242 @@
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+
+from batching import BatchBuffer
+from compact import CompactRecord
+from metrics import HandlerMetrics
+
+
+class SpoolHandler(logging.Handler):
+    ''' A Python logging handler which appends records to an on-disk
+    spool, to be replayed to another handler later. It is meant as the
+    fallback tier of a FailsafeHandler: while the main handler is out
+    of rotation records are kept on disk, not in memory, and once it
+    comes back the spool is drained into it.
+
+    The spool is a directory of append-only segment files, one JSON
+    record per line. Writes are batched. A segment is closed once it
+    reaches segment_bytes, and when a replay starts. The replayer only
+    reads closed segments, and deletes each one once it has been
+    delivered. Its position is kept in a cursor file, so delivery is
+    at-least-once across restarts. Replayed records arrive after any
+    records which reached the main handler directly in the meantime.
+
+    fsync is one of:
+    * "always": fsync after every batch written
+    * "interval": fsync at most every fsync_interval seconds
+    * "never": leave it to the operating system
+    '''
+    FSYNC_POLICIES = ("always", "interval", "never")
+    SUFFIX = ".spool"
+
+    def __init__(self, directory, segment_bytes=16*1024*1024, batch_count=100,
+                 linger=0.1, fsync="interval", fsync_interval=1.0):
+        ''' Parameters:
+        * directory holds the spool. It is created if it does not exist.
+        * segment_bytes is the size at which a segment is closed
+        * batch_count and linger control how records are batched
+          before being written
+        * fsync and fsync_interval set the fsync policy
+        '''
+        logging.Handler.__init__(self)
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy " + str(fsync))
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.last_fsync = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file_lock = threading.Lock()
+        self.segment = None
+        self.file = None
+        self.sequence = max([-1] + self.__segments())
+        self.__roll()
+        self.replayer = None
+        self.closing = False
+        self.metrics = HandlerMetrics("SpoolHandler:" + directory)
+        self.buffer = BatchBuffer(self.__write, batch_count, segment_bytes, linger, name="SpoolHandler")
+
+    def __segments(self):
+        ''' Sorted sequence numbers of the segments on disk. '''
+        return sorted(int(f[:-len(self.SUFFIX)]) for f in os.listdir(self.directory)
+                      if f.endswith(self.SUFFIX))
+
+    def __path(self, sequence):
+        return os.path.join(self.directory, "%012d%s" % (sequence, self.SUFFIX))
+
+    def __roll(self):
+        # Must be called with file_lock held, or from __init__
+        if self.file is not None:
+            self.file.flush()
+            if self.fsync != "never":
+                os.fsync(self.file.fileno())
+            self.file.close()
+        self.sequence += 1
+        self.segment = self.sequence
+        self.file = open(self.__path(self.segment), "ab")
+
+    def __write(self, lines):
+        t = time.time()
+        try:
+            with self.file_lock:
+                self.file.write("".join(lines))
+                self.file.flush()
+                now = time.time()
+                if self.fsync == "always" or \
+                        (self.fsync == "interval" and now - self.last_fsync >= self.fsync_interval):
+                    os.fsync(self.file.fileno())
+                    self.last_fsync = now
+                if self.file.tell() >= self.segment_bytes:
+                    self.__roll()
+        except Exception:
+            self.metrics.observe(time.time() - t, "raised", len(lines))
+            raise
+        self.metrics.observe(time.time() - t, "succeeded", len(lines))
+
+    def emit(self, record):
+        # The message with its args, and any exception, rendered now
+        line = json.dumps(CompactRecord(record).fields()) + "\n"
+        self.metrics.incr("emitted")
+        self.metrics.incr("queued")
+        self.buffer.add(line, len(line))
+
+    def pending(self):
+        ''' The number of bytes waiting to be replayed, including the
+        open segment. '''
+        self.buffer.flush()
+        total = 0
+        for sequence in self.__segments():
+            total += os.path.getsize(self.__path(sequence))
+        return total
+
+    def replaying(self):
+        ''' True while a replay is running. '''
+        return self.replayer is not None and self.replayer.is_alive()
+
+    def replay(self, emit, rate=100, keep_going=None):
+        ''' Starts a background thread which drains the spool by
+        calling emit (typically another handler's emit) with each
+        record, at up to rate records per second. Does nothing if a
+        replay is already running.
+
+        keep_going, if given, is called between records; when it
+        returns False the replay stops where it is. The replay also
+        stops if emit raises. Either way, what remains is replayed
+        next time.
+        '''
+        self.buffer.flush()
+        with self.file_lock:
+            if self.replaying():
+                return
+            if self.file.tell():
+                self.__roll()
+            last = self.segment - 1
+            self.replayer = threading.Thread(target=self.__replay, name="SpoolReplayer",
+                                             args=(emit, rate, keep_going, last))
+            self.replayer.daemon = True
+            self.replayer.start()
+
+    def __replay(self, emit, rate, keep_going, last):
+        cursor_path = os.path.join(self.directory, "cursor")
+        cursor = (-1, 0)
+        if os.path.exists(cursor_path):
+            with open(cursor_path) as f:
+                segment, offset = f.read().split()
+                cursor = (int(segment), int(offset))
+        interval = 1.0 / rate
+        next_time = time.time()
+        for sequence in self.__segments():
+            if sequence > last or self.closing:
+                return
+            offset = cursor[1] if sequence == cursor[0] else 0
+            with open(self.__path(sequence), "rb") as f:
+                f.seek(offset)
+                while True:
+                    line = f.readline()
+                    if not line:
+                        break
+                    if self.closing or (keep_going is not None and not keep_going()):
+                        self.__save_cursor(cursor_path, sequence, offset)
+                        return
+                    delay = next_time - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_time = max(next_time, time.time() - 1) + interval
+                    try:
+                        record = CompactRecord.from_fields(json.loads(line)).expand()
+                    except ValueError:
+                        # A line torn by a crash mid-write
+                        offset += len(line)
+                        continue
+                    try:
+                        emit(record)
+                    except Exception:
+                        self.__save_cursor(cursor_path, sequence, offset)
+                        return
+                    offset += len(line)
+            os.remove(self.__path(sequence))
+            self.__save_cursor(cursor_path, sequence + 1, 0)
+
+    def __save_cursor(self, path, segment, offset):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("%d %d" % (segment, offset))
+        os.rename(tmp, path)
+
+    def flush(self):
+        self.buffer.flush()
+        with self.file_lock:
+            self.file.flush()
+            if self.fsync != "never":
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.closing:
+            self.closing = True
+            # The replayer stops at its next record; let it save its
+            # cursor before the spool goes away
+            if self.replaying() and self.replayer is not threading.current_thread():
+                self.replayer.join()
+            self.buffer.close()
+            with self.file_lock:
+                self.file.close()
+                if not os.path.getsize(self.__path(self.segment)):
+                    os.remove(self.__path(self.segment))
+        logging.Handler.close(self)
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    from lambdahandler import LambdaHandler
+    directory = tempfile.mkdtemp()
+    try:
+        logger = logging.getLogger('myapp')
+        spool = SpoolHandler(directory, segment_bytes=200, linger=0.01)
+        logger.addHandler(spool)
+        for i in range(19):
+            logger.error("TEST %d", i)
+        try:
+            0/0
+        except ZeroDivisionError:
+            logger.exception("TEST %d", 19)
+        logger.removeHandler(spool)
+        received = []
+        replayed = LambdaHandler(received.append)
+        replayed.setFormatter(logging.Formatter())
+        spool.replay(replayed.emit, rate=1000)
+        spool.replayer.join()
+        if [m.split("\n")[0] for m in received] != ["TEST %d" % i for i in range(20)] or \
+                "ZeroDivisionError" not in received[-1] or spool.pending():
+            raise Exception("Replay failed: " + str(received))
+        spool.close()
+        # Closed again by whatever wraps it
+        spool.close()
+        print "Spool replay OKAY"
+    finally:
+        shutil.rmtree(directory)
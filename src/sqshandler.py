@@ -1,31 +1,347 @@
+import contextlib
 import logging
 import logging.handlers
+import time
 
+from boto.sqs.batchresults import BatchResults
 from boto.sqs.connection import SQSConnection
 from boto.sqs.message import Message
+from boto.sqs.queue import Queue
 import boto.sns
 
+from batching import BatchBuffer
+from connectionpool import ConnectionPool
+import destinations
+import envelope
+from envelope import CODECS as envelope_codecs
+from metrics import HandlerMetrics
+import retry
+from structured import message
+
 class SQSHandler(logging.Handler):
     ''' A Python logging handler which sends messages to Amazon SQS. Note 
-    that, in many cases, an SNSHandler, tied to SQS, is a better option. '''
-    def __init__(self, queue="sqs_handler_debug", aws_key=None, secret_key=None):
+    that, in many cases, an SNSHandler, tied to SQS, is a better option.
+
+    In batch mode, records are buffered and sent with SendMessageBatch,
+    up to ten to a request. Entries which fail within a batch are put
+    back in the buffer and go out again with the next batch. With
+    envelope set, each message is a compressed envelope holding many
+    records (see the envelope module), and batches are packed into as
+    few envelopes as the 256KB limit allows.
+
+    Sends are made on a pool of up to pool_size connections, so
+    several threads may send at once.
+
+    With a Retrier (see the retry module), failed sends are retried
+    with backoff from the retrier's thread, within its retry budget,
+    and records sent one to a message carry a deduplication id in the
+    retry.DEDUP_ATTRIBUTE message attribute.
+
+    On a FIFO queue (one whose name ends in ".fifo"), every message
+    carries a deduplication id, sent as its MessageDeduplicationId too,
+    and a message group id. Envelopes, which mix records of many
+    groups, cannot be used. '''
+    # SQS limits on a single SendMessageBatch request
+    MAX_BATCH_COUNT = 10
+    MAX_BATCH_BYTES = 256*1024
+
+    def __init__(self, queue="sqs_handler_debug", aws_key=None, secret_key=None,
+                 batch=False, batch_count=MAX_BATCH_COUNT, batch_bytes=MAX_BATCH_BYTES,
+                 linger=1.0, max_retries=3, connection=None,
+                 connection_factory=None, pool_size=1, idle_timeout=60, envelope=None,
+                 retrier=None, group_by="name"):
         ''' Sends log messages to SNS. Parameters: 
         * queue is the SQS queue. This will be created if it does not exist. 
+          It may be a queue URL, in which case no lookup is needed.
+          Otherwise, the URL is found on first use and cached for the
+          process, so creating the handler makes no AWS calls.
         * Optional: aws_key and secret_key. If these don't exist, it will look 
           at the appropriate environment variables. 
+        * Optional: batch turns on batch mode. A batch is sent once it
+          holds batch_count records or batch_bytes bytes (capped at the
+          SQS limits of 10 and 256KB), or once its oldest record has
+          waited linger seconds. An entry which fails is retried up to
+          max_retries times, then dropped.
+        * Optional: connection is an SQSConnection, or an object with the
+          same interface, to use instead of creating one. It is the
+          only connection used, and is never closed by the handler.
+        * Optional: pool_size is the number of connections sends may be
+          spread over, made with connection_factory (by default, an
+          SQSConnection with the given keys). Connections idle for
+          idle_timeout seconds are closed.
+        * Optional: envelope is a codec name ("zlib", or "lz4" or
+          "snappy" if installed), and turns on batch mode with
+          envelopes. batch_count and batch_bytes then bound the records
+          packed per flush and are not capped, so raise them (to, say,
+          1000 and 1MB). Envelope bodies are sent raw, not base64
+          encoded as boto Messages; read them with RawMessage and
+          envelope.decode.
+        * Optional: retrier is a retry.Retrier. Records which fail are
+          then retried up to max_retries times after a backoff, rather
+          than raising (or, in batch mode, going out again with the
+          next batch). A record the retry budget does not cover raises
+          (or is dropped) as before.
+        * Optional: group_by is a record attribute name, or a function
+          of the record, giving the message group id on a FIFO queue.
+          Defaults to the logger name.
         '''
 
         logging.Handler.__init__(self)
-        if aws_key and secret_key:
-            conn = SQSConnection(aws_key, secret_key)
-        else:
-            conn = SQSConnection()
-        self.q = conn.create_queue(queue)
+        if connection_factory is None:
+            if connection is not None:
+                if pool_size > 1:
+                    raise ValueError("A pool_size above 1 requires a connection_factory")
+                # The pool starts with it, and keeps it however long it
+                # is idle, so never needs to make another
+                idle_timeout = None
+            elif aws_key and secret_key:
+                connection_factory = lambda: SQSConnection(aws_key, secret_key)
+            else:
+                connection_factory = SQSConnection
+        self.connection_factory = connection_factory
+        self.queue_name = queue
+        self.url = None
+        if queue.startswith("http://") or queue.startswith("https://"):
+            self.url = queue
+        # Connections, not Queues, are pooled, so that evicting one
+        # closes its sockets
+        self.pool = ConnectionPool(connection_factory, pool_size, idle_timeout, first=connection)
+        self.max_retries = max_retries
+        self.retrier = retrier
+        self.envelope = envelope
+        self.group = None
+        if retry.is_fifo(queue):
+            self.group = retry.message_group(group_by)
+        self.metrics = HandlerMetrics("SQSHandler:" + queue)
+        self.buffer = None
+        if envelope is not None:
+            if self.group is not None:
+                raise ValueError("Envelopes cannot be sent to a FIFO queue")
+            if envelope not in envelope_codecs:
+                raise ValueError("Codec not available: " + str(envelope))
+            self.buffer = BatchBuffer(self.send_envelopes, batch_count, batch_bytes,
+                                      linger, name="SQSHandler")
+        elif batch:
+            self.buffer = BatchBuffer(self.send_batch,
+                                      min(batch_count, self.MAX_BATCH_COUNT),
+                                      min(batch_bytes, self.MAX_BATCH_BYTES),
+                                      linger, name="SQSHandler")
         
+    @contextlib.contextmanager
+    def __queue(self):
+        # A Queue on a pooled connection. Queues are cheap to make.
+        with self.pool.connection() as conn:
+            yield Queue(conn, self.resolve(conn))
+
+    def resolve(self, conn):
+        ''' Returns the queue URL, creating the queue if need be. '''
+        if self.url is None:
+            self.url = destinations.resolve("sqs", conn, self.queue_name,
+                                            lambda: conn.create_queue(self.queue_name).url)
+        return self.url
+
     def emit(self, record):
+        self.metrics.incr("emitted")
+        if self.retrier is not None:
+            self.retrier.sent()
+        if self.envelope is not None:
+            msg = message(self, record)
+            if not isinstance(msg, basestring):
+                msg = str(msg)
+            self.metrics.incr("queued")
+            self.buffer.add([msg, 0], len(msg))
+            return
         m = Message()
-        m.set_body(record.msg)
-        self.q.write(m)
+        m.set_body(message(self, record))
+        dedup = group = None
+        if self.retrier is not None or self.group is not None:
+            dedup = retry.dedup_id()
+        if self.group is not None:
+            group = self.group(record)
+        if self.buffer is not None:
+            # Encode as boto would for a single write, so consumers
+            # see the same bodies in either mode.
+            body = m.get_body_encoded()
+            self.metrics.incr("queued")
+            self.buffer.add([body, 0, dedup, group], len(body))
+            return
+        if dedup is not None:
+            m.message_attributes = self.__attribute(dedup)
+        entry = [m, 0, dedup, group]
+        try:
+            self.__write(entry)
+        except Exception:
+            if not self.__retry([entry]):
+                raise
+            self.metrics.incr("queued")
+
+    def __attribute(self, dedup):
+        return {retry.DEDUP_ATTRIBUTE: {"data_type": "String", "string_value": dedup}}
+
+    def __fifo_params(self, prefix, params, body, dedup, group):
+        # Queue.write and write_batch have no FIFO parameters, so FIFO
+        # requests are made with boto's own parameter names
+        params[prefix + "MessageBody"] = body
+        params[prefix + "MessageGroupId"] = group
+        params[prefix + "MessageDeduplicationId"] = dedup
+        params[prefix + "MessageAttribute.1.Name"] = retry.DEDUP_ATTRIBUTE
+        params[prefix + "MessageAttribute.1.Value.DataType"] = "String"
+        params[prefix + "MessageAttribute.1.Value.StringValue"] = dedup
+        return params
+
+    def __write(self, entry):
+        ''' Writes the Message in a [message, retries, dedup id, group]
+        entry. '''
+        t = time.time()
+        try:
+            with self.__queue() as q:
+                if entry[3] is None:
+                    q.write(entry[0])
+                else:
+                    params = self.__fifo_params("", {}, entry[0].get_body_encoded(), entry[2],
+                                                entry[3])
+                    q.connection.get_object('SendMessage', params, Message, q.id, verb='POST')
+        except Exception:
+            self.metrics.observe(time.time() - t, "raised")
+            raise
+        self.metrics.observe(time.time() - t, "succeeded")
+
+    def __retry(self, entries):
+        ''' Schedules another try of a single entry which failed. Returns False if it is not to be retried. '''
+        entries[0][1] += 1
+        retrier = self.retrier
+        if retrier is None or entries[0][1] > self.max_retries:
+            return False
+        return retrier.retry(self.__rewrite, entries, entries[0][1]) > 0
+
+    def __rewrite(self, entries):
+        # Called by the retrier
+        try:
+            self.__write(entries[0])
+        except Exception:
+            if not self.__retry(entries):
+                self.metrics.incr("dropped")
+
+    def createLock(self):
+        # Sends are made on pooled connections, so emit is safe to
+        # call from several threads at once.
+        self.lock = None
+
+    def send_batch(self, entries):
+        ''' Sends a list of [body, retries, dedup id, group] entries
+        with one SendMessageBatch call. The dedup id is None unless the
+        handler has a retrier or the queue is FIFO, and the group None
+        unless it is FIFO. Failed entries are requeued. '''
+        self.__requeue(self.__write_batch([(entry[0], [entry]) for entry in entries]))
+
+    def send_envelopes(self, entries):
+        ''' Packs a list of [message, retries] entries into envelopes,
+        and sends them in as few SendMessageBatch calls as the limits
+        allow. Entries in envelopes which fail are requeued. '''
+        packed = []
+        start = 0
+        for body, count in envelope.pack([entry[0] for entry in entries],
+                                         self.MAX_BATCH_BYTES, self.envelope):
+            packed.append((body, entries[start:start+count]))
+            start += count
+        failed = []
+        while packed:
+            request = [packed.pop(0)]
+            size = len(request[0][0])
+            while packed and len(request) < self.MAX_BATCH_COUNT and \
+                    size + len(packed[0][0]) <= self.MAX_BATCH_BYTES:
+                size += len(packed[0][0])
+                request.append(packed.pop(0))
+            failed.extend(self.__write_batch(request))
+        self.__requeue(failed)
+
+    def __write_batch(self, pairs):
+        ''' Sends a list of (body, entries) pairs as one SendMessageBatch
+        call. Returns the entries whose bodies failed. '''
+        count = sum(len(held) for body, held in pairs)
+        t = time.time()
+        try:
+            with self.__queue() as q:
+                if self.group is None:
+                    results = q.write_batch([self.__batch_entry(i, body, held)
+                                             for i, (body, held) in enumerate(pairs)])
+                else:
+                    # Each body holds one record
+                    params = {}
+                    for i, (body, held) in enumerate(pairs):
+                        params["SendMessageBatchRequestEntry.%d.Id" % (i+1)] = str(i)
+                        self.__fifo_params("SendMessageBatchRequestEntry.%d." % (i+1), params,
+                                           body, held[0][2], held[0][3])
+                    results = q.connection.get_object('SendMessageBatch', params, BatchResults,
+                                                      q.id, verb='POST')
+        except Exception:
+            self.metrics.observe(time.time() - t, "raised", count)
+            return sum([held for body, held in pairs], [])
+        failed = []
+        lost = 0
+        for error in results.errors:
+            held = pairs[int(error['id'])][1]
+            # Sender faults (e.g. a malformed body) will never succeed.
+            if error.get('sender_fault') == 'true':
+                lost += len(held)
+            else:
+                failed.extend(held)
+        self.metrics.observe(time.time() - t, "succeeded", count - lost - len(failed))
+        if failed:
+            self.metrics.incr("raised", len(failed))
+        if lost:
+            self.metrics.incr("dropped", lost)
+        return failed
+
+    def __batch_entry(self, i, body, held):
+        # A body holding one record with a dedup id carries it as a
+        # message attribute
+        if len(held) == 1 and len(held[0]) > 2 and held[0][2] is not None:
+            return (str(i), body, 0, self.__attribute(held[0][2]))
+        return (str(i), body, 0)
+
+    def __requeue(self, failed):
+        again = []
+        for entry in failed:
+            entry[1] += 1
+            if entry[1] <= self.max_retries:
+                again.append(entry)
+        retrier = self.retrier
+        if again and retrier is not None:
+            # The whole batch waits out one backoff, and goes back in
+            # the buffer after it
+            again = again[:retrier.retry(self.__buffer_again, again,
+                                         max(entry[1] for entry in again))]
+        if len(again) < len(failed):
+            self.metrics.incr("dropped", len(failed) - len(again))
+        if again and retrier is None:
+            self.__buffer_again(again)
+
+    def __buffer_again(self, entries):
+        self.buffer.requeue(entries, [len(entry[0]) for entry in entries])
+
+    def pending(self):
+        ''' The number of records buffered or waiting to be retried. '''
+        count = len(self.buffer) if self.buffer is not None else 0
+        retrier = self.retrier
+        if retrier is not None:
+            # A shared retrier's count includes other handlers' retries
+            count += retrier.pending()
+        return count
+
+    def flush(self):
+        if self.buffer is not None:
+            self.buffer.flush()
+
+    def close(self):
+        if self.retrier is not None:
+            self.retrier.flush()
+            # What fails from here on goes straight back in the buffer,
+            # which close() keeps sending until it is empty
+            self.retrier = None
+        if self.buffer is not None:
+            self.buffer.close()
+        logging.Handler.close(self)
 
 if __name__ == '__main__':
     logger = logging.getLogger('myapp')
@@ -0,0 +1,230 @@
+import collections
+import logging
+import logging.handlers
+import threading
+import time
+
+from metrics import HandlerMetrics
+import structured
+
+
+class StormHandler(logging.Handler):
+    ''' StormHandler wraps another handler, in the same way as
+    FailsafeHandler, and keeps log storms away from it. During an
+    incident the same error may be logged thousands of times a second;
+    each copy would otherwise cost a network call downstream.
+
+    Functionality:
+    1. Identical records (same logger, level and message, with its
+       args interpolated) seen within /window/ seconds of the first are
+       collapsed. The first is passed on at once. Once the window is
+       over, one more record is passed on for the rest, with a
+       repeat_count attribute and the count appended to its message.
+       A background thread passes it on as the window ends, whether or
+       not anything else is logged.
+    2. Each (logger, level) pair has a token bucket which refills at
+       /rate/ records per second, up to /burst/. Records which find the
+       bucket empty are dropped; the next record let through is
+       preceded by a notice of how many were dropped. /limits/ maps a
+       level to its own (rate, burst), overriding the default.
+
+    Recent message keys are kept in an LRU of at most /max_keys/
+    entries, so the cost per record is formatting its message, a
+    dictionary lookup and a couple of arithmetic operations. Records
+    are passed on with the wrapped handler's handle(), under its lock.
+    '''
+    def __init__(self, handler, window=1.0, rate=None, burst=None, limits=None, max_keys=1000):
+        ''' Parameters:
+        * handler is the wrapped handler
+        * window is the time, in seconds, over which duplicates are
+          collapsed. None turns collapsing off.
+        * rate and burst are the default token bucket. None turns rate
+          limiting off.
+        * limits maps levels to (rate, burst) tuples
+        * max_keys bounds the number of recent messages remembered
+        '''
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.window = window
+        self.default_limit = None
+        if rate is not None:
+            self.default_limit = (rate, burst if burst is not None else rate)
+        self.limits = limits or {}
+        self.max_keys = max_keys
+        # key -> [window start, repeats, last suppressed record]
+        self.recent = collections.OrderedDict()
+        # (logger, level) -> [tokens, last refill, dropped]
+        self.buckets = {}
+        self.state_lock = threading.Lock()
+        # Wakes the thread which passes on summaries as windows end
+        self.condition = threading.Condition(self.state_lock)
+        self.thread = None
+        self.stopping = False
+        self.metrics = HandlerMetrics("StormHandler")
+
+    def createLock(self):
+        # Bookkeeping has its own lock, and the wrapped handler is not
+        # called under it.
+        self.lock = None
+
+    def __summary(self, record, repeats):
+        summary = logging.makeLogRecord(record.__dict__)
+        structured.forget(summary)
+        summary.repeat_count = repeats
+        summary.msg = "%s [repeated %d times]" % (record.getMessage(), repeats)
+        summary.args = ()
+        return summary
+
+    def __expire(self, now, out):
+        # Must be called with state_lock held. Entries are in order of
+        # window start, so expired ones are at the front.
+        while self.recent:
+            key, entry = next(self.recent.iteritems())
+            if now - entry[0] < self.window and len(self.recent) <= self.max_keys:
+                break
+            del self.recent[key]
+            if entry[1]:
+                out.append(self.__summary(entry[2], entry[1]))
+
+    def __expire_on_time(self):
+        while True:
+            out = []
+            with self.condition:
+                if self.stopping:
+                    return
+                now = time.time()
+                self.__expire(now, out)
+                if not out:
+                    if self.recent:
+                        # The oldest window ends first
+                        self.condition.wait(next(self.recent.itervalues())[0] + self.window - now)
+                    else:
+                        self.condition.wait()
+                    continue
+            for r in out:
+                self.handler.handle(r)
+
+    def __allow(self, record, now, out):
+        # Must be called with state_lock held. Token bucket check.
+        limit = self.limits.get(record.levelno, self.default_limit)
+        if limit is None:
+            return True
+        rate, burst = limit
+        key = (record.name, record.levelno)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [burst, now, 0]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            out.append(logging.makeLogRecord({
+                "name": record.name, "levelno": record.levelno,
+                "levelname": record.levelname, "created": now,
+                "msg": "%d records from %s at %s were rate limited" % (bucket[2], record.name, record.levelname),
+                "dropped_count": bucket[2]}))
+            bucket[2] = 0
+        return True
+
+    def emit(self, record):
+        now = time.time()
+        self.metrics.incr("emitted")
+        out = []
+        with self.state_lock:
+            if self.window is not None:
+                self.__expire(now, out)
+                try:
+                    key = (record.name, record.levelno, record.getMessage())
+                except Exception:
+                    # Its args do not fit its msg; the wrapped handler
+                    # will report that. Don't try to collapse it.
+                    entry = key = None
+                else:
+                    entry = self.recent.get(key)
+                if entry is not None:
+                    entry[1] += 1
+                    entry[2] = record
+                    record = None
+                elif key is not None:
+                    if not self.recent:
+                        self.condition.notify()
+                    self.recent[key] = [now, 0, None]
+                    if self.thread is None:
+                        self.thread = threading.Thread(target=self.__expire_on_time,
+                                                       name="StormHandler")
+                        self.thread.daemon = True
+                        self.thread.start()
+            if record is not None:
+                if self.__allow(record, now, out):
+                    out.append(record)
+                else:
+                    record = None
+        if record is None:
+            # Collapsed into a later summary, or rate limited
+            self.metrics.incr("dropped")
+        else:
+            self.metrics.incr("succeeded")
+        for r in out:
+            self.handler.handle(r)
+
+    def flush(self):
+        ''' Passes on pending repeat counts, and flushes the wrapped handler. '''
+        out = []
+        with self.state_lock:
+            for entry in self.recent.itervalues():
+                if entry[1]:
+                    out.append(self.__summary(entry[2], entry[1]))
+            self.recent.clear()
+        for r in out:
+            self.handler.handle(r)
+        self.handler.flush()
+
+    def close(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        self.handler.close()
+        logging.Handler.close(self)
+
+if __name__ == '__main__':
+    from lambdahandler import LambdaHandler
+    logger = logging.getLogger('myapp')
+    received = []
+    handler = StormHandler(LambdaHandler(received.append), window=0.1, rate=10, burst=5)
+    logger.addHandler(handler)
+    for i in range(1000):
+        logger.error("Database is down")
+    time.sleep(0.15)
+    logger.error("Database is down")
+    if received != ["Database is down", "Database is down [repeated 999 times]", "Database is down"]:
+        raise Exception("Collapsing failed: " + str(received))
+
+    # Keyed on the interpolated message, and summed up when the window
+    # ends, even if nothing more is logged
+    del received[:]
+    handler.handler.setFormatter(logging.Formatter())
+    for i in range(100):
+        logger.error("Shard %d is down", i % 2)
+    time.sleep(0.15)
+    if sorted(received) != ["Shard 0 is down", "Shard 0 is down [repeated 49 times]",
+                            "Shard 1 is down", "Shard 1 is down [repeated 49 times]"]:
+        raise Exception("Collapsing by message failed: " + str(received))
+    print "Duplicate collapsing OKAY"
+
+    del received[:]
+    for i in range(20):
+        logger.warning("Request %d failed" % i)
+    time.sleep(0.2)
+    logger.warning("Request 20 failed")
+    handler.close()
+    logger.removeHandler(handler)
+    if received[:5] != ["Request %d failed" % i for i in range(5)] or \
+            received[5:] != ["15 records from myapp at WARNING were rate limited", "Request 20 failed"]:
+        raise Exception("Rate limiting failed: " + str(received))
+    print "Rate limiting OKAY"
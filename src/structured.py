@@ -0,0 +1,154 @@
+''' Structured (JSON) output for the handlers.
+
+By default the handlers send record.msg as given. Give a handler a
+formatter and it sends the formatted record instead:
+
+    handler.setFormatter(StructuredFormatter(["created", "name", "levelname", "message"],
+                                             static={"service": "api"}))
+
+StructuredFormatter serializes the selected LogRecord fields to one
+line of JSON. The field list is compiled once, when the formatter is
+made. The result is cached on the record, so a record passed to
+several handlers (for instance a FailsafeHandler's main and fallback
+handlers) with the same fields is serialized only once.
+
+ujson or simplejson are used if installed; they are faster than the
+json module.
+'''
+import json
+import logging
+import operator
+
+# Encoders are built once; json.dumps with options builds one per call
+ENCODERS = {"json": json.JSONEncoder(separators=(',', ':'), default=str).encode}
+
+try:
+    import ujson
+    ENCODERS["ujson"] = ujson.dumps
+except ImportError:
+    pass
+
+try:
+    import simplejson
+    ENCODERS["simplejson"] = simplejson.JSONEncoder(separators=(',', ':'), default=str).encode
+except ImportError:
+    pass
+
+# Attribute on the LogRecord holding serialized output, by formatter key
+CACHE_ATTRIBUTE = "_structured"
+
+DEFAULT_FIELDS = ("created", "name", "levelname", "message")
+
+
+def fastest_encoder():
+    ''' The fastest JSON encoder installed. '''
+    for encoder in ("ujson", "simplejson", "json"):
+        if encoder in ENCODERS:
+            return encoder
+
+
+def message(handler, record):
+    ''' What handler sends for record: record.msg, unless the handler
+    has a formatter, in which case the formatted record. '''
+    if handler.formatter is None:
+        return record.msg
+    return handler.format(record)
+
+
+class StructuredFormatter(logging.Formatter):
+    ''' Formats records as JSON objects of selected fields.
+
+    Fields are LogRecord attributes, plus "message", the message with
+    its arguments interpolated, and "exception", the formatted
+    traceback if there is one. Attributes a record lacks are left
+    out. static is a dictionary of constant fields added to every
+    record. '''
+    def __init__(self, fields=DEFAULT_FIELDS, static=None, encoder=None):
+        logging.Formatter.__init__(self)
+        if encoder is None:
+            encoder = fastest_encoder()
+        if encoder not in ENCODERS:
+            raise ValueError("Encoder not available: " + str(encoder))
+        self.encode = ENCODERS[encoder]
+        self.static = dict(static or {})
+        self.template = []
+        for field in fields:
+            if field == "message":
+                self.template.append((field, logging.LogRecord.getMessage))
+            elif field == "exception":
+                self.template.append((field, self.__exception))
+            else:
+                self.template.append((field, operator.attrgetter(field)))
+        # Formatters with the same fields share cached output
+        self.key = (tuple(fields), tuple(sorted(self.static.items())), encoder)
+
+    def __exception(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        return record.exc_text
+
+    def format(self, record):
+        cache = record.__dict__.get(CACHE_ATTRIBUTE)
+        if cache is None:
+            cache = record.__dict__[CACHE_ATTRIBUTE] = {}
+        else:
+            try:
+                return cache[self.key]
+            except (KeyError, TypeError):
+                pass
+        out = dict(self.static)
+        for field, get in self.template:
+            try:
+                value = get(record)
+            except AttributeError:
+                continue
+            if value is not None:
+                out[field] = value
+        try:
+            data = self.encode(out)
+        except (TypeError, OverflowError, ValueError):
+            # Some encoders reject what json turns into strings
+            data = ENCODERS["json"](out)
+        try:
+            cache[self.key] = data
+        except TypeError:
+            # Unhashable static values; don't cache
+            pass
+        return data
+
+
+def forget(record):
+    ''' Drops any serialized output cached on record, for use after
+    changing it. '''
+    record.__dict__.pop(CACHE_ATTRIBUTE, None)
+
+if __name__ == '__main__':
+    import time
+    record = logging.LogRecord("myapp", logging.ERROR, __file__, 1, "Request %d failed", (42,), None)
+    formatter = StructuredFormatter(static={"service": "api"})
+    data = formatter.format(record)
+    if json.loads(data) != {"service": "api", "created": record.created, "name": "myapp",
+                            "levelname": "ERROR", "message": "Request 42 failed"}:
+        raise Exception("Structured format failed: " + data)
+    if StructuredFormatter(static={"service": "api"}).format(record) is not data:
+        raise Exception("Cached output not shared")
+
+    n = 20000
+    plain = logging.Formatter('{"created":%(created)f,"name":"%(name)s","levelname":"%(levelname)s","message":"%(message)s"}')
+    t = time.time()
+    for i in range(n):
+        plain.format(record)
+    plain_time = time.time() - t
+    records = [logging.LogRecord("myapp", logging.ERROR, __file__, 1, "Request %d failed", (i,), None)
+               for i in range(n)]
+    t = time.time()
+    for r in records:
+        formatter.format(r)
+    first_time = time.time() - t
+    t = time.time()
+    for r in records:
+        formatter.format(r)
+    cached_time = time.time() - t
+    print "logging.Formatter %.1fus, structured %.1fus, cached %.1fus per record (%s)" % (
+        plain_time / n * 1e6, first_time / n * 1e6, cached_time / n * 1e6, fastest_encoder())
+    print "Structured OKAY"
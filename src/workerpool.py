@@ -0,0 +1,187 @@
+import threading
+import time
+import Queue
+
+
+class _Task(object):
+    ''' A single call queued on a WorkerPool. State transitions happen
+    under the pool lock; done is set just after finished, outside it.
+    done may be shared between several tasks which a caller waits on
+    together; finished is this task's own. '''
+    __slots__ = ('function', 'argument', 'done', 'finished', 'started', 'abandoned', 'stuck', 'exception')
+
+    def __init__(self, function, argument, done=None):
+        self.function = function
+        self.argument = argument
+        self.done = done if done is not None else threading.Event()
+        self.finished = False
+        self.started = False
+        self.abandoned = False
+        self.stuck = False
+        self.exception = None
+
+
+class WorkerPool(object):
+    ''' A long-lived set of threads which run calls on behalf of a
+    single handler, fed from a bounded work queue.
+
+    Python does not give a way to kill threads, so a call which runs
+    past its timeout keeps its worker busy. Such workers are counted
+    as stuck. Up to /max_stuck/ stuck workers are replaced with fresh
+    threads, so the pool keeps /size/ threads available while a few
+    calls hang. Once the cap is reached and every live worker is
+    stuck, the pool is wedged and refuses new work until one of the
+    stuck calls returns.
+    '''
+    def __init__(self, size=4, queue_size=1000, max_stuck=3, name="WorkerPool", spins=20):
+        ''' Parameters:
+        * size is the number of workers serving the queue
+        * queue_size bounds the number of calls waiting for a worker
+        * max_stuck is the number of stuck workers which will be
+          replaced. At most size+max_stuck threads ever exist.
+        * name is used to name the worker threads
+        * spins is how many times a caller yields to the workers
+          before falling back to a timed wait
+        '''
+        self.size = size
+        self.max_stuck = max_stuck
+        self.name = name
+        self.threads = 0
+        self.stuck = 0
+        self.spins = spins
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue(queue_size)
+        with self.lock:
+            for i in range(size):
+                self.__spawn()
+
+    def __spawn(self):
+        # Must be called with self.lock held
+        self.threads += 1
+        t = threading.Thread(target=self.__work, name="%s-%d" % (self.name, self.threads))
+        t.daemon = True
+        t.start()
+
+    def __work(self):
+        while True:
+            task = self.queue.get()
+            with self.lock:
+                if task is None:
+                    # Closed
+                    self.threads -= 1
+                    return
+                if task.abandoned:
+                    # The caller gave up before we got here; it has
+                    # already moved on to another handler.
+                    continue
+                task.started = True
+            try:
+                task.function(task.argument)
+            except Exception, ex:
+                task.exception = ex
+            retire = False
+            with self.lock:
+                task.finished = True
+                if task.stuck:
+                    self.stuck -= 1
+                    if self.threads - self.stuck > self.size:
+                        # We were replaced while stuck. Retire.
+                        self.threads -= 1
+                        retire = True
+            # Not under the lock: done may take locks of its own, which
+            # are held while calling abandon()
+            task.done.set()
+            if retire:
+                return
+
+    def wedged(self):
+        ''' True if every live worker is stuck on a timed out call. '''
+        return self.stuck >= self.threads
+
+    def submit(self, function, argument, done=None):
+        ''' Queues function(argument) without waiting for it. Returns
+        the task, or None if the pool is wedged or its queue is full.
+        done is an Event to set when the call finishes, which may be
+        shared with other tasks. '''
+        if self.wedged():
+            return None
+        task = _Task(function, argument, done)
+        try:
+            self.queue.put_nowait(task)
+        except Queue.Full:
+            return None
+        return task
+
+    def abandon(self, task, stuck=True):
+        ''' Gives up on a task. A task not yet started is skipped; one
+        running counts as stuck until it returns, unless stuck is
+        False, as when the caller lost interest rather than timed out.
+        Returns False if the task had already finished. '''
+        with self.lock:
+            if task.finished:
+                return False
+            task.abandoned = True
+            if task.started and stuck:
+                task.stuck = True
+                self.stuck += 1
+                if self.stuck <= self.max_stuck:
+                    self.__spawn()
+            return True
+
+    def result(self, task):
+        ''' The (status, exception) of a finished task. '''
+        if task.exception is not None:
+            return "Exception", task.exception
+        return "Success", None
+
+    def close(self):
+        ''' Stops the idle workers once the queue empties. Workers stuck
+        on a call stop when it returns. '''
+        with self.lock:
+            threads = self.threads
+        for i in range(threads):
+            try:
+                self.queue.put_nowait(None)
+            except Queue.Full:
+                # The workers are daemon threads, and go at exit
+                break
+
+    def run(self, function, argument, timeout):
+        ''' Calls function(argument) on a worker and waits up to
+        timeout seconds for it.
+
+        Returns a tuple of a status string and an exception. The
+        status is one of "Success", "Exception", "Timeout", or "Busy"
+        if the pool is wedged or its queue is full and the call was
+        never queued.
+        '''
+        task = self.submit(function, argument)
+        if task is None:
+            return "Busy", None
+        # Under Python 2, a timed Event.wait polls with sleeps of at
+        # least half a millisecond. Fast handlers usually finish within
+        # a couple of GIL handoffs, so give them that chance first.
+        for i in range(self.spins):
+            if task.finished:
+                break
+            time.sleep(0)
+        if not task.done.wait(timeout) and self.abandon(task):
+            return "Timeout", None
+        return self.result(task)
+
+if __name__ == '__main__':
+    calls = []
+    pool = WorkerPool(size=2, queue_size=10, max_stuck=2)
+
+    print pool.run(calls.append, "a", 0.1)
+    print pool.run(lambda x: 0/0, "b", 0.1)
+    for i in range(4):
+        print pool.run(time.sleep, 0.5, 0.05)
+    print "threads:", pool.threads, "stuck:", pool.stuck, "wedged:", pool.wedged()
+    print pool.run(calls.append, "c", 0.1)
+    time.sleep(0.6)
+    print "threads:", pool.threads, "stuck:", pool.stuck, "wedged:", pool.wedged()
+    print pool.run(calls.append, "d", 0.1)
+    if calls != ["a", "d"]:
+        raise Exception("WorkerPool failed: " + str(calls))
+    print "WorkerPool OKAY"